@@ -0,0 +1,151 @@
+# backfill.py
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+
+import config
+import db_manager
+import etl_metrics
+import tenants
+from concurrency import ordered_map
+
+logger = logging.getLogger(__name__)
+
+# Окно догрузки: набор данных тенанта за [date_from, date_to] (даты включительно)
+BackfillWindow = namedtuple('BackfillWindow', 'tenant dataset fetch_and_store date_from date_to')
+
+# Число идущих основных задач (foreground): фоновая догрузка не начинает новых окон, пока оно больше нуля
+_foreground_jobs = 0
+_foreground_idle = threading.Condition()
+
+
+@contextmanager
+def foreground():
+    """Отмечает основную задачу (ежедневную загрузку): на время ее работы фоновая догрузка встает на паузу."""
+    global _foreground_jobs
+    with _foreground_idle:
+        _foreground_jobs += 1
+    try:
+        yield
+    finally:
+        with _foreground_idle:
+            _foreground_jobs -= 1
+            _foreground_idle.notify_all()
+
+
+def _wait_for_foreground():
+    """Ждет, пока не останется основных задач; уже начатые окна при этом дорабатывают."""
+    with _foreground_idle:
+        if _foreground_jobs:
+            logger.info("Background backfill paused while a foreground job is running.")
+            _foreground_idle.wait_for(lambda: _foreground_jobs == 0)
+            logger.info("Background backfill resumed.")
+
+
+def split_into_windows(dates, window_days):
+    """
+    Режет отсортированный список дат на непрерывные окна не длиннее window_days дней:
+    пропуск в датах всегда начинает новое окно. Возвращает [(date_from, date_to), ...], самые свежие первыми.
+    """
+    windows = []
+    for day in dates:
+        if windows and day - windows[-1][1] == timedelta(days=1) and (day - windows[-1][0]).days < window_days:
+            windows[-1][1] = day
+        else:
+            windows.append([day, day])
+    return [(window_from, window_to) for window_from, window_to in reversed(windows)]
+
+
+def plan_windows(tasks, date_from, date_to, window_days):
+    """
+    Окна для всех (tenant, dataset, fetch_and_store) из tasks по датам, которых еще нет в etl_load_state.
+    Окна разных наборов чередуются, чтобы разные API работали одновременно, а не по очереди.
+    """
+    all_dates = [date_from + timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+    per_task = []
+    for tenant, dataset, fetch_and_store in tasks:
+        completed_dates = db_manager.get_completed_dates(tenant.tenant_id, dataset, date_from, date_to)
+        missing_dates = [day for day in all_dates if day not in completed_dates]
+        windows = [BackfillWindow(tenant, dataset, fetch_and_store, window_from, window_to)
+                   for window_from, window_to in split_into_windows(missing_dates, window_days)]
+        logger.info(f"Backfill {tenant.tenant_id}/{dataset}: {len(missing_dates)} of {len(all_dates)} dates "
+                    f"missing, {len(windows)} window(s).")
+        per_task.append(windows)
+    return [window for group in itertools.zip_longest(*per_task) for window in group if window is not None]
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class BackfillProgress:
+    """Прогресс догрузки по окнам; ETA считается по средней скорости в днях, т.к. окна бывают разной длины."""
+
+    def __init__(self, windows):
+        self.total_windows = len(windows)
+        self.total_days = sum((window.date_to - window.date_from).days + 1 for window in windows)
+        self.done_windows = 0
+        self.done_days = 0
+        self.failed_windows = 0
+        self._started = time.monotonic()
+
+    def window_done(self, window, ok):
+        self.done_windows += 1
+        self.done_days += (window.date_to - window.date_from).days + 1
+        if not ok:
+            self.failed_windows += 1
+        elapsed = time.monotonic() - self._started
+        eta = elapsed / self.done_days * (self.total_days - self.done_days)
+        logger.info(f"Backfill progress: {self.done_windows}/{self.total_windows} windows, "
+                    f"{self.done_days}/{self.total_days} dataset-days ({self.done_days / self.total_days:.1%}), "
+                    f"{self.failed_windows} failed; last {window.tenant.tenant_id}/{window.dataset} "
+                    f"{window.date_from}..{window.date_to} {'ok' if ok else 'FAILED'}; "
+                    f"elapsed {_format_seconds(elapsed)}, ETA {_format_seconds(eta)}.")
+
+
+def run_backfill(tasks, date_from, date_to, load_window, window_days=None, max_workers=None, background=False):
+    """
+    Догружает период [date_from, date_to] любой длины по окнам из window_days (config.BACKFILL_WINDOW_DAYS) дней,
+    выполняя до max_workers (config.BACKFILL_MAX_WORKERS) окон параллельно; лимиты частоты API общие для всех.
+    load_window(dataset, fetch_and_store, window_from, window_to) загружает окно от имени его тенанта,
+    отмечает даты в etl_load_state и возвращает успех. Отметка и есть контрольная точка: после перезапуска
+    план строится только из неотмеченных дат, поэтому загрузка продолжается с того места, где остановилась.
+    Самые свежие окна идут первыми. С background=True догрузка уступает основным задачам (см. foreground):
+    перед каждым окном ждет их завершения. Возвращает True, если все окна загрузились.
+    """
+    window_days = window_days or config.BACKFILL_WINDOW_DAYS
+    windows = plan_windows(tasks, date_from, date_to, window_days)
+    if not windows:
+        logger.info(f"Backfill {date_from} - {date_to}: nothing to load.")
+        return True
+
+    progress = BackfillProgress(windows)
+    logger.info(f"Backfill {date_from} - {date_to}: {progress.total_windows} window(s), "
+                f"{progress.total_days} dataset-days to load.")
+
+    def run_window(window):
+        if background:
+            _wait_for_foreground()
+        with tenants.use(window.tenant):
+            try:
+                return window, load_window(window.dataset, window.fetch_and_store, window.date_from, window.date_to)
+            except Exception as e:
+                logger.error(f"Backfill window {window.tenant.tenant_id}/{window.dataset} "
+                             f"{window.date_from}..{window.date_to} failed: {e}", exc_info=True)
+                with etl_metrics.stage(window.dataset):
+                    etl_metrics.add('failed_loads')
+                return window, False
+
+    for window, ok in ordered_map(run_window, windows, max_workers=max_workers or config.BACKFILL_MAX_WORKERS,
+                                  thread_name_prefix="backfill"):
+        progress.window_done(window, ok)
+
+    logger.info(f"Backfill {date_from} - {date_to} finished: {progress.total_windows - progress.failed_windows} "
+                f"of {progress.total_windows} window(s) loaded.")
+    return progress.failed_windows == 0
@@ -0,0 +1,266 @@
+# bench/fake_api.py
+"""
+Локальная замена API Метрики (stat/v1/data и Logs API) и Топвизора (positions_2/history, positions_2/summary)
+для бенчмарков: отдает синтетические, но детерминированные ответы нужного объема с заданной задержкой.
+"""
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TRAFFIC_SOURCES = (
+    ("Search engine traffic", ("Yandex", "Google", "Bing", "DuckDuckGo")),
+    ("Direct traffic", (None,)),
+    ("Link traffic", ("example.com", "habr.com", "vc.ru")),
+    ("Social network traffic", ("VK", "Telegram")),
+    ("Ad traffic", ("Yandex Direct",)),
+    ("Internal traffic", (None,)),
+)
+SOURCE_PAIRS = tuple((source_type, engine) for source_type, engines in TRAFFIC_SOURCES for engine in engines)
+
+_GOAL_METRIC_RE = re.compile(r'ym:s:goal(\d+)reaches')
+
+# Logs API: (код источника, поисковая/рекламная система или сайт) и цели из config.METRIKA_GOALS_MAP по умолчанию
+LOGS_SOURCES = (('organic', 'yandex'), ('organic', 'google'), ('direct', ''), ('referral', 'habr.com'),
+                ('social', 'vkontakte'), ('ad', 'ya_direct'), ('internal', ''))
+LOGS_GOAL_IDS = ('117840214', '117840244', '117840256')
+_LOGS_PATH_RE = re.compile(r'/management/v1/counter/\d+/(logrequests(?:/evaluate)?|logrequest/(\d+)(?:/(.+))?)$')
+
+
+def _days(date_from, date_to):
+    start = datetime.strptime(date_from, '%Y-%m-%d').date()
+    end = datetime.strptime(date_to, '%Y-%m-%d').date()
+    return [(start + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range((end - start).days + 1)]
+
+
+class FakeAPIState:
+    """Параметры объема ответов и счетчики запросов по методам (общие для всех потоков сервера)."""
+
+    def __init__(self, metrika_rows_per_day=200, keywords=1000, latency_ms=0, logs_visits_per_day=2000,
+                 logs_part_rows=50000):
+        self.metrika_rows_per_day = metrika_rows_per_day
+        self.keywords = keywords
+        self.latency_ms = latency_ms
+        self.logs_visits_per_day = logs_visits_per_day
+        self.logs_part_rows = logs_part_rows
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._log_requests = {}  # request_id -> {'params': ..., 'polls': ...}
+
+    def count(self, endpoint):
+        with self._lock:
+            self._requests[endpoint] = self._requests.get(endpoint, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._requests)
+
+    def create_log_request(self, params):
+        with self._lock:
+            request_id = len(self._log_requests) + 1
+            self._log_requests[request_id] = {'params': params, 'polls': 0}
+            return request_id
+
+    def poll_log_request(self, request_id):
+        """Описание запроса выгрузки: первый опрос - 'created', дальше - 'processed' со списком частей."""
+        with self._lock:
+            log_request = self._log_requests.get(request_id)
+            if log_request is None:
+                return None
+            log_request['polls'] += 1
+            polls = log_request['polls']
+        params = log_request['params']
+        days = _days(params['date1'][0], params['date2'][0])
+        if polls < 2:
+            return {'request_id': request_id, 'status': 'created'}
+        parts_count = -(-len(days) * self.logs_visits_per_day // self.logs_part_rows)
+        return {'request_id': request_id, 'status': 'processed',
+                'parts': [{'part_number': number, 'size': 0} for number in range(parts_count)]}
+
+    def log_request_params(self, request_id):
+        with self._lock:
+            log_request = self._log_requests.get(request_id)
+            return log_request and log_request['params']
+
+
+def _source_pair(index):
+    """Уникальная для index пара (тип источника, система): различные строки детализации, как в реальном отчете."""
+    source_type, engine = SOURCE_PAIRS[index % len(SOURCE_PAIRS)]
+    return source_type, f"{engine or 'Не определено'} #{index}"
+
+
+def _metrika_rows(query, rows_per_day):
+    """Строки ответа stat/v1/data для запрошенных dimensions/metrics и общее их число."""
+    dimensions = query['dimensions'][0].split(',')
+    metrics = query['metrics'][0].split(',')
+    days = _days(query['date1'][0], query['date2'][0])
+    limit = int(query.get('limit', ['10000'])[0])
+    offset = int(query.get('offset', ['1'])[0]) - 1
+
+    if dimensions == ['ym:s:date']:
+        combos = [()]
+    elif 'ym:s:goalID' in dimensions:
+        goal_ids = _GOAL_METRIC_RE.findall(query['metrics'][0])
+        combos = [(goal_id,) + _source_pair(i) for goal_id in goal_ids
+                  for i in range(max(1, rows_per_day // max(1, len(goal_ids))))]
+    else:
+        combos = [_source_pair(i) for i in range(rows_per_day)]
+
+    total = len(days) * len(combos)
+    rows = []
+    for index in range(offset, min(total, offset + limit)):
+        day, combo = days[index // len(combos)], combos[index % len(combos)]
+        rows.append({
+            'dimensions': [{'name': day}] + [{'name': value} for value in combo],
+            'metrics': [float((index * 7 + metric_index) % 97) for metric_index in range(len(metrics))],
+        })
+    return rows, total
+
+
+def _visit_value(field, day, index):
+    source, engine = LOGS_SOURCES[index % len(LOGS_SOURCES)]
+    values = {
+        'ym:s:visitID': lambda: str(index + 1),
+        'ym:s:date': lambda: day,
+        'ym:s:clientID': lambda: str(index // 3 + 1),
+        'ym:s:bounce': lambda: '1' if index % 4 == 0 else '0',
+        'ym:s:pageViews': lambda: str(index % 7 + 1),
+        'ym:s:visitDuration': lambda: str(index * 13 % 600),
+        'ym:s:lastTrafficSource': lambda: source,
+        'ym:s:lastSearchEngineRoot': lambda: engine if source == 'organic' else '',
+        'ym:s:lastAdvEngine': lambda: engine if source == 'ad' else '',
+        'ym:s:lastReferalSource': lambda: engine if source == 'referral' else '',
+        'ym:s:lastSocialNetwork': lambda: engine if source == 'social' else '',
+        'ym:s:goalsID': lambda: f"[{LOGS_GOAL_IDS[index % len(LOGS_GOAL_IDS)]}]" if index % 10 == 0 else '[]',
+    }
+    return values[field]() if field in values else ''
+
+
+def _logs_part(params, part_number, visits_per_day, part_rows):
+    """TSV одной части выгрузки визитов: строка заголовков и строки визитов part_number-й части."""
+    fields = params['fields'][0].split(',')
+    days = _days(params['date1'][0], params['date2'][0])
+    start = part_number * part_rows
+    stop = min(len(days) * visits_per_day, start + part_rows)
+    lines = ['\t'.join(fields)]
+    lines.extend('\t'.join(_visit_value(field, days[index // visits_per_day], index) for field in fields)
+                 for index in range(start, stop))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _positions_result(body, keywords_total):
+    days = _days(*body['dates'])
+    offset, limit = int(body.get('offset', 0)), int(body.get('limit', 1000))
+    keywords = []
+    for keyword_index in range(offset, min(keywords_total, offset + limit)):
+        positions_data = {
+            f"{day}:{body['project_id']}:{region}": {
+                'position': (keyword_index + day_index + region) % 100 + 1,
+                'relevant_url': f"https://example.com/page/{keyword_index % 250}",
+            }
+            for day_index, day in enumerate(days) for region in body.get('regions_indexes') or []
+        }
+        keywords.append({'id': keyword_index, 'name': f"keyword {keyword_index}", 'positionsData': positions_data})
+    return {'result': {'keywords': keywords}, 'total': keywords_total}
+
+
+def _summary_result(body):
+    days = _days(*body['dates'])
+    return {'result': {'dates': days,
+                       'visibilities': [round((day_index % 30) / 3.0, 2) for day_index in range(len(days))]}}
+
+
+def make_handler(state):
+    class FakeAPIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящих API
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, payload, status=200):
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _delay(self):
+            if state.latency_ms:
+                time.sleep(state.latency_ms / 1000.0)
+
+        def _logs_api(self, method, url):
+            """Logs API: evaluate, создание, статус, скачивание частей, clean/cancel."""
+            match = _LOGS_PATH_RE.search(url.path)
+            if not match:
+                return False
+            state.count('metrika_logs')
+            self._delay()
+            params = parse_qs(url.query)
+            target, request_id, action = match.group(1), match.group(2), match.group(3)
+            if target == 'logrequests/evaluate':
+                self._reply({'log_request_evaluation': {'possible': True, 'max_possible_day_quantity': 365}})
+            elif target == 'logrequests' and method == 'POST':
+                self._reply({'log_request': {'request_id': state.create_log_request(params), 'status': 'created'}})
+            elif request_id and action is None:
+                log_request = state.poll_log_request(int(request_id))
+                if log_request is None:
+                    self._reply({'errors': [{'message': 'unknown log request'}]}, status=404)
+                else:
+                    self._reply({'log_request': log_request})
+            elif request_id and action.startswith('part/'):
+                data = _logs_part(state.log_request_params(int(request_id)), int(action.split('/')[1]),
+                                  state.logs_visits_per_day, state.logs_part_rows)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/tab-separated-values; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self._reply({'log_request': {'request_id': int(request_id or 0), 'status': 'cleaned_by_user'}})
+            return True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/__stats':
+                self._reply(state.stats())
+                return
+            if self._logs_api('GET', url):
+                return
+            if url.path.endswith('/stat/v1/data'):
+                state.count('metrika')
+                self._delay()
+                rows, total = _metrika_rows(parse_qs(url.query), state.metrika_rows_per_day)
+                self._reply({'data': rows, 'total_rows': total})
+                return
+            self._reply({'errors': [{'message': f'unknown path {url.path}'}]}, status=404)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if self._logs_api('POST', urlparse(self.path)):
+                return
+            path = urlparse(self.path).path
+            if path.endswith('/positions_2/history'):
+                state.count('topvisor_history')
+                self._delay()
+                self._reply(_positions_result(body, state.keywords))
+            elif path.endswith('/positions_2/summary'):
+                state.count('topvisor_summary')
+                self._delay()
+                self._reply(_summary_result(body))
+            else:
+                self._reply({'errors': [{'message': f'unknown path {path}'}]}, status=404)
+
+    return FakeAPIHandler
+
+
+def start_fake_api(state, host='127.0.0.1', port=0):
+    """Запускает сервер в фоновом потоке; возвращает (server, базовый URL)."""
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-api", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
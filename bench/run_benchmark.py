@@ -0,0 +1,291 @@
+# bench/run_benchmark.py
+"""
+Офлайн-бенчмарк загрузчиков: API Метрики и Топвизора подменяются локальным сервером (fake_api.py),
+данные пишутся во временный Postgres. Каждый этап запускается в отдельном процессе на пустых таблицах,
+чтобы пиковый RSS и кэши справочников относились только к нему.
+
+Примеры:
+    python bench/run_benchmark.py --days 30 --keywords 2000 --latency-ms 50
+    python bench/run_benchmark.py --postgres env --compare bench/results/20240101-120000.json
+
+Postgres: local - временный кластер через initdb/pg_ctl, docker - контейнер postgres:15,
+env - уже настроенная БД из DB_* (ее таблицы загрузчика будут очищены!), auto - local или docker.
+Результаты сохраняются в bench/results/<время>.json (в git не попадают: цифры зависят от машины);
+с --compare этапы сравниваются с одним из прошлых прогонов на той же машине, и при падении rows/sec
+больше чем на --tolerance процесс завершается с кодом 1.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from urllib.request import urlopen
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+# Этап -> (функция main.py, таблицы, строки которых считаются результатом этапа)
+STAGES = {
+    'traffic_sources': ('fetch_and_store_all_traffic_sources', ('metrika_traffic_sources',)),
+    'behavior': ('fetch_and_store_behavior_data', ('metrika_behavior',)),
+    'conversions': ('fetch_and_store_conversions_data', ('metrika_conversions',)),
+    'positions': ('fetch_and_store_topvisor_positions', ('topvisor_positions',)),
+    'visibility': ('fetch_and_store_topvisor_visibility', ('topvisor_visibility',)),
+    'historical_load': ('run_historical_load', ('metrika_traffic_sources', 'metrika_behavior', 'metrika_conversions',
+                                                'topvisor_positions', 'topvisor_visibility')),
+    'logs_traffic_sources': ('fetch_and_store_all_traffic_sources', ('metrika_traffic_sources',)),
+}
+# Переменные окружения, которые этап задает поверх общих
+STAGE_ENV = {
+    'logs_traffic_sources': {'METRIKA_SOURCE': 'logs'},
+}
+# Таблицы, очищаемые перед каждым этапом
+RESET_TABLES = ('metrika_traffic_sources', 'metrika_behavior', 'metrika_conversions', 'topvisor_positions',
+                'topvisor_visibility', 'etl_load_state', 'dim_keywords', 'dim_urls', 'dim_sources', 'dim_goals',
+                'rollup_traffic_sources', 'rollup_conversions', 'rollup_positions', 'metrika_logs_visits')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_postgres(db_env, timeout=60):
+    import psycopg2
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            psycopg2.connect(host=db_env['DB_HOST'], port=db_env['DB_PORT'], dbname=db_env['DB_NAME'],
+                             user=db_env['DB_USER'], password=db_env['DB_PASSWORD']).close()
+            return
+        except psycopg2.OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+class LocalPostgres:
+    """Временный кластер Postgres в каталоге tmp (initdb + pg_ctl), удаляется после бенчмарка."""
+
+    def __init__(self):
+        self.data_dir = tempfile.mkdtemp(prefix='bench-pg-')
+        self.port = _free_port()
+
+    def start(self):
+        subprocess.run(['initdb', '-D', self.data_dir, '-U', 'bench', '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(['pg_ctl', '-D', self.data_dir, '-w', '-l', os.path.join(self.data_dir, 'server.log'),
+                        '-o', f"-p {self.port} -k {self.data_dir} -c listen_addresses=127.0.0.1 -c fsync=off",
+                        'start'], check=True, stdout=subprocess.DEVNULL)
+        return {'DB_HOST': '127.0.0.1', 'DB_PORT': str(self.port), 'DB_NAME': 'postgres',
+                'DB_USER': 'bench', 'DB_PASSWORD': ''}
+
+    def stop(self):
+        subprocess.run(['pg_ctl', '-D', self.data_dir, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+class DockerPostgres:
+    """Одноразовый контейнер postgres:15 (той же версии, что в Docker-compose.yml)."""
+
+    def __init__(self):
+        self.container_id = None
+        self.port = _free_port()
+
+    def start(self):
+        self.container_id = subprocess.run(
+            ['docker', 'run', '--rm', '-d', '-p', f"127.0.0.1:{self.port}:5432", '-e', 'POSTGRES_USER=bench',
+             '-e', 'POSTGRES_PASSWORD=bench', '-e', 'POSTGRES_DB=bench', 'postgres:15', '-c', 'fsync=off'],
+            check=True, capture_output=True, text=True).stdout.strip()
+        return {'DB_HOST': '127.0.0.1', 'DB_PORT': str(self.port), 'DB_NAME': 'bench',
+                'DB_USER': 'bench', 'DB_PASSWORD': 'bench'}
+
+    def stop(self):
+        if self.container_id:
+            subprocess.run(['docker', 'stop', self.container_id], stdout=subprocess.DEVNULL)
+
+
+class ExistingPostgres:
+    """БД из переменных окружения DB_*."""
+
+    def start(self):
+        return {name: os.environ.get(name, '') for name in ('DB_HOST', 'DB_PORT', 'DB_NAME', 'DB_USER', 'DB_PASSWORD')}
+
+    def stop(self):
+        pass
+
+
+def make_postgres(kind):
+    if kind == 'auto':
+        kind = 'local' if shutil.which('initdb') and shutil.which('pg_ctl') else 'docker'
+    return {'local': LocalPostgres, 'docker': DockerPostgres, 'env': ExistingPostgres}[kind]()
+
+
+def _server_stats(api_url):
+    with urlopen(f"{api_url}/__stats") as response:
+        return json.load(response)
+
+
+def run_stage(stage, days, result_file):
+    """Выполняется в дочернем процессе: окружение уже указывает на фейковый API и временную БД."""
+    os.environ.update(STAGE_ENV.get(stage, {}))
+    sys.path.insert(0, REPO_DIR)
+    import db_manager
+    import main
+
+    main.prepare_database()
+    with db_manager.pooled_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"TRUNCATE {', '.join(RESET_TABLES)} RESTART IDENTITY")
+        conn.commit()
+
+    function_name, tables = STAGES[stage]
+    date_to = date.today() - timedelta(days=1)
+    date_from = date.today() - timedelta(days=days)
+    api_url = os.environ['TOPVISOR_API_URL']
+
+    requests_before = sum(_server_stats(api_url).values())
+    started = time.perf_counter()
+    if stage == 'historical_load':
+        main.run_historical_load(days)
+    else:
+        getattr(main, function_name)(date_from.strftime('%Y-%m-%d'), date_to.strftime('%Y-%m-%d'))
+    wall_seconds = time.perf_counter() - started
+    requests_count = sum(_server_stats(api_url).values()) - requests_before
+
+    with db_manager.pooled_connection() as conn:
+        with conn.cursor() as cur:
+            rows = 0
+            for table_name in tables:
+                cur.execute(f"SELECT count(*) FROM {table_name}")
+                rows += cur.fetchone()[0]
+    db_manager.close_connection_pool()
+
+    # ru_maxrss в Linux - килобайты, в macOS - байты
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+    with open(result_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            'wall_seconds': round(wall_seconds, 3),
+            'rows': rows,
+            'requests': requests_count,
+            'rows_per_sec': round(rows / wall_seconds, 1) if wall_seconds else None,
+            'requests_per_sec': round(requests_count / wall_seconds, 2) if wall_seconds else None,
+            'peak_rss_mb': round(peak_rss_mb, 1),
+        }, f)
+
+
+def compare(results, baseline_path, tolerance):
+    """Печатает сравнение с базовым прогоном; возвращает список этапов с регрессией rows/sec."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    print(f"\nComparison with {baseline_path}:")
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if not previous or not previous.get('rows_per_sec') or not current.get('rows_per_sec'):
+            print(f"  {stage:16} no baseline")
+            continue
+        change = current['rows_per_sec'] / previous['rows_per_sec'] - 1
+        rss_change = current['peak_rss_mb'] - previous['peak_rss_mb']
+        marker = ''
+        if change < -tolerance:
+            marker = '  <-- REGRESSION'
+            regressions.append(stage)
+        print(f"  {stage:16} rows/sec {previous['rows_per_sec']:>10} -> {current['rows_per_sec']:>10} "
+              f"({change:+.1%}), peak RSS {rss_change:+.1f} MB{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the Metrika/Topvisor loaders.")
+    parser.add_argument('--stages', default=','.join(STAGES), help="comma-separated stages to run")
+    parser.add_argument('--days', type=int, default=14, help="days of data per stage")
+    parser.add_argument('--metrika-rows-per-day', type=int, default=200)
+    parser.add_argument('--keywords', type=int, default=1000, help="Topvisor keywords in the project")
+    parser.add_argument('--regions', default='1,2', help="Topvisor region indexes")
+    parser.add_argument('--searchers', default='2,3', help="Topvisor searcher ids")
+    parser.add_argument('--latency-ms', type=int, default=0, help="artificial latency of every API response")
+    parser.add_argument('--postgres', choices=('auto', 'local', 'docker', 'env'), default='auto')
+    parser.add_argument('--compare', help="baseline results JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed rows/sec drop vs baseline")
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args.stage, args.days, args.result_file)
+        return 0
+
+    sys.path.insert(0, BENCH_DIR)
+    from fake_api import FakeAPIState, start_fake_api
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {unknown}")
+
+    state = FakeAPIState(metrika_rows_per_day=args.metrika_rows_per_day, keywords=args.keywords,
+                         latency_ms=args.latency_ms)
+    server, api_url = start_fake_api(state)
+    postgres = make_postgres(args.postgres)
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    results = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                     capture_output=True, text=True).stdout.strip(),
+        'params': {key: value for key, value in vars(args).items()
+                   if key not in ('stage', 'result_file', 'compare', 'tolerance')},
+        'stages': {},
+    }
+    try:
+        db_env = postgres.start()
+        _wait_for_postgres(db_env)
+        env = dict(os.environ, **db_env, **{
+            'METRIKA_TOKEN': 'bench', 'METRIKA_COUNTER_ID': '1', 'METRIKA_API_URL': f"{api_url}/stat/v1/data",
+            'TOPVISOR_API_KEY': 'bench', 'TOPVISOR_USER_ID': '1', 'TOPVISOR_PROJECT_ID': '1',
+            'TOPVISOR_API_URL': api_url, 'TOPVISOR_REGION_INDEXES': args.regions,
+            'TOPVISOR_SEARCHERS': args.searchers, 'HTTP_CACHE_ENABLED': 'false',
+            'HISTORICAL_LOAD_DAYS': str(args.days), 'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+            'LOG_FILE': os.path.join(work_dir, 'bench.log'),
+            'METRIKA_LOGS_API_URL': f"{api_url}/management/v1/counter", 'METRIKA_LOGS_POLL_SECONDS': '0.2',
+        })
+        for stage in stages:
+            result_file = os.path.join(work_dir, f"{stage}.json")
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--stage', stage, '--days', str(args.days),
+                 '--result-file', result_file], env=env, cwd=work_dir)
+            if completed.returncode != 0 or not os.path.exists(result_file):
+                print(f"{stage:16} FAILED (exit code {completed.returncode}), see {env['LOG_FILE']}")
+                continue
+            with open(result_file, encoding='utf-8') as f:
+                results['stages'][stage] = json.load(f)
+            stage_result = results['stages'][stage]
+            print(f"{stage:16} {stage_result['rows']:>9} rows {stage_result['wall_seconds']:>8.2f}s "
+                  f"{stage_result['rows_per_sec']:>10} rows/s {stage_result['requests']:>6} req "
+                  f"{stage_result['requests_per_sec']:>8} req/s  peak RSS {stage_result['peak_rss_mb']} MB")
+    finally:
+        postgres.stop()
+        server.shutdown()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(results_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {results_path}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+# concurrency.py
+import collections
+import contextvars
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def ordered_map(func, items, max_workers, max_in_flight=None, thread_name_prefix="worker"):
+    """
+    Аналог ThreadPoolExecutor.map: выполняет func(item) в пуле потоков и отдает результаты
+    в порядке items, но держит в работе не больше max_in_flight задач одновременно,
+    чтобы готовые, но еще не прочитанные результаты не копились в памяти.
+    Исключение из func пробрасывается при чтении соответствующего результата; оставшиеся задачи отменяются.
+    Задачи выполняются в копии контекста вызывающего потока (contextvars), например с его набором данных для метрик.
+    """
+    max_in_flight = max_in_flight or max_workers * 2
+    items = iter(items)
+    context = contextvars.copy_context()
+
+    def submit(executor, item):
+        return executor.submit(context.copy().run, func, item)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix) as executor:
+        pending = collections.deque(submit(executor, item) for item in itertools.islice(items, max_in_flight))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for item in itertools.islice(items, 1):
+                    pending.append(submit(executor, item))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
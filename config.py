@@ -1,4 +1,5 @@
 # config.py
+import json
 import os
 from dotenv import load_dotenv
 
@@ -9,6 +10,23 @@ load_dotenv()
 METRIKA_TOKEN = os.getenv("METRIKA_TOKEN")
 METRIKA_COUNTER_ID = os.getenv("METRIKA_COUNTER_ID")
 METRIKA_API_URL = os.getenv("METRIKA_API_URL", "https://api-metrika.yandex.net/stat/v1/data")
+# Общий лимит частоты запросов к API Метрики и число параллельных потоков (API допускает 3 одновременных запроса)
+METRIKA_RATE_LIMIT_RPS = float(os.getenv("METRIKA_RATE_LIMIT_RPS", "5"))
+METRIKA_RATE_LIMIT_BURST = int(os.getenv("METRIKA_RATE_LIMIT_BURST", "3"))
+# Верхняя граница, до которой лимит сам поднимается, пока API отвечает без троттлинга
+METRIKA_RATE_LIMIT_MAX_RPS = float(os.getenv("METRIKA_RATE_LIMIT_MAX_RPS", "10"))
+METRIKA_MAX_WORKERS = int(os.getenv("METRIKA_MAX_WORKERS", "3"))
+# Источник данных Метрики: 'reporting' - API отчетов (stat/v1/data), 'logs' - выгрузка визитов через Logs API
+# (metrika_logs_api.py) и расчет агрегатов в БД; без сэмплирования и ограничений на число строк отчета
+METRIKA_SOURCE = os.getenv("METRIKA_SOURCE", "reporting").lower()
+METRIKA_LOGS_API_URL = os.getenv("METRIKA_LOGS_API_URL", "https://api-metrika.yandex.net/management/v1/counter")
+# Как часто проверять готовность выгрузки и сколько ждать ее максимум, секунды
+METRIKA_LOGS_POLL_SECONDS = float(os.getenv("METRIKA_LOGS_POLL_SECONDS", "10"))
+METRIKA_LOGS_MAX_WAIT_SECONDS = float(os.getenv("METRIKA_LOGS_MAX_WAIT_SECONDS", "3600"))
+# Выгруженные визиты за период (или за охватывающий его период) используются всеми тремя наборами данных,
+# пока им не больше METRIKA_LOGS_REUSE_SECONDS; визиты старше METRIKA_LOGS_STAGING_TTL_HOURS удаляются из промежуточной таблицы
+METRIKA_LOGS_REUSE_SECONDS = float(os.getenv("METRIKA_LOGS_REUSE_SECONDS", "3600"))
+METRIKA_LOGS_STAGING_TTL_HOURS = int(os.getenv("METRIKA_LOGS_STAGING_TTL_HOURS", "24"))
 
 # Topvisor
 TOPVISOR_API_KEY = os.getenv("TOPVISOR_API_KEY")
@@ -21,6 +39,28 @@ _searchers_str = os.getenv("TOPVISOR_SEARCHERS", "")
 # ИСПРАВЛЕНИЕ: Добавлен .strip() для удаления случайных пробелов
 TOPVISOR_SEARCHERS = [int(s.strip()) for s in _searchers_str.split(',') if s.strip()] if _searchers_str else []
 TOPVISOR_API_URL = os.getenv("TOPVISOR_API_URL", "https://api.topvisor.com/v2/json/get")
+# Общий лимит частоты запросов к API Топвизора (запросов в секунду и допустимый всплеск),
+# число параллельных потоков и повторы для отдельной ячейки (день x регион x ПС)
+TOPVISOR_RATE_LIMIT_RPS = float(os.getenv("TOPVISOR_RATE_LIMIT_RPS", "4"))
+TOPVISOR_RATE_LIMIT_BURST = int(os.getenv("TOPVISOR_RATE_LIMIT_BURST", "4"))
+TOPVISOR_RATE_LIMIT_MAX_RPS = float(os.getenv("TOPVISOR_RATE_LIMIT_MAX_RPS", "8"))
+TOPVISOR_MAX_WORKERS = int(os.getenv("TOPVISOR_MAX_WORKERS", "4"))
+TOPVISOR_CELL_RETRIES = int(os.getenv("TOPVISOR_CELL_RETRIES", "3"))
+TOPVISOR_RETRY_BACKOFF_SECONDS = float(os.getenv("TOPVISOR_RETRY_BACKOFF_SECONDS", "2"))
+
+# Сколько дней видимости запрашивать одним вызовом positions_2/summary (1 - по запросу на каждый день)
+TOPVISOR_VISIBILITY_WINDOW_DAYS = int(os.getenv("TOPVISOR_VISIBILITY_WINDOW_DAYS", "31"))
+# Размер страницы (ключевых слов) для positions_2/history
+TOPVISOR_POSITIONS_PAGE_SIZE = int(os.getenv("TOPVISOR_POSITIONS_PAGE_SIZE", "1000"))
+
+# Повторы HTTP-запросов к обоим API (http_client.send_with_retries) при 429/5xx, таймаутах и обрывах соединения:
+# пауза из Retry-After (не больше HTTP_RETRY_AFTER_MAX_SECONDS), иначе экспоненциальная со случайным джиттером
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE_SECONDS = float(os.getenv("HTTP_BACKOFF_BASE_SECONDS", "1"))
+HTTP_BACKOFF_MAX_SECONDS = float(os.getenv("HTTP_BACKOFF_MAX_SECONDS", "60"))
+HTTP_RETRY_AFTER_MAX_SECONDS = float(os.getenv("HTTP_RETRY_AFTER_MAX_SECONDS", "300"))
+# Подстройка лимитов частоты: +HTTP_RATE_INCREASE_RPS после каждого успешного ответа, x0.5 при троттлинге
+HTTP_RATE_INCREASE_RPS = float(os.getenv("HTTP_RATE_INCREASE_RPS", "0.05"))
 
 # PostgreSQL Database
 DB_HOST = os.getenv("DB_HOST")
@@ -28,6 +68,99 @@ DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
+# Политики записи при конфликте ключа по таблицам: ignore / upsert / upsert_if_changed.
+# Метрика пересчитывает последние дни задним числом, поэтому ее таблицы по умолчанию обновляются при изменениях.
+# Переопределение: DB_WRITE_POLICIES="metrika_behavior=upsert,topvisor_positions=upsert_if_changed"
+DB_WRITE_POLICIES = {
+    "metrika_traffic_sources": "upsert_if_changed",
+    "metrika_conversions": "upsert_if_changed",
+    "metrika_behavior": "upsert_if_changed",
+    "topvisor_positions": "ignore",
+    "topvisor_visibility": "ignore",
+}
+_write_policies_str = os.getenv("DB_WRITE_POLICIES", "")
+DB_WRITE_POLICIES.update(
+    (table.strip(), policy.strip())
+    for table, policy in (item.split('=', 1) for item in _write_policies_str.split(',') if '=' in item)
+)
+# Партиционирование фактовых таблиц по месяцам report_date (действует при создании таблиц с нуля; по умолчанию
+# выключено, например: metrika_traffic_sources,metrika_conversions,topvisor_positions),
+# сколько месяцев партиций создавать заранее и срок хранения (0 - хранить все; detach или drop старых партиций)
+_partitioned_tables_str = os.getenv("DB_PARTITIONED_TABLES", "")
+DB_PARTITIONED_TABLES = {t.strip() for t in _partitioned_tables_str.split(',') if t.strip()}
+DB_PARTITION_PREMAKE_MONTHS = int(os.getenv("DB_PARTITION_PREMAKE_MONTHS", "2"))
+DB_PARTITION_RETENTION_MONTHS = int(os.getenv("DB_PARTITION_RETENTION_MONTHS", "0"))
+DB_PARTITION_RETENTION_ACTION = os.getenv("DB_PARTITION_RETENTION_ACTION", "detach")
+# Пул соединений: минимальное/максимальное число соединений, ожидание свободного соединения
+# и порог простоя, после которого соединение проверяется запросом SELECT 1 перед выдачей.
+# Максимум по умолчанию считается из числа потоков загрузки (DB_POOL_REQUIRED_SIZE ниже)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "0"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+DB_POOL_HEALTHCHECK_IDLE_SECONDS = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE_SECONDS", "30"))
+# Начиная с этого числа строк bulk_insert_data пишет через COPY в staging-таблицу вместо execute_values
+DB_COPY_THRESHOLD_ROWS = int(os.getenv("DB_COPY_THRESHOLD_ROWS", "500"))
+# Потоковая загрузка: размер пачки, сбрасываемой в БД, и сколько пачек может ждать записи
+DB_INSERT_BATCH_SIZE = int(os.getenv("DB_INSERT_BATCH_SIZE", "5000"))
+DB_STREAM_QUEUE_BATCHES = int(os.getenv("DB_STREAM_QUEUE_BATCHES", "2"))
+# Справочники (dimensions.py): сколько ключей держать в памяти процесса, прежде чем сбросить кэш
+DIM_CACHE_MAX_ENTRIES = int(os.getenv("DIM_CACHE_MAX_ENTRIES", "200000"))
+
+# Кэш ответов API на диске (SQLite): путь, предельный размер и политики TTL по источникам.
+# Политика: (через сколько дней данные считаются неизменными, но не раньше DAILY_GAP_LOOKBACK_DAYS;
+# TTL в секундах для более свежих дат)
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+HTTP_CACHE_PATH = os.getenv("HTTP_CACHE_PATH", "cache/http_cache.sqlite3")
+HTTP_CACHE_MAX_BYTES = int(os.getenv("HTTP_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+HTTP_CACHE_POLICIES = {
+    "metrika": (int(os.getenv("HTTP_CACHE_METRIKA_IMMUTABLE_AFTER_DAYS", "3")),
+                int(os.getenv("HTTP_CACHE_METRIKA_RECENT_TTL_SECONDS", "3600"))),
+    "topvisor": (int(os.getenv("HTTP_CACHE_TOPVISOR_IMMUTABLE_AFTER_DAYS", "2")),
+                 int(os.getenv("HTTP_CACHE_TOPVISOR_RECENT_TTL_SECONDS", "3600"))),
+}
+
+# Выгрузка таблиц в Parquet (export_parquet.py): каталог, размер пачки строк серверного курсора и сжатие
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "50000"))
+EXPORT_PARQUET_COMPRESSION = os.getenv("EXPORT_PARQUET_COMPRESSION", "zstd")
+
+# Инкрементальная загрузка: глубина исторической догрузки при старте и окно поиска пропусков в ежедневной задаче
+HISTORICAL_LOAD_DAYS = int(os.getenv("HISTORICAL_LOAD_DAYS", "60"))
+DAILY_GAP_LOOKBACK_DAYS = int(os.getenv("DAILY_GAP_LOOKBACK_DAYS", "7"))
+# Сколько последних дней Метрики ежедневная задача перечитывает заново, чтобы поздние пересчеты попали в БД
+METRIKA_REVISION_DAYS = int(os.getenv("METRIKA_REVISION_DAYS", "3"))
+
+# Метрики загрузок для Prometheus (etl_metrics.py); METRICS_PORT=0 выключает эндпоинт
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Несколько сайтов в одном процессе (tenants.py): JSON-файл со списком счетчиков/проектов.
+# Без файла используется один тенант DEFAULT_TENANT_ID из переменных METRIKA_*/TOPVISOR_* выше.
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+DEFAULT_TENANT_ID = os.getenv("DEFAULT_TENANT_ID", "default")
+
+# Граф задач загрузки (job_graph.py): наборы данных всех тенантов выполняются параллельно,
+# не больше JOB_MAX_WORKERS одновременно (лимиты частоты API при этом общие для всех)
+JOB_MAX_WORKERS = int(os.getenv("JOB_MAX_WORKERS", "4"))
+# Таймаут одной попытки задачи, секунды (0 - без ограничения)
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "7200"))
+# Повторы задачи после ошибки и пауза перед повтором; повтор догружает только оставшиеся даты
+JOB_RETRIES = int(os.getenv("JOB_RETRIES", "1"))
+JOB_RETRY_DELAY_SECONDS = float(os.getenv("JOB_RETRY_DELAY_SECONDS", "60"))
+
+# Историческая догрузка (backfill.py): период режется на окна по BACKFILL_WINDOW_DAYS дней на набор данных,
+# до BACKFILL_MAX_WORKERS окон загружаются параллельно; каждое загруженное окно отмечается в etl_load_state
+BACKFILL_WINDOW_DAYS = int(os.getenv("BACKFILL_WINDOW_DAYS", "31"))
+BACKFILL_MAX_WORKERS = int(os.getenv("BACKFILL_MAX_WORKERS", "4"))
+# Историческая догрузка при старте сервиса идет в фоне, не задерживая планировщик: начинается через
+# HISTORICAL_LOAD_DELAY_SECONDS, грузит до HISTORICAL_LOAD_MAX_WORKERS окон одновременно и уступает ежедневной задаче
+HISTORICAL_LOAD_DELAY_SECONDS = float(os.getenv("HISTORICAL_LOAD_DELAY_SECONDS", "30"))
+HISTORICAL_LOAD_MAX_WORKERS = int(os.getenv("HISTORICAL_LOAD_MAX_WORKERS", "1"))
+
+# Задаче графа и окну догрузки нужны два соединения сразу (справочники в потоке разбора и поток записи
+# bulk_insert_stream); задачи идут вместе с догрузкой, еще одно соединение - основному потоку
+DB_POOL_REQUIRED_SIZE = 2 * (JOB_MAX_WORKERS + max(BACKFILL_MAX_WORKERS, HISTORICAL_LOAD_MAX_WORKERS)) + 1
+DB_POOL_MAX_SIZE = DB_POOL_MAX_SIZE or DB_POOL_REQUIRED_SIZE
 
 # Logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -60,21 +193,63 @@ METRIKA_GOALS_MAP = {
 }
 METRIKA_GOAL_IDS_FOR_REQUEST = list(METRIKA_GOALS_MAP.keys())
 
+# Правила категоризации источников трафика Метрики (traffic_classifier.py) для всех загрузчиков.
+# Правила проверяются по порядку, срабатывает первое: source_type - подстроки типа источника
+# (ym:s:lastTrafficSource), source_engine - подстроки системы/детализации (ym:s:lastSourceEngine);
+# пустой список совпадает с любым значением. В engine можно подставить исходный тип: "{source_type}".
+# Свои правила можно задать JSON-файлом того же формата в TRAFFIC_SOURCE_RULES_FILE. Категории хранятся
+# в dim_sources и при старте пересчитываются по текущим правилам вместе с агрегатами; факты не меняются.
+TRAFFIC_SOURCE_RULES = [
+    {"source_type": ["organic", "search"], "source_engine": ["yandex", "яндекс"],
+     "group": "Переходы из поисковых систем", "engine": "Яндекс"},
+    {"source_type": ["organic", "search"], "source_engine": ["google"],
+     "group": "Переходы из поисковых систем", "engine": "Google"},
+    {"source_type": ["organic", "search"], "source_engine": [],
+     "group": "Переходы из поисковых систем", "engine": "Другие поисковые системы"},
+    {"source_type": ["direct"], "source_engine": [], "group": "Прямые заходы", "engine": "Прямые заходы"},
+    {"source_type": ["social"], "source_engine": [],
+     "group": "Переходы из социальных сетей", "engine": "Социальные сети"},
+    {"source_type": ["link"], "source_engine": [],
+     "group": "Переходы по ссылкам на сайтах", "engine": "Переходы по ссылкам на сайтах"},
+    {"source_type": ["ad"], "source_engine": [], "group": "Переходы по рекламе", "engine": "Переходы по рекламе"},
+    {"source_type": [], "source_engine": [], "group": "Прочие источники", "engine": "{source_type}"},
+]
+TRAFFIC_SOURCE_RULES_FILE = os.getenv("TRAFFIC_SOURCE_RULES_FILE")
+if TRAFFIC_SOURCE_RULES_FILE:
+    with open(TRAFFIC_SOURCE_RULES_FILE, encoding="utf-8") as rules_file:
+        TRAFFIC_SOURCE_RULES = json.load(rules_file)
+# Сколько различных пар (тип источника, система) помнит кэш классификатора
+TRAFFIC_CLASSIFIER_CACHE_SIZE = int(os.getenv("TRAFFIC_CLASSIFIER_CACHE_SIZE", "4096"))
+
 
 def check_config():
     required_vars = {
-        "METRIKA_TOKEN": METRIKA_TOKEN,
-        "METRIKA_COUNTER_ID": METRIKA_COUNTER_ID,
         "DB_HOST": DB_HOST,
         "DB_NAME": DB_NAME,
         "DB_USER": DB_USER,
         "DB_PASSWORD": DB_PASSWORD,
     }
-    if TOPVISOR_API_KEY:
+    if TENANTS_FILE:
+        # Счетчики и проекты описаны в файле тенантов, он проверяется при загрузке (tenants.load_tenants)
+        if not os.path.exists(TENANTS_FILE):
+            raise EnvironmentError(f"Tenants file not found: {TENANTS_FILE}")
+    else:
+        required_vars.update({
+            "METRIKA_TOKEN": METRIKA_TOKEN,
+            "METRIKA_COUNTER_ID": METRIKA_COUNTER_ID,
+        })
+    if TOPVISOR_API_KEY and not TENANTS_FILE:
         required_vars.update({
             "TOPVISOR_USER_ID": TOPVISOR_USER_ID,
             "TOPVISOR_PROJECT_ID": TOPVISOR_PROJECT_ID
         })
+    if METRIKA_SOURCE not in ('reporting', 'logs'):
+        raise EnvironmentError(f"METRIKA_SOURCE must be 'reporting' or 'logs', got '{METRIKA_SOURCE}'")
+    if DB_POOL_MAX_SIZE < DB_POOL_REQUIRED_SIZE:
+        raise EnvironmentError(
+            f"DB_POOL_MAX_SIZE={DB_POOL_MAX_SIZE} is too small for JOB_MAX_WORKERS={JOB_MAX_WORKERS} and "
+            f"BACKFILL_MAX_WORKERS={BACKFILL_MAX_WORKERS} (HISTORICAL_LOAD_MAX_WORKERS={HISTORICAL_LOAD_MAX_WORKERS}): at least {DB_POOL_REQUIRED_SIZE} connections are needed "
+            f"(unset it to use the default).")
     missing_vars = [key for key, value in required_vars.items() if value is None]
     if missing_vars:
         raise EnvironmentError(f"Missing required environment variables: {', '.join(missing_vars)}")
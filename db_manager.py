@@ -2,10 +2,23 @@
 import psycopg2
 # Удален неправильный импорт: from pip._internal import commands
 from psycopg2 import sql
+from psycopg2 import extensions as pg_extensions
 from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
+from contextlib import contextmanager
+import collections
+import io
+import re
+import itertools
 import logging
+import queue
+import threading
+import time
 import config  # Импортируем наш модуль config
+import contextvars
+import etl_metrics
 import traceback
+from datetime import date, datetime
 
 logger = logging.getLogger(__name__)
 
@@ -28,67 +41,357 @@ def get_db_connection():
         raise
 
 
+class ConnectionPool:
+    """
+    Потокобезопасный пул долгоживущих соединений с PostgreSQL.
+    Соединение, простоявшее дольше healthcheck_idle_seconds, перед выдачей проверяется запросом SELECT 1;
+    "протухшие" соединения закрываются и заменяются новыми.
+    """
+
+    def __init__(self, minconn, maxconn, connect=get_db_connection, timeout=30, healthcheck_idle_seconds=30):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: min={minconn}, max={maxconn}")
+        self._maxconn = maxconn
+        self._connect = connect
+        self._timeout = timeout
+        self._healthcheck_idle_seconds = healthcheck_idle_seconds
+        self._idle = collections.deque()  # (conn, время возврата в пул)
+        self._opened = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._opened += 1
+
+    def getconn(self):
+        """Выдает соединение из пула, ожидая освобождения не дольше timeout секунд."""
+        deadline = time.monotonic() + self._timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._opened >= self._maxconn and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolError(f"Timed out after {self._timeout}s waiting for a free database connection.")
+                    self._cond.wait(remaining)
+                if self._closed:
+                    raise PoolError("Connection pool is closed.")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()  # LIFO: берем самое "теплое" соединение
+                else:
+                    conn, returned_at = None, None
+                    self._opened += 1
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+
+            if self._is_healthy(conn, returned_at):
+                return conn
+            logger.warning("Discarding stale PostgreSQL connection from the pool and reconnecting.")
+            self._discard(conn)
+
+    def putconn(self, conn, close=False):
+        """Возвращает соединение в пул. Незавершенная транзакция откатывается, сломанное соединение закрывается."""
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == pg_extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != pg_extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        else:
+            close = True
+
+        with self._cond:
+            if not close and not self._closed:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+        self._discard(conn)
+
+    def closeall(self):
+        """Закрывает все свободные соединения; выданные закроются при возврате."""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self._healthcheck_idle_seconds:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _discard(self, conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        except psycopg2.Error:
+            pass
+        self._forget()
+
+    def _forget(self):
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """Возвращает общий для всех потоков пул соединений, создавая его при первом обращении."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    minconn=config.DB_POOL_MIN_SIZE,
+                    maxconn=config.DB_POOL_MAX_SIZE,
+                    timeout=config.DB_POOL_TIMEOUT_SECONDS,
+                    healthcheck_idle_seconds=config.DB_POOL_HEALTHCHECK_IDLE_SECONDS
+                )
+                logger.info(
+                    f"PostgreSQL connection pool created (min={config.DB_POOL_MIN_SIZE}, max={config.DB_POOL_MAX_SIZE}).")
+    return _pool
+
+
+def close_connection_pool():
+    """Закрывает общий пул соединений (например, при остановке сервиса)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def pooled_connection():
+    """
+    Контекстный менеджер: берет соединение из пула и возвращает его обратно.
+    Соединение, на котором произошла ошибка связи, в пул не возвращается.
+    """
+    pool = get_connection_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+
+# Таблицы, которые можно хранить партиционированными по месяцам report_date (config.DB_PARTITIONED_TABLES)
+PARTITIONABLE_TABLES = ("metrika_traffic_sources", "metrika_conversions", "topvisor_positions")
+
+_PARTITION_NAME_RE = re.compile(r'_p(\d{4})_(\d{2})$')
+_known_partitions = set()
+# Таблицы из config.DB_PARTITIONED_TABLES, которые в БД остались обычными (созданы до включения партиций)
+_unpartitioned_tables = set()
+_partitions_lock = threading.Lock()
+
+
+def _is_partitioning_enabled(table_name):
+    return (table_name in PARTITIONABLE_TABLES and table_name in config.DB_PARTITIONED_TABLES
+            and table_name not in _unpartitioned_tables)
+
+
+def _partitioning_ddl(table_name):
+    """
+    Части CREATE TABLE, зависящие от партиционирования: у партиционированной таблицы первичный ключ
+    обязан включать ключ партиционирования, поэтому он становится (id, report_date).
+    """
+    if _is_partitioning_enabled(table_name):
+        return {'id_column': 'id SERIAL', 'primary_key': ',\n            PRIMARY KEY (id, report_date)',
+                'partitioning': ' PARTITION BY RANGE (report_date)'}
+    return {'id_column': 'id SERIAL PRIMARY KEY', 'primary_key': '', 'partitioning': ''}
+
+
+def _to_date(value):
+    return value if isinstance(value, date) else datetime.strptime(str(value), '%Y-%m-%d').date()
+
+
+def _add_months(month_start, months):
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def _partition_name(table_name, month_start):
+    return f"{table_name}_p{month_start:%Y_%m}"
+
+
+def _is_partitioned(cur, table_name):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table_name,))
+    row = cur.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def ensure_partitions(table_name, date_from, date_to):
+    """
+    Создает недостающие месячные партиции таблицы на период [date_from, date_to].
+    Для таблиц без партиционирования ничего не делает. Уже созданные партиции запоминаются в процессе,
+    поэтому повторные вызовы не ходят в БД.
+    """
+    if not _is_partitioning_enabled(table_name):
+        return True
+    month = _to_date(date_from).replace(day=1)
+    last_month = _to_date(date_to).replace(day=1)
+    months = []
+    while month <= last_month:
+        if (table_name, month) not in _known_partitions:
+            months.append(month)
+        month = _add_months(month, 1)
+    if not months:
+        return True
+
+    try:
+        with _partitions_lock, pooled_connection() as conn:
+            with conn.cursor() as cur:
+                if not _is_partitioned(cur, table_name):
+                    logger.warning(f"{table_name} is configured as partitioned but exists as a regular table; "
+                                   f"convert it manually to enable partitions.")
+                    conn.rollback()
+                    _unpartitioned_tables.add(table_name)
+                    return True
+                for month_start in months:
+                    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+                        sql.Identifier(_partition_name(table_name, month_start)), sql.Identifier(table_name)
+                    ), (month_start, _add_months(month_start, 1)))
+            conn.commit()
+        _known_partitions.update((table_name, month_start) for month_start in months)
+        logger.info(f"Partitions of {table_name} ensured for {months[0]:%Y-%m} - {months[-1]:%Y-%m}.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error creating partitions for {table_name}: {repr(error)}")
+        return False
+
+
+def apply_partition_retention():
+    """
+    Отсоединяет (и при DB_PARTITION_RETENTION_ACTION='drop' удаляет) месячные партиции старше
+    DB_PARTITION_RETENTION_MONTHS месяцев. Удаление партиции целиком не требует DELETE и VACUUM.
+    """
+    if config.DB_PARTITION_RETENTION_MONTHS <= 0:
+        return
+    cutoff_month = _add_months(date.today().replace(day=1), -config.DB_PARTITION_RETENTION_MONTHS)
+    for table_name in PARTITIONABLE_TABLES:
+        if not _is_partitioning_enabled(table_name):
+            continue
+        try:
+            with _partitions_lock, pooled_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                        "WHERE i.inhparent = to_regclass(%s)", (table_name,)
+                    )
+                    expired = []
+                    for (partition_name,) in cur.fetchall():
+                        match = _PARTITION_NAME_RE.search(partition_name)
+                        if match and date(int(match.group(1)), int(match.group(2)), 1) < cutoff_month:
+                            expired.append(partition_name)
+                    for partition_name in sorted(expired):
+                        cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(
+                            sql.Identifier(table_name), sql.Identifier(partition_name)))
+                        if config.DB_PARTITION_RETENTION_ACTION == 'drop':
+                            cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(partition_name)))
+                conn.commit()
+            if expired:
+                logger.info(f"Retention: {config.DB_PARTITION_RETENTION_ACTION} {len(expired)} partition(s) "
+                            f"of {table_name} older than {cutoff_month:%Y-%m}: {', '.join(sorted(expired))}")
+        except (Exception, psycopg2.Error) as error:
+            logger.error(f"Error applying partition retention to {table_name}: {repr(error)}")
+
+
+def maintain_partitions():
+    """Заранее создает партиции на ближайшие DB_PARTITION_PREMAKE_MONTHS месяцев и применяет срок хранения."""
+    today = date.today()
+    for table_name in PARTITIONABLE_TABLES:
+        ensure_partitions(table_name, _add_months(today.replace(day=1), -1),
+                          _add_months(today.replace(day=1), config.DB_PARTITION_PREMAKE_MONTHS))
+    apply_partition_retention()
+
+
 def create_tables_if_not_exist():
-    """Создает таблицы в БД, если они еще не существуют."""
+    """Создает таблицы в БД, если они еще не существуют (миграция 1, migrations.py). Возвращает успех."""
     # Вот недостающий кортеж с командами SQL
     commands_sql = (
         """
         CREATE TABLE IF NOT EXISTS metrika_traffic_sources (
-            id SERIAL PRIMARY KEY,
+            {id_column},
+            tenant_id VARCHAR(64) NOT NULL, -- сайт (tenants.py)
             fetch_date DATE NOT NULL DEFAULT CURRENT_DATE,
             report_date DATE NOT NULL,
-            source_group VARCHAR(255), -- e.g., 'Переходы из поисковых систем', 'Прямые заходы'
-            source_engine VARCHAR(255), -- e.g., 'Яндекс', 'Google', 'Переходы по ссылкам на сайтах'
-            source_detail VARCHAR(512), -- ym:s:lastSignSource
+            source_id INTEGER NOT NULL, -- dim_sources: группа, система и детализация источника
             visits INTEGER,
             users INTEGER,
-            UNIQUE (report_date, source_group, source_engine, source_detail) -- уникальность для предотвращения дублей за день
-        );
-        """,
+            -- уникальность для предотвращения дублей за день
+            UNIQUE (tenant_id, report_date, source_id){primary_key}
+        ){partitioning};
+        """.format(**_partitioning_ddl('metrika_traffic_sources')),
         """
         CREATE TABLE IF NOT EXISTS metrika_conversions (
-            id SERIAL PRIMARY KEY,
+            {id_column},
+            tenant_id VARCHAR(64) NOT NULL, -- сайт (tenants.py)
             fetch_date DATE NOT NULL DEFAULT CURRENT_DATE,
             report_date DATE NOT NULL,
-            goal_id VARCHAR(255) NOT NULL,
-            goal_name VARCHAR(255),
-            source_engine VARCHAR(255), -- 'organic' for search engines, or specific source
-            source_detail VARCHAR(512), -- ym:s:lastSignSource для детализации
+            goal_id VARCHAR(255) NOT NULL, -- название цели хранится в dim_goals
+            source_id INTEGER NOT NULL, -- dim_sources
             reaches INTEGER,
             conversion_rate REAL, -- FLOAT в SQL это REAL или DOUBLE PRECISION
-            UNIQUE (report_date, goal_id, source_engine, source_detail)
-        );
-        """,
+            UNIQUE (tenant_id, report_date, goal_id, source_id){primary_key}
+        ){partitioning};
+        """.format(**_partitioning_ddl('metrika_conversions')),
         """
         CREATE TABLE IF NOT EXISTS metrika_behavior (
             id SERIAL PRIMARY KEY,
+            tenant_id VARCHAR(64) NOT NULL, -- сайт (tenants.py)
             fetch_date DATE NOT NULL DEFAULT CURRENT_DATE,
             report_date DATE NOT NULL,
             bounces INTEGER,
             bounce_rate REAL,
             page_depth REAL,
             avg_visit_duration_seconds INTEGER,
-            UNIQUE (report_date)
+            UNIQUE (tenant_id, report_date)
         );
         """,
         """
         CREATE TABLE IF NOT EXISTS topvisor_positions (
-            id SERIAL PRIMARY KEY,
+            {id_column},
+            tenant_id VARCHAR(64) NOT NULL, -- сайт (tenants.py)
             fetch_date DATE NOT NULL DEFAULT CURRENT_DATE,
             report_date DATE NOT NULL,
-            keyword TEXT NOT NULL,
+            keyword_id INTEGER NOT NULL, -- dim_keywords
             search_engine_name VARCHAR(100), -- "Yandex", "Google"
             search_engine_id INTEGER,
             region_name VARCHAR(255), -- Название региона, если сможем получить
             region_id INTEGER,
             position INTEGER,
-            url TEXT,
-            UNIQUE (report_date, keyword, search_engine_id, region_id)
-        );
-        """,
+            url_id INTEGER, -- dim_urls
+            UNIQUE (tenant_id, report_date, keyword_id, search_engine_id, region_id){primary_key}
+        ){partitioning};
+        """.format(**_partitioning_ddl('topvisor_positions')),
         """
         CREATE TABLE IF NOT EXISTS topvisor_visibility (
             id SERIAL PRIMARY KEY,
+            tenant_id VARCHAR(64) NOT NULL, -- сайт (tenants.py)
             fetch_date DATE NOT NULL DEFAULT CURRENT_DATE,
             report_date DATE NOT NULL,
             search_engine_name VARCHAR(100),
@@ -96,14 +399,56 @@ def create_tables_if_not_exist():
             region_name VARCHAR(255),
             region_id INTEGER,
             visibility_score REAL,
-            UNIQUE (report_date, search_engine_id, region_id)
+            UNIQUE (tenant_id, report_date, search_engine_id, region_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS etl_load_state (
+            tenant_id VARCHAR(64) NOT NULL,
+            dataset VARCHAR(100) NOT NULL, -- имя набора данных, обычно совпадает с таблицей
+            report_date DATE NOT NULL,
+            completed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (tenant_id, dataset, report_date)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS etl_runs (
+            run_id SERIAL PRIMARY KEY,
+            job_name VARCHAR(100) NOT NULL, -- 'daily_job', 'historical_load'
+            started_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP,
+            duration_seconds REAL,
+            status VARCHAR(20) NOT NULL -- 'success', 'partial' (часть диапазонов не загрузилась), 'failed'
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS etl_stage_metrics (
+            run_id INTEGER NOT NULL REFERENCES etl_runs (run_id) ON DELETE CASCADE,
+            tenant_id VARCHAR(64) NOT NULL,
+            dataset VARCHAR(100) NOT NULL,
+            metric VARCHAR(100) NOT NULL, -- см. etl_metrics.METRICS
+            value DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (run_id, tenant_id, dataset, metric)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS etl_run_jobs (
+            run_id INTEGER NOT NULL REFERENCES etl_runs (run_id) ON DELETE CASCADE,
+            task_name VARCHAR(200) NOT NULL, -- задача графа (job_graph.py), например 'default:metrika_behavior'
+            status VARCHAR(20) NOT NULL, -- 'success', 'failed', 'timeout', 'skipped'
+            attempts INTEGER NOT NULL,
+            started_at TIMESTAMP,
+            duration_seconds REAL,
+            error TEXT,
+            PRIMARY KEY (run_id, task_name)
         );
         """
         # TODO: Добавить таблицы для Yandex Webmaster (ИКС, индексация), если будем использовать
     )
     conn = None
     try:
-        conn = get_db_connection()
+        pool = get_connection_pool()
+        conn = pool.getconn()
         cur = conn.cursor()
         # Используем commands_sql, который мы определили выше
         for command_idx, command in enumerate(commands_sql):
@@ -147,82 +492,423 @@ def create_tables_if_not_exist():
                 logger.error(f"Full traceback for the SQL error:\n{traceback.format_exc()}")
                 if conn:
                     conn.rollback()
-                return
+                return False
 
         cur.close()
         conn.commit()
         logger.info("Tables checked/created successfully.")
+        return True
     except (Exception, psycopg2.Error) as error:
         logger.error(
             f"An unexpected error occurred during table creation process (not specific SQL command): {repr(error)}")
         logger.error(f"Full traceback for unexpected error:\n{traceback.format_exc()}")
-        if conn:
+        if conn and not conn.closed:
             conn.rollback()
+        return False
     finally:
         if conn:
-            conn.close()
+            pool.putconn(conn)
+
+
+# Ключи уникальности таблиц: по ним строится ON CONFLICT для обоих путей записи
+CONFLICT_COLUMNS_MAP = {
+    "metrika_traffic_sources": ("tenant_id", "report_date", "source_id"),
+    "metrika_conversions": ("tenant_id", "report_date", "goal_id", "source_id"),
+    "metrika_behavior": ("tenant_id", "report_date"),
+    "topvisor_positions": ("tenant_id", "report_date", "keyword_id", "search_engine_id", "region_id"),
+    "topvisor_visibility": ("tenant_id", "report_date", "search_engine_id", "region_id")
+}
+
+# Политики записи при конфликте ключа:
+#   ignore            - ON CONFLICT DO NOTHING, существующие строки не трогаем;
+#   upsert            - ON CONFLICT DO UPDATE, перезаписываем строку всегда;
+#   upsert_if_changed - перезаписываем, только если значения действительно отличаются (IS DISTINCT FROM),
+#                       чтобы не плодить мертвые версии строк и WAL на неизмененных данных.
+WRITE_POLICY_IGNORE = 'ignore'
+WRITE_POLICY_UPSERT = 'upsert'
+WRITE_POLICY_UPSERT_IF_CHANGED = 'upsert_if_changed'
+WRITE_POLICIES = (WRITE_POLICY_IGNORE, WRITE_POLICY_UPSERT, WRITE_POLICY_UPSERT_IF_CHANGED)
+
+# Экранирование для текстового формата COPY: обратный слеш, табуляция и переводы строк
+_COPY_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+class WriteResult(collections.namedtuple('WriteResult', ['inserted', 'updated', 'unchanged'])):
+    """Итог записи: сколько строк вставлено, обновлено и оставлено без изменений (в т.ч. дубли в пачке)."""
+    __slots__ = ()
+
+    @property
+    def total(self):
+        return self.inserted + self.updated + self.unchanged
+
+    def combine(self, other):
+        return WriteResult(self.inserted + other.inserted, self.updated + other.updated,
+                           self.unchanged + other.unchanged)
+
+
+def get_write_policy(table_name):
+    """Политика записи таблицы из config.DB_WRITE_POLICIES (по умолчанию - ignore)."""
+    policy = config.DB_WRITE_POLICIES.get(table_name, WRITE_POLICY_IGNORE)
+    if policy not in WRITE_POLICIES:
+        logger.warning(f"Unknown write policy '{policy}' for {table_name}; using '{WRITE_POLICY_IGNORE}'.")
+        return WRITE_POLICY_IGNORE
+    return policy
+
+
+def _build_conflict_clause(table_name, columns, policy):
+    """
+    Собирает ON CONFLICT ... для политики записи и RETURNING, по которому считаются вставленные
+    и обновленные строки (xmax = 0 только у только что вставленной версии строки).
+    """
+    returning = sql.SQL("RETURNING (xmax = 0) AS inserted")
+    if table_name not in CONFLICT_COLUMNS_MAP:
+        return returning
+
+    conflict_columns = CONFLICT_COLUMNS_MAP[table_name]
+    conflict_target = sql.SQL(', ').join(map(sql.Identifier, conflict_columns))
+    # fetch_date не сравниваем, но при обновлении выставляем заново - по нему видно, когда строка менялась
+    update_columns = [col for col in columns if col not in conflict_columns and col != 'fetch_date']
+    if policy == WRITE_POLICY_IGNORE or not update_columns:
+        return sql.SQL("ON CONFLICT ({}) DO NOTHING {}").format(conflict_target, returning)
+
+    set_clause = sql.SQL(', ').join(
+        [sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col)) for col in update_columns]
+        + [sql.SQL("fetch_date = CURRENT_DATE")]
+    )
+    where_clause = sql.SQL("")
+    if policy == WRITE_POLICY_UPSERT_IF_CHANGED:
+        where_clause = sql.SQL("WHERE ROW({}) IS DISTINCT FROM ROW({})").format(
+            sql.SQL(', ').join(sql.Identifier(table_name, col) for col in update_columns),
+            sql.SQL(', ').join(sql.SQL("EXCLUDED.{}").format(sql.Identifier(col)) for col in update_columns)
+        )
+    return sql.SQL("ON CONFLICT ({}) DO UPDATE SET {} {} {}").format(
+        conflict_target, set_clause, where_clause, returning)
 
 
-def bulk_insert_data(table_name, columns, data_tuples):
+def _dedupe_by_conflict_key(table_name, columns, data_tuples):
+    """
+    Оставляет по одной (последней) строке на ключ конфликта: ON CONFLICT DO UPDATE не может
+    изменить одну и ту же строку дважды в рамках одного запроса.
+    """
+    key_indexes = [columns.index(col) for col in CONFLICT_COLUMNS_MAP[table_name]]
+    unique_rows = {}
+    for row in data_tuples:
+        unique_rows[tuple(row[i] for i in key_indexes)] = row
+    return list(unique_rows.values())
+
+
+def _format_copy_row(row):
+    """Превращает кортеж в строку текстового формата COPY (NULL -> \\N)."""
+    return '\t'.join(
+        '\\N' if value is None else str(value).translate(_COPY_TEXT_ESCAPES) for value in row
+    ) + '\n'
+
+
+def _insert_via_values(cur, table_name, columns, data_tuples, conflict_clause):
+    """
+    Старый путь записи: многострочные INSERT ... VALUES через execute_values.
+    Возвращает (вставлено, обновлено).
+    """
+    # Формируем SQL-запрос с использованием sql.SQL для безопасной вставки имен таблиц и колонок
+    cols_sql = sql.SQL(', ').join(map(sql.Identifier, columns))
+    query_template_sql = sql.SQL("INSERT INTO {} ({}) VALUES %s {}").format(
+        sql.Identifier(table_name),
+        cols_sql,
+        conflict_clause
+    )
+    # psycopg2.extras.execute_values ожидает строку запроса
+    returned = execute_values(cur, query_template_sql.as_string(cur), data_tuples, page_size=100, fetch=True)
+    inserted = sum(1 for (was_inserted,) in returned if was_inserted)
+    return inserted, len(returned) - inserted
+
+
+def _insert_via_copy(cur, table_name, columns, data_tuples, conflict_clause):
+    """
+    Быстрый путь записи: строки потоком уходят через COPY FROM STDIN во временную staging-таблицу,
+    после чего сливаются в целевую таблицу одним INSERT ... SELECT ... ON CONFLICT.
+    Staging-таблица живет до конца транзакции (ON COMMIT DROP).
+    Возвращает (вставлено, обновлено).
+    """
+    staging_table = sql.Identifier(f"_staging_{table_name}")
+    cols_sql = sql.SQL(', ').join(map(sql.Identifier, columns))
+
+    # Берем только нужные колонки без ограничений целевой таблицы (id SERIAL, NOT NULL и т.п.)
+    cur.execute(sql.SQL("CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA").format(
+        staging_table, cols_sql, sql.Identifier(table_name)
+    ))
+
+    buffer = io.StringIO()
+    buffer.writelines(_format_copy_row(row) for row in data_tuples)
+    buffer.seek(0)
+    cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN").format(staging_table, cols_sql).as_string(cur), buffer)
+
+    cur.execute(sql.SQL(
+        "WITH merged AS (INSERT INTO {} ({}) SELECT {} FROM {} {}) "
+        "SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged"
+    ).format(sql.Identifier(table_name), cols_sql, cols_sql, staging_table, conflict_clause))
+    inserted, updated = cur.fetchone()
+    return inserted, updated
+
+
+def bulk_insert_data(table_name, columns, data_tuples, method='auto', policy=None):
     """
     Выполняет массовую вставку данных в указанную таблицу.
     :param table_name: Имя таблицы.
     :param columns: Список названий колонок.
     :param data_tuples: Список кортежей с данными для вставки.
+    :param method: 'copy' - COPY в staging-таблицу и слияние одним запросом, 'values' - execute_values,
+                   'auto' - 'copy', если строк не меньше config.DB_COPY_THRESHOLD_ROWS, иначе 'values'.
+    :param policy: Политика записи при конфликте ключа (ignore / upsert / upsert_if_changed);
+                   по умолчанию берется из config.DB_WRITE_POLICIES.
+    :return: WriteResult(inserted, updated, unchanged) или None, если запись не удалась.
     """
     if not data_tuples:
         logger.info(f"No data to insert into {table_name}.")
-        return
+        return WriteResult(0, 0, 0)
+
+    policy = policy or get_write_policy(table_name)
+    rows_to_write = data_tuples
+    if policy != WRITE_POLICY_IGNORE and table_name in CONFLICT_COLUMNS_MAP:
+        rows_to_write = _dedupe_by_conflict_key(table_name, list(columns), data_tuples)
+
+    if method == 'auto':
+        method = 'copy' if len(rows_to_write) >= config.DB_COPY_THRESHOLD_ROWS else 'values'
 
     conn = None
     try:
-        conn = get_db_connection()
+        pool = get_connection_pool()
+        conn = pool.getconn()
         cur = conn.cursor()
+        conflict_clause = _build_conflict_clause(table_name, columns, policy)
 
-        conflict_columns_map = {
-            "metrika_traffic_sources": "(report_date, source_group, source_engine, source_detail)",
-            "metrika_conversions": "(report_date, goal_id, source_engine, source_detail)",
-            "metrika_behavior": "(report_date)",
-            "topvisor_positions": "(report_date, keyword, search_engine_id, region_id)",
-            "topvisor_visibility": "(report_date, search_engine_id, region_id)"
-        }
-
-        conflict_clause = ""
-        if table_name in conflict_columns_map:
-            # Создаем список полей для DO UPDATE SET, исключая сами поля конфликта, если они есть в columns
-            # Это более продвинутый вариант, пока оставим DO NOTHING для простоты
-            # update_columns = [col for col in columns if col not in conflict_columns_map[table_name]]
-            # if update_columns:
-            #    set_clause = ", ".join([f"{sql.Identifier(col).string} = EXCLUDED.{sql.Identifier(col).string}" for col in update_columns])
-            #    conflict_clause = f"ON CONFLICT {conflict_columns_map[table_name]} DO UPDATE SET {set_clause}"
-            # else:
-            conflict_clause = f"ON CONFLICT {conflict_columns_map[table_name]} DO NOTHING"
-
-        # Формируем SQL-запрос с использованием sql.SQL для безопасной вставки имен таблиц и колонок
-        cols_sql = sql.SQL(', ').join(map(sql.Identifier, columns))
-        query_template_sql = sql.SQL("INSERT INTO {} ({}) VALUES %s {}").format(
-            sql.Identifier(table_name),
-            cols_sql,
-            sql.SQL(conflict_clause)  # Вставляем ON CONFLICT ... как есть (уже строка)
-        )
-
-        # psycopg2.extras.execute_values ожидает строку запроса
-        execute_values(cur, query_template_sql.as_string(cur), data_tuples, page_size=100)
+        if method == 'copy':
+            try:
+                inserted, updated = _insert_via_copy(cur, table_name, columns, rows_to_write, conflict_clause)
+            except psycopg2.Error as copy_error:
+                if conn.closed:
+                    raise
+                logger.warning(
+                    f"COPY load into {table_name} failed: {repr(copy_error)}. Falling back to execute_values.")
+                conn.rollback()
+                method = 'values'
+                inserted, updated = _insert_via_values(cur, table_name, columns, rows_to_write, conflict_clause)
+        else:
+            inserted, updated = _insert_via_values(cur, table_name, columns, rows_to_write, conflict_clause)
 
         conn.commit()
-        logger.info(f"Successfully inserted {len(data_tuples)} rows into {table_name}.")
+        result = WriteResult(inserted, updated, len(data_tuples) - inserted - updated)
+        logger.info(f"Successfully wrote {len(data_tuples)} rows into {table_name} (method={method}, "
+                    f"policy={policy}): {result.inserted} inserted, {result.updated} updated, "
+                    f"{result.unchanged} unchanged.")
+        return result
     except (Exception, psycopg2.Error) as error:
         logger.error(
             f"Error during bulk insert into {table_name}: {repr(error)}")  # Используем repr(error) для безопасности
         logger.error(f"Full traceback for bulk insert error:\n{traceback.format_exc()}")
-        if conn:
+        if conn and not conn.closed:
             conn.rollback()
+        return None
     finally:
         if conn:
-            # cur.close() должен быть перед conn.close() и только если cur был успешно создан
+            # cur.close() должен быть перед возвратом соединения в пул и только если cur был успешно создан
             if 'cur' in locals() and cur:
                 cur.close()
-            conn.close()
+            pool.putconn(conn)
+
+
+def ensure_tenant_column(cur, table_name, constraint_type, key_columns):
+    """
+    Переводит таблицу, созданную до появления тенантов, на колонку tenant_id: существующие строки
+    относятся к тенанту config.DEFAULT_TENANT_ID, а ключ ('u' - UNIQUE, 'p' - PRIMARY KEY) пересоздается
+    по key_columns. Возвращает True, если таблица была изменена.
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL, EXISTS (SELECT 1 FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'tenant_id')",
+                (table_name, table_name))
+    table_exists, has_tenant = cur.fetchone()
+    if not table_exists or has_tenant:
+        return False
+    table = sql.Identifier(table_name)
+    # Значение по умолчанию нужно только для уже существующих строк (в PostgreSQL 11+ без перезаписи таблицы)
+    cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN tenant_id VARCHAR(64) NOT NULL DEFAULT {}").format(
+        table, sql.Literal(config.DEFAULT_TENANT_ID)))
+    cur.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN tenant_id DROP DEFAULT").format(table))
+    cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = %s",
+                (table_name, constraint_type))
+    for (constraint_name,) in cur.fetchall():
+        cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(table, sql.Identifier(constraint_name)))
+    cur.execute(sql.SQL("ALTER TABLE {} ADD {} ({})").format(
+        table, sql.SQL('UNIQUE' if constraint_type == 'u' else 'PRIMARY KEY'),
+        sql.SQL(', ').join(map(sql.Identifier, key_columns))))
+    logger.info(f"{table_name}: tenant_id column added, existing rows belong to '{config.DEFAULT_TENANT_ID}'.")
+    return True
+
+
+def migrate_tenant_columns():
+    """Добавляет tenant_id в таблицы, созданные до появления тенантов (см. ensure_tenant_column)."""
+    tenant_keys = {table_name: ('u', key_columns) for table_name, key_columns in CONFLICT_COLUMNS_MAP.items()}
+    tenant_keys['etl_load_state'] = ('p', ('tenant_id', 'dataset', 'report_date'))
+    tenant_keys['etl_stage_metrics'] = ('p', ('run_id', 'tenant_id', 'dataset', 'metric'))
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for table_name, (constraint_type, key_columns) in tenant_keys.items():
+                    ensure_tenant_column(cur, table_name, constraint_type, key_columns)
+            conn.commit()
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error adding tenant_id columns: {repr(error)}")
+        return False
+
+
+def get_completed_dates(tenant_id, dataset, date_from, date_to):
+    """
+    Возвращает множество дат периода, за которые набор данных тенанта уже полностью загружен.
+    При ошибке БД возвращает пустое множество - тогда период просто будет загружен заново.
+    """
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT report_date FROM etl_load_state "
+                    "WHERE tenant_id = %s AND dataset = %s AND report_date BETWEEN %s AND %s",
+                    (tenant_id, dataset, date_from, date_to)
+                )
+                completed = {row[0] for row in cur.fetchall()}
+            conn.commit()
+        return completed
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error reading load state for {tenant_id}/{dataset}: {repr(error)}")
+        return set()
+
+
+def mark_dates_completed(tenant_id, dataset, dates):
+    """Отмечает даты набора данных тенанта как загруженные (повторная отметка обновляет completed_at)."""
+    if not dates:
+        return True
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "INSERT INTO etl_load_state (tenant_id, dataset, report_date) VALUES %s "
+                    "ON CONFLICT (tenant_id, dataset, report_date) DO UPDATE SET completed_at = NOW()",
+                    [(tenant_id, dataset, day) for day in dates]
+                )
+            conn.commit()
+        logger.info(f"Marked {len(dates)} date(s) of {tenant_id}/{dataset} as loaded.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error saving load state for {tenant_id}/{dataset}: {repr(error)}")
+        return False
+
+
+def save_etl_run(etl_run):
+    """
+    Сохраняет завершенный запуск (etl_metrics.EtlRun), его метрики и итоги задач
+    в etl_runs / etl_stage_metrics / etl_run_jobs.
+    """
+    try:
+        with pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO etl_runs (job_name, started_at, finished_at, duration_seconds, status) "
+                    "VALUES (%s, %s, %s, %s, %s) RETURNING run_id",
+                    (etl_run.job_name, etl_run.started_at, etl_run.finished_at, etl_run.duration_seconds,
+                     etl_run.status)
+                )
+                run_id = cur.fetchone()[0]
+                if etl_run.metrics:
+                    execute_values(cur, "INSERT INTO etl_stage_metrics (run_id, tenant_id, dataset, metric, value) "
+                                        "VALUES %s",
+                                   [(run_id, tenant_id, dataset, metric, value)
+                                    for (tenant_id, dataset, metric), value in sorted(etl_run.metrics.items())])
+                if etl_run.jobs:
+                    execute_values(cur, "INSERT INTO etl_run_jobs (run_id, task_name, status, attempts, started_at, "
+                                        "duration_seconds, error) VALUES %s",
+                                   [(run_id, job.name, job.status, job.attempts, job.started_at,
+                                     job.duration_seconds, job.error) for job in etl_run.jobs])
+            conn.commit()
+        logger.info(f"ETL run {run_id} ({etl_run.job_name}) saved with {len(etl_run.metrics)} metric(s).")
+        return run_id
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error saving ETL run {etl_run.job_name}: {repr(error)}")
+        return None
+
+
+def _batched(rows, batch_size):
+    """Режет итератор строк на списки не длиннее batch_size."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def bulk_insert_stream(table_name, columns, rows, batch_size=None):
+    """
+    Потоковая запись: строки из итератора (обычно генератора парсера API) собираются в пачки
+    по batch_size и пишутся отдельным потоком, пока основной поток скачивает следующие страницы.
+    Очередь пачек ограничена config.DB_STREAM_QUEUE_BATCHES, поэтому память не зависит от объема периода.
+    Если итератор выбросил исключение, уже полученные пачки дописываются, а исключение пробрасывается дальше;
+    если упал поток записи, чтение итератора прекращается.
+    :return: Суммарный WriteResult или None, если хотя бы одна пачка не записалась.
+    """
+    batch_size = batch_size or config.DB_INSERT_BATCH_SIZE
+    batches = queue.Queue(maxsize=config.DB_STREAM_QUEUE_BATCHES)
+    outcome = {'result': WriteResult(0, 0, 0), 'failed_batches': 0, 'error': None}
+
+    def writer():
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                started = time.monotonic()
+                result = bulk_insert_data(table_name, columns, batch)
+                etl_metrics.add('db_write_seconds', time.monotonic() - started)
+                if result is None:
+                    outcome['failed_batches'] += 1
+                    etl_metrics.add('db_failed_batches')
+                else:
+                    outcome['result'] = outcome['result'].combine(result)
+                    etl_metrics.add('db_rows_inserted', result.inserted)
+                    etl_metrics.add('db_rows_updated', result.updated)
+                    etl_metrics.add('db_rows_unchanged', result.unchanged)
+        except Exception as error:
+            outcome['error'] = error
+            logger.error(f"Writer thread for {table_name} failed: {repr(error)}")
+
+    def put(item):
+        # Упавший поток записи очередь больше не разбирает: ждем места в ней, только пока он жив
+        while writer_thread.is_alive():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Поток записи работает в контексте вызывающего, чтобы метрики попадали в тот же набор данных
+    writer_thread = threading.Thread(target=contextvars.copy_context().run, args=(writer,),
+                                     name=f"db-writer-{table_name}", daemon=True)
+    writer_thread.start()
+    try:
+        for batch in _batched(rows, batch_size):
+            if not put(batch):
+                break
+    finally:
+        put(None)
+        writer_thread.join()
+
+    if outcome['error'] is not None:
+        return None
+    if outcome['failed_batches']:
+        logger.error(f"{outcome['failed_batches']} batch(es) failed to load into {table_name}; "
+                     f"{outcome['result'].total} rows written.")
+        return None
+    return outcome['result']
 
 
 if __name__ == '__main__':
@@ -0,0 +1,418 @@
+# dimensions.py
+import logging
+import threading
+from itertools import islice
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import config
+import db_manager
+from traffic_classifier import classify as classify_traffic_source
+
+logger = logging.getLogger(__name__)
+
+
+class DimensionLookupError(Exception):
+    """Не удалось получить суррогатные ключи справочника (ошибка БД)."""
+
+
+DIMENSION_TABLES_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS dim_keywords (
+        keyword_id SERIAL PRIMARY KEY,
+        keyword TEXT NOT NULL UNIQUE
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dim_urls (
+        url_id SERIAL PRIMARY KEY,
+        url TEXT NOT NULL UNIQUE
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dim_sources (
+        source_id SERIAL PRIMARY KEY,
+        source_group VARCHAR(255) NOT NULL DEFAULT '', -- пустая строка вместо NULL, чтобы работал UNIQUE
+        source_engine VARCHAR(255) NOT NULL DEFAULT '',
+        source_detail VARCHAR(512) NOT NULL DEFAULT '',
+        UNIQUE (source_group, source_engine, source_detail)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dim_goals (
+        goal_id VARCHAR(255) PRIMARY KEY, -- ID цели Метрики сам по себе компактный ключ
+        goal_name VARCHAR(255)
+    );
+    """,
+)
+
+# Переход со старой схемы, где строки хранились прямо в фактах: (таблица, признак старой схемы, команды).
+# Выполняется один раз, пока в таблице есть старая колонка; все команды таблицы - в одной транзакции.
+# Старые ограничения UNIQUE пропускали повторы строк с NULL (API присылает "name": null), а при переходе NULL
+# становится '': перед новым ограничением из повторов остается строка с самой поздней fetch_date.
+LEGACY_MIGRATIONS = (
+    ("topvisor_positions", "keyword", (
+        "INSERT INTO dim_keywords (keyword) SELECT DISTINCT keyword FROM topvisor_positions "
+        "ON CONFLICT DO NOTHING",
+        "INSERT INTO dim_urls (url) SELECT DISTINCT url FROM topvisor_positions WHERE url IS NOT NULL "
+        "ON CONFLICT DO NOTHING",
+        "ALTER TABLE topvisor_positions ADD COLUMN IF NOT EXISTS keyword_id INTEGER, "
+        "ADD COLUMN IF NOT EXISTS url_id INTEGER",
+        "UPDATE topvisor_positions f SET keyword_id = k.keyword_id FROM dim_keywords k "
+        "WHERE k.keyword = f.keyword",
+        "UPDATE topvisor_positions f SET url_id = u.url_id FROM dim_urls u WHERE u.url = f.url",
+        # Вместе с колонками удаляется и старое ограничение UNIQUE
+        "ALTER TABLE topvisor_positions DROP COLUMN keyword, DROP COLUMN url, "
+        "ALTER COLUMN keyword_id SET NOT NULL",
+        "DELETE FROM topvisor_positions a USING topvisor_positions b WHERE a.report_date = b.report_date "
+        "AND a.keyword_id = b.keyword_id AND a.search_engine_id = b.search_engine_id AND a.region_id = b.region_id "
+        "AND (a.fetch_date, a.id) < (b.fetch_date, b.id)",
+        "ALTER TABLE topvisor_positions ADD UNIQUE (report_date, keyword_id, search_engine_id, region_id)",
+    )),
+    ("metrika_traffic_sources", "source_engine", (
+        "INSERT INTO dim_sources (source_group, source_engine, source_detail) "
+        "SELECT DISTINCT COALESCE(source_group, ''), COALESCE(source_engine, ''), COALESCE(source_detail, '') "
+        "FROM metrika_traffic_sources ON CONFLICT DO NOTHING",
+        "ALTER TABLE metrika_traffic_sources ADD COLUMN IF NOT EXISTS source_id INTEGER",
+        "UPDATE metrika_traffic_sources f SET source_id = s.source_id FROM dim_sources s "
+        "WHERE s.source_group = COALESCE(f.source_group, '') AND s.source_engine = COALESCE(f.source_engine, '') "
+        "AND s.source_detail = COALESCE(f.source_detail, '')",
+        "ALTER TABLE metrika_traffic_sources DROP COLUMN source_group, DROP COLUMN source_engine, "
+        "DROP COLUMN source_detail, ALTER COLUMN source_id SET NOT NULL",
+        "DELETE FROM metrika_traffic_sources a USING metrika_traffic_sources b WHERE a.report_date = b.report_date "
+        "AND a.source_id = b.source_id AND (a.fetch_date, a.id) < (b.fetch_date, b.id)",
+        "ALTER TABLE metrika_traffic_sources ADD UNIQUE (report_date, source_id)",
+    )),
+    ("metrika_conversions", "source_engine", (
+        "INSERT INTO dim_goals (goal_id, goal_name) SELECT DISTINCT ON (goal_id) goal_id, goal_name "
+        "FROM metrika_conversions ORDER BY goal_id, report_date DESC ON CONFLICT DO NOTHING",
+        "INSERT INTO dim_sources (source_group, source_engine, source_detail) "
+        "SELECT DISTINCT '', COALESCE(source_engine, ''), COALESCE(source_detail, '') "
+        "FROM metrika_conversions ON CONFLICT DO NOTHING",
+        "ALTER TABLE metrika_conversions ADD COLUMN IF NOT EXISTS source_id INTEGER",
+        "UPDATE metrika_conversions f SET source_id = s.source_id FROM dim_sources s "
+        "WHERE s.source_group = '' AND s.source_engine = COALESCE(f.source_engine, '') "
+        "AND s.source_detail = COALESCE(f.source_detail, '')",
+        "ALTER TABLE metrika_conversions DROP COLUMN goal_name, DROP COLUMN source_engine, "
+        "DROP COLUMN source_detail, ALTER COLUMN source_id SET NOT NULL",
+        "DELETE FROM metrika_conversions a USING metrika_conversions b WHERE a.report_date = b.report_date "
+        "AND a.goal_id = b.goal_id AND a.source_id = b.source_id AND (a.fetch_date, a.id) < (b.fetch_date, b.id)",
+        "ALTER TABLE metrika_conversions ADD UNIQUE (report_date, goal_id, source_id)",
+    )),
+)
+
+# Представления с расшифрованными значениями - для дашбордов и ручных запросов
+VIEWS_SQL = (
+    """
+    CREATE OR REPLACE VIEW metrika_traffic_sources_v AS
+    SELECT f.id, f.fetch_date, f.report_date, s.source_group, s.source_engine, s.source_detail,
+           f.visits, f.users, f.tenant_id
+    FROM metrika_traffic_sources f JOIN dim_sources s USING (source_id);
+    """,
+    """
+    CREATE OR REPLACE VIEW metrika_conversions_v AS
+    SELECT f.id, f.fetch_date, f.report_date, f.goal_id, COALESCE(g.goal_name, 'Неизвестная цель') AS goal_name,
+           s.source_group, s.source_engine, s.source_detail, f.reaches, f.conversion_rate, f.tenant_id
+    FROM metrika_conversions f JOIN dim_sources s USING (source_id) LEFT JOIN dim_goals g USING (goal_id);
+    """,
+    """
+    CREATE OR REPLACE VIEW topvisor_positions_v AS
+    SELECT f.id, f.fetch_date, f.report_date, k.keyword, f.search_engine_name, f.search_engine_id,
+           f.region_name, f.region_id, f.position, u.url, f.tenant_id
+    FROM topvisor_positions f JOIN dim_keywords k USING (keyword_id) LEFT JOIN dim_urls u USING (url_id);
+    """,
+)
+
+
+class Dimension:
+    """
+    Справочник строковых значений с целочисленными суррогатными ключами.
+    Ключи кэшируются в памяти процесса, в БД уходят только промахи кэша - одной пачкой на чанк записей.
+    derive(*key) - значения derived_columns для новой строки справочника (в ключ они не входят).
+    """
+
+    def __init__(self, table_name, id_column, key_columns, derived_columns=(), derive=None):
+        self.table_name = table_name
+        self.id_column = id_column
+        self.key_columns = tuple(key_columns)
+        self.derived_columns = tuple(derived_columns)
+        self.derive = derive
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def _normalize(self, values):
+        """Полностью пустое значение не кодируется (None), отдельные пустые части превращаются в ''."""
+        if all(value is None for value in values):
+            return None
+        return tuple('' if value is None else str(value) for value in values)
+
+    def _lookup(self, cur, keys):
+        columns = sql.SQL(', ').join(map(sql.Identifier, self.key_columns))
+        join_condition = sql.SQL(' AND ').join(
+            sql.SQL("d.{col} = v.{col}").format(col=sql.Identifier(col)) for col in self.key_columns)
+        query = sql.SQL("SELECT d.{id}, {d_columns} FROM {table} d JOIN (VALUES %s) AS v ({columns}) ON {cond}").format(
+            id=sql.Identifier(self.id_column), table=sql.Identifier(self.table_name), columns=columns,
+            d_columns=sql.SQL(', ').join(sql.SQL("d.{}").format(sql.Identifier(col)) for col in self.key_columns),
+            cond=join_condition)
+        rows = execute_values(cur, query.as_string(cur), keys, page_size=len(keys), fetch=True)
+        return {tuple(row[1:]): row[0] for row in rows}
+
+    def _resolve(self, keys):
+        """Находит ключи в БД, недостающие значения вставляет одной пачкой."""
+        keys = sorted(keys)  # одинаковый порядок вставки у параллельных загрузчиков - без взаимных блокировок
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                found = self._lookup(cur, keys)
+                new_keys = [key for key in keys if key not in found]
+                if new_keys:
+                    insert_query = sql.SQL("INSERT INTO {table} ({columns}) VALUES %s ON CONFLICT DO NOTHING").format(
+                        table=sql.Identifier(self.table_name),
+                        columns=sql.SQL(', ').join(map(sql.Identifier, self.key_columns + self.derived_columns)))
+                    new_rows = [key + tuple(self.derive(*key)) for key in new_keys] if self.derive else new_keys
+                    execute_values(cur, insert_query.as_string(cur), new_rows, page_size=len(new_rows))
+                    # Повторный поиск подхватывает и значения, параллельно вставленные другим загрузчиком
+                    found.update(self._lookup(cur, new_keys))
+                    logger.debug(f"{self.table_name}: {len(new_keys)} new values inserted.")
+            conn.commit()
+        return found
+
+    def get_ids_for_keys(self, keys):
+        """Возвращает {нормализованное значение: id} для нормализованных значений (None пропускаются)."""
+        keys = {key for key in keys if key is not None}
+        with self._lock:
+            result = {key: self._ids[key] for key in keys if key in self._ids}
+        missing = keys.difference(result)
+        if missing:
+            try:
+                resolved = self._resolve(missing)
+            except (Exception, psycopg2.Error) as error:
+                logger.error(f"Error resolving {len(missing)} values of {self.table_name}: {repr(error)}")
+                raise DimensionLookupError(f"Could not resolve ids in {self.table_name}") from error
+            unresolved = missing.difference(resolved)
+            if unresolved:
+                raise DimensionLookupError(f"{len(unresolved)} values of {self.table_name} were not resolved")
+            with self._lock:
+                if len(self._ids) + len(resolved) > config.DIM_CACHE_MAX_ENTRIES:
+                    self._ids.clear()
+                self._ids.update(resolved)
+            result.update(resolved)
+        return result
+
+    def encode_column(self, records, field_indexes):
+        """Список суррогатных ключей (None для пустых значений) для полей field_indexes каждой записи."""
+        keys = [self._normalize(tuple(record[index] for index in field_indexes)) for record in records]
+        ids = self.get_ids_for_keys(keys)
+        return [ids[key] if key is not None else None for key in keys]
+
+
+DIMENSIONS = {
+    "keywords": Dimension("dim_keywords", "keyword_id", ("keyword",)),
+    "urls": Dimension("dim_urls", "url_id", ("url",)),
+    # Ключ источника - исходные значения Метрики; группа и система выводятся правилами traffic_classifier,
+    # поэтому смена правил не меняет source_id и не плодит дубли в таблицах фактов (см. sync_source_categories)
+    "sources": Dimension("dim_sources", "source_id", ("source_type", "source_detail"),
+                         derived_columns=("source_group", "source_engine"), derive=classify_traffic_source),
+}
+
+# Таблицы фактов с ключом источника (dim_sources)
+SOURCE_FACT_TABLES = ("metrika_traffic_sources", "metrika_conversions")
+
+
+def encode_records(table_schema, records, tenant_id, chunk_size=None):
+    """
+    Генератор строк для записи в БД (колонки table_schema.columns) из записей парсера тенанта tenant_id.
+    Строковые значения справочников заменяются суррогатными ключами; записи обрабатываются чанками,
+    чтобы промахи кэша уходили в БД пачкой, а не по строке. К записям таблиц без справочников
+    только добавляется tenant_id - остальные поля уже совпадают с колонками таблицы.
+    """
+    tenant_prefix = (tenant_id,)
+    if not table_schema.dimensions:
+        for record in records:
+            yield tenant_prefix + record
+        return
+    chunk_size = chunk_size or config.DB_INSERT_BATCH_SIZE
+    dimensions = [DIMENSIONS[dimension_name] for dimension_name, _, _ in table_schema.dimensions]
+    column_plan = table_schema.column_plan
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        encoded = [dimension.encode_column(chunk, field_indexes)
+                   for dimension, field_indexes in zip(dimensions, table_schema.dimension_field_indexes)]
+        for row_index, record in enumerate(chunk):
+            yield tenant_prefix + tuple(record[index] if kind == 'field' else encoded[index][row_index]
+                                        for kind, index in column_plan)
+
+
+def sync_goals(goals_map):
+    """Обновляет названия целей в dim_goals (только изменившиеся)."""
+    if not goals_map:
+        return True
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur,
+                               "INSERT INTO dim_goals (goal_id, goal_name) VALUES %s "
+                               "ON CONFLICT (goal_id) DO UPDATE SET goal_name = EXCLUDED.goal_name "
+                               "WHERE dim_goals.goal_name IS DISTINCT FROM EXCLUDED.goal_name",
+                               [(str(goal_id), goal_name) for goal_id, goal_name in goals_map.items()])
+            conn.commit()
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error syncing dim_goals: {repr(error)}")
+        return False
+
+
+def _column_exists(cur, table_name, column_name):
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() "
+                "AND table_name = %s AND column_name = %s", (table_name, column_name))
+    return cur.fetchone() is not None
+
+
+def create_dimension_tables():
+    """
+    Создает справочники и переводит таблицы фактов старой схемы на суррогатные ключи.
+    Вызывается после db_manager.create_tables_if_not_exist().
+    """
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for command in DIMENSION_TABLES_SQL:
+                    cur.execute(command)
+            conn.commit()
+
+            for table_name, legacy_column, commands in LEGACY_MIGRATIONS:
+                with conn.cursor() as cur:
+                    if not _column_exists(cur, table_name, legacy_column):
+                        continue
+                    logger.info(f"Migrating {table_name} to dimension keys...")
+                    for command in commands:
+                        cur.execute(command)
+                conn.commit()
+                logger.info(f"{table_name} migrated to dimension keys. "
+                            f"Run VACUUM FULL {table_name} to return the freed space to the OS.")
+        logger.info("Dimension tables checked/created successfully.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error creating dimension tables: {repr(error)}")
+        return False
+
+
+def create_views():
+    """(Пере)создает представления с расшифровкой справочников; вызывается после всех миграций таблиц фактов."""
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for command in VIEWS_SQL:
+                    cur.execute(command)
+            conn.commit()
+        logger.info("Dimension views checked/created successfully.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error creating dimension views: {repr(error)}")
+        return False
+
+
+def migrate_source_keys():
+    """
+    Переводит dim_sources на ключ (source_type, source_detail). Строки, записанные раньше, исходного типа
+    не знают: они остаются с source_type = '' и замещаются при перезагрузке своих дней (purge_stale_sources).
+    """
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("ALTER TABLE dim_sources ADD COLUMN IF NOT EXISTS source_type VARCHAR(255) NOT NULL DEFAULT ''")
+                # Старый ключ (группа, система, детализация) зависел от правил категоризации
+                cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = 'dim_sources'::regclass AND contype = 'u'")
+                for (constraint_name,) in cur.fetchall():
+                    cur.execute(sql.SQL("ALTER TABLE dim_sources DROP CONSTRAINT {}").format(
+                        sql.Identifier(constraint_name)))
+                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dim_sources_source_key "
+                            "ON dim_sources (source_type, source_detail) WHERE source_type <> ''")
+            conn.commit()
+        logger.info("dim_sources keyed by raw source type and detail.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error migrating dim_sources keys: {repr(error)}")
+        return False
+
+
+def sync_source_categories():
+    """
+    Пересчитывает группу и систему источников dim_sources по текущим правилам traffic_classifier
+    (например, после правки TRAFFIC_SOURCE_RULES_FILE). source_id не меняются, факты не трогаются.
+    Возвращает [(таблица фактов, tenant_id, первая дата, последняя дата)] со строками изменившихся
+    источников - за эти периоды нужно пересчитать агрегаты, или None при ошибке.
+    """
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT source_id, source_type, source_detail, source_group, source_engine "
+                            "FROM dim_sources WHERE source_type <> ''")
+                changed = []
+                for source_id, source_type, source_detail, source_group, source_engine in cur.fetchall():
+                    category = classify_traffic_source(source_type, source_detail)
+                    if category != (source_group, source_engine):
+                        changed.append((source_id,) + category)
+                affected = []
+                if changed:
+                    execute_values(cur,
+                                   "UPDATE dim_sources d SET source_group = v.source_group, "
+                                   "source_engine = v.source_engine FROM (VALUES %s) AS v (source_id, source_group, "
+                                   "source_engine) WHERE d.source_id = v.source_id",
+                                   changed)
+                    source_ids = [row[0] for row in changed]
+                    for table_name in SOURCE_FACT_TABLES:
+                        cur.execute(sql.SQL("SELECT tenant_id, MIN(report_date), MAX(report_date) FROM {} "
+                                            "WHERE source_id = ANY(%s) GROUP BY tenant_id").format(
+                            sql.Identifier(table_name)), (source_ids,))
+                        affected.extend((table_name,) + row for row in cur.fetchall())
+            conn.commit()
+        if changed:
+            logger.info(f"Traffic source rules changed: {len(changed)} source(s) recategorized in dim_sources.")
+        return affected
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error syncing source categories: {repr(error)}")
+        return None
+
+
+def track_source_keys(table_schema, rows, source_keys):
+    """Пропускает строки encode_records таблицы с источниками, добавляя в source_keys пары (report_date, source_id)."""
+    date_index = table_schema.columns.index('report_date')
+    source_index = table_schema.columns.index('source_id')
+    for row in rows:
+        source_keys.add((row[date_index], row[source_index]))
+        yield row
+
+
+def purge_stale_sources(table_name, tenant_id, source_keys):
+    """
+    Удаляет строки фактов тенанта за только что перезагруженные дни, источников которых эта загрузка не записала
+    (source_keys - пары (report_date, source_id) из track_source_keys). Так не остаются дублями строки
+    со старым ключом источника (source_type = '') и строки, записанные до переключения METRIKA_SOURCE:
+    Logs API и API отчетов называют один и тот же источник по-разному, и это разные строки dim_sources.
+    """
+    if not source_keys:
+        return True
+    report_dates, source_ids = zip(*source_keys)
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL(
+                    "DELETE FROM {} f WHERE f.tenant_id = %s AND f.report_date = ANY(%s::date[]) AND NOT EXISTS ("
+                    "SELECT 1 FROM unnest(%s::date[], %s::integer[]) AS k (report_date, source_id) "
+                    "WHERE k.report_date = f.report_date AND k.source_id = f.source_id)"
+                ).format(sql.Identifier(table_name)),
+                    (tenant_id, sorted(set(report_dates)), list(report_dates), list(source_ids)))
+                purged = cur.rowcount
+            conn.commit()
+        if purged:
+            logger.info(f"{table_name}: {purged} row(s) of sources missing from the reload removed "
+                        f"for tenant {tenant_id}.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error purging stale source rows of {table_name}: {repr(error)}")
+        return False
@@ -0,0 +1,204 @@
+# etl_metrics.py
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import tenants
+
+logger = logging.getLogger(__name__)
+
+# Метрика -> описание для Prometheus. Все метрики - счетчики в разрезе тенанта и набора данных (dataset).
+METRICS = {
+    'http_requests': "HTTP requests sent to the APIs",
+    'http_errors': "HTTP requests that failed",
+    'http_retries': "Repeated API requests after a failure",
+    'http_throttled': "API responses with 429/503 (throttling)",
+    'http_bytes': "Bytes of API response bodies",
+    'http_seconds': "Time spent transferring HTTP requests and responses",
+    'http_sleep_seconds': "Time spent waiting for the rate limiter, Retry-After and retry backoff",
+    'export_wait_seconds': "Time spent waiting for Metrika Logs API exports to be prepared",
+    'cache_hits': "API responses served from the local cache",
+    'parsed_rows': "Rows produced by the API parsers",
+    'rejected_rows': "API rows rejected by the parsers",
+    'db_write_seconds': "Time spent writing batches to the database",
+    'db_rows_inserted': "Rows inserted into the database",
+    'db_rows_updated': "Rows updated in the database",
+    'db_rows_unchanged': "Rows skipped as unchanged or duplicate",
+    'db_failed_batches': "Batches that failed to write",
+    'failed_loads': "Date ranges whose load failed",
+    'stage_seconds': "Wall time of dataset loads",
+}
+
+UNKNOWN_DATASET = 'unknown'
+
+# Текущий набор данных и запуск; concurrency.ordered_map и поток записи в БД переносят их в свои потоки
+_current_dataset = contextvars.ContextVar('etl_dataset', default=None)
+_current_run = contextvars.ContextVar('etl_run', default=None)
+
+_lock = threading.Lock()
+_totals = {}  # (tenant_id, dataset, metric) -> значение с момента запуска процесса
+_last_runs = {}  # job_name -> последний завершенный EtlRun
+_runs_by_status = {}  # (job_name, status) -> число запусков
+
+
+def add(metric, value=1):
+    """Увеличивает счетчик metric текущего тенанта и набора данных (и текущего запуска, если он есть)."""
+    if not value:
+        return
+    key = (tenants.current_id(), _current_dataset.get() or UNKNOWN_DATASET, metric)
+    etl_run = _current_run.get()
+    with _lock:
+        _totals[key] = _totals.get(key, 0) + value
+        if etl_run is not None:
+            etl_run.metrics[key] = etl_run.metrics.get(key, 0) + value
+
+
+@contextmanager
+def stage(dataset):
+    """Относит все метрики внутри блока к набору данных dataset и замеряет его время."""
+    token = _current_dataset.set(dataset)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        add('stage_seconds', time.monotonic() - started)
+        _current_dataset.reset(token)
+
+
+def record_job(job_result):
+    """Добавляет итог задачи графа (job_graph.JobResult) к текущему запуску."""
+    etl_run = _current_run.get()
+    if etl_run is not None:
+        with _lock:
+            etl_run.jobs.append(job_result)
+
+
+class EtlRun:
+    """
+    Один запуск задачи (ежедневной, исторической загрузки): используется как контекстный менеджер,
+    собирает метрики всех наборов данных и статус. Сохраняется в БД через db_manager.save_etl_run().
+    """
+
+    def __init__(self, job_name):
+        self.job_name = job_name
+        self.started_at = None
+        self.finished_at = None
+        self.duration_seconds = None
+        self.status = 'running'
+        self.metrics = {}  # (tenant_id, dataset, metric) -> значение
+        self.jobs = []  # job_graph.JobResult задач запуска
+        self._token = None
+        self._started = None
+
+    def __enter__(self):
+        self.started_at = datetime.now()
+        self._started = time.monotonic()
+        self._token = _current_run.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_run.reset(self._token)
+        self.finished_at = datetime.now()
+        self.duration_seconds = time.monotonic() - self._started
+        if exc_type is not None:
+            self.status = 'failed'
+        elif (any(metric == 'failed_loads' for _, _, metric in self.metrics)
+              or any(job.status != 'success' for job in self.jobs)):
+            self.status = 'partial'
+        else:
+            self.status = 'success'
+        with _lock:
+            _last_runs[self.job_name] = self
+            _runs_by_status[(self.job_name, self.status)] = _runs_by_status.get((self.job_name, self.status), 0) + 1
+        transfer_seconds = sum(value for (_, _, metric), value in self.metrics.items() if metric == 'http_seconds')
+        wait_seconds = sum(value for (_, _, metric), value in self.metrics.items() if metric == 'http_sleep_seconds')
+        logger.info(f"ETL run '{self.job_name}' finished with status {self.status} "
+                    f"in {self.duration_seconds:.1f}s (HTTP: {transfer_seconds:.1f}s transferring, "
+                    f"{wait_seconds:.1f}s waiting; summed over threads).")
+        return False
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    """Текущие метрики в текстовом формате Prometheus (version 0.0.4)."""
+    with _lock:
+        totals = dict(_totals)
+        last_runs = dict(_last_runs)
+        runs_by_status = dict(_runs_by_status)
+
+    lines = []
+    for metric, description in METRICS.items():
+        samples = sorted((tenant_id, dataset, value)
+                         for (tenant_id, dataset, name), value in totals.items() if name == metric)
+        if not samples:
+            continue
+        lines.append(f"# HELP etl_{metric}_total {description}")
+        lines.append(f"# TYPE etl_{metric}_total counter")
+        lines.extend(f'etl_{metric}_total{{tenant="{_escape_label(tenant_id)}",dataset="{_escape_label(dataset)}"}} '
+                     f'{value}' for tenant_id, dataset, value in samples)
+
+    if runs_by_status:
+        lines.append("# HELP etl_runs_total Finished ETL runs by job and status")
+        lines.append("# TYPE etl_runs_total counter")
+        lines.extend(f'etl_runs_total{{job="{_escape_label(job)}",status="{_escape_label(status)}"}} {count}'
+                     for (job, status), count in sorted(runs_by_status.items()))
+    if last_runs:
+        gauges = (
+            ('etl_last_run_timestamp_seconds', "Start time of the last finished run",
+             lambda etl_run: etl_run.started_at.timestamp()),
+            ('etl_last_run_duration_seconds', "Duration of the last finished run",
+             lambda etl_run: round(etl_run.duration_seconds, 3)),
+            ('etl_last_run_success', "1 if the last finished run loaded everything",
+             lambda etl_run: 1 if etl_run.status == 'success' else 0),
+        )
+        for name, description, value_of in gauges:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(f'{name}{{job="{_escape_label(job)}"}} {value_of(etl_run)}'
+                         for job, etl_run in sorted(last_runs.items()))
+        job_samples = sorted((job, job_result) for job, etl_run in last_runs.items() for job_result in etl_run.jobs)
+        if job_samples:
+            lines.append("# HELP etl_last_run_task_duration_seconds Duration of each task of the last finished run")
+            lines.append("# TYPE etl_last_run_task_duration_seconds gauge")
+            lines.extend(f'etl_last_run_task_duration_seconds{{job="{_escape_label(job)}",'
+                         f'task="{_escape_label(job_result.name)}",status="{job_result.status}"}} '
+                         f'{round(job_result.duration_seconds, 3)}' for job, job_result in job_samples)
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(host, port):
+    """Запускает HTTP-эндпоинт /metrics в фоновом потоке; port 0 - эндпоинт выключен."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not start metrics endpoint on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,263 @@
+# export_parquet.py
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+from datetime import date, datetime
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+from psycopg2 import sql
+
+import config
+import db_manager
+
+logger = logging.getLogger(__name__)
+
+# Таблица фактов -> отношение, из которого берутся строки: для таблиц со справочниками - представление
+# с расшифровкой (dimensions.VIEWS_SQL), чтобы BI не приходилось соединять справочники самому
+EXPORT_SOURCES = {
+    "metrika_traffic_sources": "metrika_traffic_sources_v",
+    "metrika_behavior": "metrika_behavior",
+    "metrika_conversions": "metrika_conversions_v",
+    "topvisor_positions": "topvisor_positions_v",
+    "topvisor_visibility": "topvisor_visibility",
+}
+# Отпечаток расшифрованных значений дня для таблиц, чьи представления меняются без изменений в фактах:
+# перекатегоризация источников (dimensions.sync_source_categories) или переименование цели в dim_goals
+DIMENSION_FINGERPRINTS = {
+    "metrika_traffic_sources": "concat_ws('|', source_group, source_engine)",
+    "metrika_conversions": "concat_ws('|', goal_id, goal_name, source_group, source_engine)",
+}
+# Файл в каталоге таблицы: что и когда выгружено по каждой report_date
+MANIFEST_FILE = "_manifest.json"
+
+# OID типов PostgreSQL -> типы Arrow; остальные типы выгружаются строками
+_ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1700: pa.float64(),  # NUMERIC
+    1082: pa.date32(),
+    1114: pa.timestamp('us'),
+    1184: pa.timestamp('us', tz='UTC'),
+}
+
+
+def _arrow_schema(description, skip_column):
+    """Схема Arrow по описанию колонок курсора (без skip_column - она уходит в путь партиции)."""
+    return pa.schema([pa.field(column.name, _ARROW_TYPES.get(column.type_code, pa.string()))
+                      for column in description if column.name != skip_column])
+
+
+def _to_record_batch(rows, column_indexes, schema):
+    """Строки курсора -> RecordBatch по колонкам; NUMERIC приводится к float, незнакомые типы - к str."""
+    arrays = []
+    for index, field in zip(column_indexes, schema):
+        values = [row[index] for row in rows]
+        if pa.types.is_floating(field.type):
+            values = [float(value) if value is not None else None for value in values]
+        elif pa.types.is_string(field.type):
+            values = [str(value) if value is not None else None for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _load_manifest(table_dir):
+    try:
+        with open(os.path.join(table_dir, MANIFEST_FILE), encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_manifest(table_dir, manifest):
+    """Записывает манифест атомарно: прерванная выгрузка не оставляет его недописанным."""
+    path = os.path.join(table_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _partition_dir(table_dir, report_date):
+    # Раскладка в стиле Hive (report_date=YYYY-MM-DD) понятна pyarrow.dataset, pandas, DuckDB и Spark
+    return os.path.join(table_dir, f"report_date={report_date}")
+
+
+def _date_filter(date_from, date_to):
+    conditions = []
+    params = {}
+    if date_from:
+        conditions.append(sql.SQL("report_date >= %(date_from)s"))
+        params['date_from'] = date_from
+    if date_to:
+        conditions.append(sql.SQL("report_date <= %(date_to)s"))
+        params['date_to'] = date_to
+    where = sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")
+    return where, params
+
+
+def _partition_signatures(cur, table_name, date_from, date_to):
+    """
+    {report_date: (max(fetch_date), число строк, отпечаток справочников или None)} - по ним видно, какие дни
+    менялись. Для таблиц из DIMENSION_FINGERPRINTS подпись считается по представлению, иначе - по таблице фактов.
+    """
+    where, params = _date_filter(date_from, date_to)
+    fingerprint = DIMENSION_FINGERPRINTS.get(table_name)
+    if fingerprint:
+        relation = EXPORT_SOURCES[table_name]
+        fingerprint_sql = sql.SQL("md5(string_agg(DISTINCT {fingerprint}, ',' ORDER BY {fingerprint}))").format(
+            fingerprint=sql.SQL(fingerprint))
+    else:
+        relation = table_name
+        fingerprint_sql = sql.SQL("NULL")
+    cur.execute(sql.SQL("SELECT report_date, MAX(fetch_date), COUNT(*), {} FROM {}{} GROUP BY report_date").format(
+        fingerprint_sql, sql.Identifier(relation), where), params)
+    return {report_date.isoformat(): (max_fetch_date.isoformat(), rows, dimensions)
+            for report_date, max_fetch_date, rows, dimensions in cur.fetchall()}
+
+
+def _is_stale(entry, max_fetch_date, rows, dimensions):
+    """
+    Нужно ли перевыгрузить день. fetch_date - дата, а не время, поэтому строки, измененные в день прошлой
+    выгрузки уже после нее, не меняют max(fetch_date): такой день перевыгружается еще раз на следующий день.
+    """
+    return (entry is None or entry['max_fetch_date'] != max_fetch_date or entry['rows'] != rows
+            or entry.get('dimensions') != dimensions or max_fetch_date >= entry['exported_on'])
+
+
+def export_table(table_name, output_dir=None, date_from=None, date_to=None, full=False):
+    """
+    Выгружает таблицу фактов (или ее период [date_from, date_to]) в Parquet по файлу на report_date:
+    <output_dir>/<table_name>/report_date=YYYY-MM-DD/part-0.parquet. Строки читаются серверным курсором
+    пачками по config.EXPORT_BATCH_ROWS, поэтому память не зависит от размера таблицы.
+    Выгрузка инкрементальная: перезаписываются только дни, у которых с прошлой выгрузки изменились
+    max(fetch_date), число строк или расшифровка справочников (full=True - все дни); дни, которых больше нет
+    в БД, удаляются.
+    Возвращает (записано дней, записано строк, удалено дней) или None при ошибке.
+    """
+    output_dir = output_dir or config.EXPORT_DIR
+    table_dir = os.path.join(output_dir, table_name)
+    os.makedirs(table_dir, exist_ok=True)
+    manifest = _load_manifest(table_dir)
+    today = date.today().isoformat()
+    written_partitions = written_rows = 0
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                signatures = _partition_signatures(cur, table_name, date_from, date_to)
+            stale_dates = sorted(report_date for report_date, signature in signatures.items()
+                                 if full or _is_stale(manifest.get(report_date), *signature))
+            removed_dates = [report_date for report_date in manifest if report_date not in signatures
+                             and (not date_from or report_date >= date_from.isoformat())
+                             and (not date_to or report_date <= date_to.isoformat())]
+            for report_date in removed_dates:
+                shutil.rmtree(_partition_dir(table_dir, report_date), ignore_errors=True)
+                del manifest[report_date]
+            if removed_dates:
+                _save_manifest(table_dir, manifest)
+            logger.info(f"Export {table_name}: {len(stale_dates)} of {len(signatures)} day(s) changed, "
+                        f"{len(removed_dates)} removed.")
+            if not stale_dates:
+                conn.rollback()
+                return 0, 0, len(removed_dates)
+
+            # Именованный курсор - серверный: строки приходят пачками по мере чтения
+            with conn.cursor(name=f"export_{table_name}") as cur:
+                cur.itersize = config.EXPORT_BATCH_ROWS
+                cur.execute(sql.SQL("SELECT * FROM {} WHERE report_date = ANY(%s::date[]) ORDER BY report_date").format(
+                    sql.Identifier(EXPORT_SOURCES[table_name])), (stale_dates,))
+                writer = schema = None
+                current_date = None
+
+                def partition_path():
+                    return os.path.join(_partition_dir(table_dir, current_date), "part-0.parquet")
+
+                def finish_partition():
+                    # Файл пишется рядом и подменяет старый, только когда день выгружен целиком
+                    writer.close()
+                    os.replace(partition_path() + '.tmp', partition_path())
+                    # В манифест - подпись дня, с которой сравнивается следующая выгрузка
+                    max_fetch_date, signature_rows, dimensions = signatures[current_date]
+                    manifest[current_date] = {'max_fetch_date': max_fetch_date, 'rows': signature_rows,
+                                              'dimensions': dimensions, 'exported_on': today}
+                    _save_manifest(table_dir, manifest)
+
+                try:
+                    while True:
+                        rows = cur.fetchmany(config.EXPORT_BATCH_ROWS)
+                        if not rows:
+                            break
+                        if schema is None:
+                            date_index = [column.name for column in cur.description].index('report_date')
+                            column_indexes = [index for index in range(len(cur.description)) if index != date_index]
+                            schema = _arrow_schema(cur.description, 'report_date')
+                        for report_date, day_rows in itertools.groupby(rows, key=lambda row: row[date_index]):
+                            report_date = report_date.isoformat()
+                            if report_date != current_date:
+                                if writer is not None:
+                                    finish_partition()
+                                    writer = None
+                                    written_partitions += 1
+                                current_date = report_date
+                                os.makedirs(_partition_dir(table_dir, current_date), exist_ok=True)
+                                writer = pq.ParquetWriter(partition_path() + '.tmp', schema,
+                                                          compression=config.EXPORT_PARQUET_COMPRESSION)
+                            day_rows = list(day_rows)
+                            writer.write_batch(_to_record_batch(day_rows, column_indexes, schema))
+                            written_rows += len(day_rows)
+                    if writer is not None:
+                        finish_partition()
+                        writer = None
+                        written_partitions += 1
+                finally:
+                    # Ошибка посреди дня: недописанный файл закрывается и удаляется, прежний файл дня остается
+                    if writer is not None:
+                        writer.close()
+                        try:
+                            os.remove(partition_path() + '.tmp')
+                        except FileNotFoundError:
+                            pass
+            conn.rollback()
+        logger.info(f"Export {table_name}: {written_partitions} day(s), {written_rows} row(s) written "
+                    f"to {table_dir}.")
+        return written_partitions, written_rows, len(removed_dates)
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error exporting {table_name} to Parquet: {repr(error)}")
+        return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=config.LOG_LEVEL.upper(),
+        format='%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(funcName)s - %(lineno)d - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
+    parser = argparse.ArgumentParser(description="Выгрузка таблиц фактов в Parquet, по файлу на report_date")
+    parser.add_argument('--tables', default=','.join(EXPORT_SOURCES),
+                        help="таблицы через запятую (по умолчанию все)")
+    parser.add_argument('--from', dest='date_from', help="начало периода YYYY-MM-DD")
+    parser.add_argument('--to', dest='date_to', help="конец периода YYYY-MM-DD")
+    parser.add_argument('--output', default=config.EXPORT_DIR, help="каталог выгрузки")
+    parser.add_argument('--full', action='store_true', help="перевыгрузить все дни, а не только изменившиеся")
+    args = parser.parse_args()
+
+    tables = [table.strip() for table in args.tables.split(',') if table.strip()]
+    unknown = [table for table in tables if table not in EXPORT_SOURCES]
+    if unknown:
+        parser.error(f"unknown table(s): {', '.join(unknown)}")
+    export_from = datetime.strptime(args.date_from, '%Y-%m-%d').date() if args.date_from else None
+    export_to = datetime.strptime(args.date_to, '%Y-%m-%d').date() if args.date_to else None
+
+    failed = [table for table in tables
+              if export_table(table, args.output, export_from, export_to, full=args.full) is None]
+    if failed:
+        logger.error(f"Parquet export failed for: {', '.join(failed)}")
+        exit(1)
+    logger.info("export_parquet.py finished.")
@@ -0,0 +1,151 @@
+# http_cache.py
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import date, datetime
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Персистентный кэш JSON-ответов API в локальном файле SQLite.
+    Тела ответов хранятся сжатыми (zlib); при превышении max_bytes вытесняются записи,
+    к которым дольше всего не обращались (LRU). Ведет счетчики попаданий и промахов.
+    """
+
+    def __init__(self, path, max_bytes):
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL, -- NULL: запись не устаревает
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access_idx ON responses (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(method, url, params):
+        """Ключ кэша: хэш метода, URL и параметров запроса (порядок ключей в params не важен)."""
+        raw_key = json.dumps([method.upper(), url, params], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Возвращает сохраненный ответ или None, если его нет или он устарел."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT body, size, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            body, size, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._total_bytes -= size
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(body).decode('utf-8'))
+
+    def set(self, key, value, ttl):
+        """Сохраняет ответ. ttl=None - бессрочно, ttl<=0 - не кэшировать."""
+        if ttl is not None and ttl <= 0:
+            return
+        body = zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, body, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, body, len(body), expires_at, now)
+            )
+            self._total_bytes += len(body) - (previous[0] if previous else 0)
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._total_bytes -= size
+            evicted += 1
+        logger.info(f"HTTP cache evicted {evicted} least recently used entries "
+                    f"({self._total_bytes} bytes remain, limit {self.max_bytes}).")
+
+    def stats(self):
+        """Счетчики кэша для логов и метрик."""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self._total_bytes}
+
+
+def ttl_for_dates(source, dates):
+    """
+    TTL ответа по самой поздней дате запроса и политике источника ('metrika' / 'topvisor'):
+    данные старше immutable_after_days дней считаются неизменными (None - бессрочно),
+    более свежие живут recent_ttl секунд. Даты внутри config.DAILY_GAP_LOOKBACK_DAYS ежедневная задача
+    еще может перезапросить (пустые недавние дни не отмечаются загруженными), поэтому они тоже считаются свежими:
+    иначе закэшированный пустой ответ скрыл бы поздние данные. Если дату разобрать нельзя, ответ считается свежим.
+    """
+    immutable_after_days, recent_ttl = config.HTTP_CACHE_POLICIES[source]
+    immutable_after_days = max(immutable_after_days, config.DAILY_GAP_LOOKBACK_DAYS + 1)
+    latest = None
+    for value in dates:
+        try:
+            parsed = value if isinstance(value, date) else datetime.strptime(str(value), '%Y-%m-%d').date()
+        except ValueError:
+            return recent_ttl
+        latest = parsed if latest is None or parsed > latest else latest
+    if latest is None:
+        return recent_ttl
+    if (date.today() - latest).days >= immutable_after_days:
+        return None
+    return recent_ttl
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Общий кэш ответов или None, если кэш выключен (HTTP_CACHE_ENABLED)."""
+    global _cache
+    if not config.HTTP_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache(config.HTTP_CACHE_PATH, config.HTTP_CACHE_MAX_BYTES)
+                logger.info(f"HTTP response cache opened at {config.HTTP_CACHE_PATH}.")
+    return _cache
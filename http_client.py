@@ -0,0 +1,134 @@
+# http_client.py
+import http.cookiejar
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import etl_metrics
+
+logger = logging.getLogger(__name__)
+
+# Ответы, после которых запрос имеет смысл повторить; 429 и 503 к тому же означают, что мы слишком частим
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+THROTTLE_STATUS_CODES = frozenset({429, 503})
+
+
+def create_session(headers, pool_size):
+    """
+    Создает keep-alive сессию с пулом соединений на pool_size соединений к одному хосту,
+    сжатием ответов (gzip) и заранее собранными заголовками.
+    Cookie не сохраняются, поэтому состояние сессии после создания не меняется и ее можно
+    безопасно использовать из нескольких потоков одновременно.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    session.headers.update(headers)
+    return session
+
+
+class SharedSession:
+    """Лениво создаваемая общая для всех потоков модуля сессия (см. create_session)."""
+
+    def __init__(self, name, headers_factory, pool_size):
+        self._name = name
+        self._headers_factory = headers_factory
+        self._pool_size = pool_size
+        self._session = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = create_session(self._headers_factory(), self._pool_size)
+                    logger.info(f"HTTP session for {self._name} created (pool size {self._pool_size}).")
+        return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+def parse_retry_after(value):
+    """Заголовок Retry-After (секунды или HTTP-дата) в секундах ожидания; None, если его нет или он не разобран."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), config.HTTP_RETRY_AFTER_MAX_SECONDS)
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Экспоненциальная пауза перед повтором с полным джиттером: случайное значение от 0 до min(cap, base * 2^(attempt-1))."""
+    base = config.HTTP_BACKOFF_BASE_SECONDS if base is None else base
+    cap = config.HTTP_BACKOFF_MAX_SECONDS if cap is None else cap
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def send_with_retries(send, rate_limiter, description, max_retries=None, stream=False):
+    """
+    Выполняет send() (один HTTP-запрос, возвращает requests.Response), дождавшись rate_limiter
+    (rate_limiter.AdaptiveTokenBucket), и повторяет его при 429/5xx, таймаутах и обрывах соединения.
+    Пауза перед повтором берется из Retry-After, иначе - экспоненциальная с джиттером (backoff_delay).
+    Успешные ответы повышают частоту лимитера, троттлинг снижает ее.
+    Возвращает последний ответ (статус проверяет вызывающий) или пробрасывает последнее сетевое исключение.
+    Ожидание (лимит и паузы) и передача учитываются в etl_metrics отдельно: http_sleep_seconds и http_seconds.
+    stream=True - тело успешного ответа не читается (потоковая загрузка), его объем учитывает вызывающий.
+    """
+    max_retries = config.HTTP_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        attempt += 1
+        etl_metrics.add('http_sleep_seconds', rate_limiter.acquire())
+        etl_metrics.add('http_requests')
+        started = time.monotonic()
+        retry_after = None
+        try:
+            response = send()
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if attempt > max_retries:
+                raise
+            if isinstance(e, requests.exceptions.Timeout):
+                rate_limiter.on_throttle()
+            reason = repr(e)
+        else:
+            if not stream or response.status_code in RETRY_STATUS_CODES:
+                etl_metrics.add('http_bytes', len(response.content))
+            if response.status_code not in RETRY_STATUS_CODES:
+                if response.ok:
+                    rate_limiter.on_success()
+                return response
+            if response.status_code in THROTTLE_STATUS_CODES:
+                etl_metrics.add('http_throttled')
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                rate_limiter.on_throttle(retry_after)
+            if attempt > max_retries:
+                return response
+            reason = f"HTTP {response.status_code}"
+        finally:
+            etl_metrics.add('http_seconds', time.monotonic() - started)
+
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        logger.warning(f"{description} failed ({reason}), attempt {attempt} of {max_retries + 1}; "
+                       f"retrying in {delay:.1f}s.")
+        etl_metrics.add('http_retries')
+        etl_metrics.add('http_sleep_seconds', delay)
+        time.sleep(delay)
@@ -0,0 +1,190 @@
+# job_graph.py
+import contextvars
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Итог задачи: status - 'success', 'failed', 'timeout' или 'skipped' (не выполнялась из-за зависимости);
+# duration_seconds - от первого запуска до завершения, включая повторы
+JobResult = namedtuple('JobResult', 'name status attempts started_at duration_seconds error')
+
+# Задачи, чьи потоки превысили таймаут и еще работают: имя -> Future попытки. Общий на процесс,
+# чтобы следующий граф (например, следующий запуск по расписанию) не запустил ту же задачу параллельно
+_orphaned = {}
+_orphaned_lock = threading.Lock()
+
+
+def _orphan(name, future):
+    """Запоминает поток задачи, превысившей таймаут, до его фактического завершения."""
+    def release(_):
+        with _orphaned_lock:
+            if _orphaned.get(name) is future:
+                del _orphaned[name]
+            logger.info(f"Timed-out job '{name}' has finally finished in the background.")
+
+    with _orphaned_lock:
+        _orphaned[name] = future
+    future.add_done_callback(release)
+
+
+def still_running(name):
+    """True, если поток прошлой попытки задачи name превысил таймаут и еще не завершился."""
+    with _orphaned_lock:
+        return name in _orphaned
+
+
+class Job:
+    """
+    Узел графа задач: func() без аргументов и имена задач, после успеха которых ее можно запускать.
+    timeout - ограничение одной попытки в секундах (None или 0 - без ограничения),
+    retries - число повторов после ошибки, retry_delay - пауза перед повтором.
+    Задача считается неудачной, если func выбросила исключение или вернула False.
+    """
+
+    def __init__(self, name, func, depends_on=(), timeout=None, retries=0, retry_delay=0):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout or None
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+
+def _check_graph(jobs):
+    """Проверяет имена и зависимости; возвращает {имя: Job}. Циклы и неизвестные зависимости - ValueError."""
+    jobs_by_name = {}
+    for job in jobs:
+        if job.name in jobs_by_name:
+            raise ValueError(f"Duplicate job name '{job.name}'")
+        jobs_by_name[job.name] = job
+    for job in jobs:
+        unknown = [name for name in job.depends_on if name not in jobs_by_name]
+        if unknown:
+            raise ValueError(f"Job '{job.name}' depends on unknown job(s): {', '.join(unknown)}")
+
+    # Топологическая сортировка: если какие-то задачи в нее не попали, они образуют цикл
+    remaining = {job.name: set(job.depends_on) for job in jobs}
+    while True:
+        free = [name for name, deps in remaining.items() if not deps]
+        if not free:
+            break
+        for name in free:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(free)
+    if remaining:
+        raise ValueError(f"Dependency cycle between jobs: {', '.join(sorted(remaining))}")
+    return jobs_by_name
+
+
+def _start(job, context):
+    """Запускает попытку задачи в отдельном потоке (в копии context); возвращает Future с ее результатом."""
+    future = Future()
+
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.copy().run(job.func))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, name=f"job-{job.name}", daemon=True).start()
+    return future
+
+
+def run_job_graph(jobs, max_workers):
+    """
+    Выполняет задачи графа, не больше max_workers одновременно: задача стартует, как только успешно
+    завершились все ее зависимости, поэтому независимые задачи идут параллельно и общее время
+    близко к самой длинной цепочке, а не к сумме. Неудачная задача не прерывает остальные:
+    пропускаются только зависящие от нее. Возвращает {имя: JobResult} в порядке jobs.
+    Поток нельзя прервать извне, поэтому задача, превысившая таймаут, помечается 'timeout' без повторов,
+    а ее поток дорабатывает в фоне и не занимает место в пуле. Пока он не завершится, задача с тем же
+    именем в этом и последующих графах не запускается, а помечается 'skipped' (вместе с зависящими от нее).
+    Задачи выполняются в копии контекста вызывающего потока (contextvars), как в concurrency.ordered_map.
+    """
+    jobs_by_name = _check_graph(jobs)
+    context = contextvars.copy_context()
+    waiting = {job.name: set(job.depends_on) for job in jobs}
+    ready = {}  # имя -> time.monotonic(), раньше которого задачу не запускать (пауза перед повтором)
+    running = {}  # Future -> (имя, дедлайн попытки или None)
+    attempts = {}
+    started = {}  # имя -> (datetime, time.monotonic()) первого запуска
+    results = {}
+
+    def finish(name, status, error=None):
+        started_at, started_monotonic = started.get(name, (None, None))
+        duration = time.monotonic() - started_monotonic if started_monotonic is not None else 0.0
+        results[name] = JobResult(name, status, attempts.get(name, 0), started_at, duration, error)
+        if status == 'success':
+            logger.info(f"Job '{name}' succeeded in {duration:.1f}s (attempts: {attempts[name]}).")
+        elif status != 'skipped':
+            logger.error(f"Job '{name}' {status} after {duration:.1f}s (attempts: {attempts[name]}): {error}")
+        for dependent, deps in list(waiting.items()):
+            if name not in deps:
+                continue
+            if status == 'success':
+                deps.discard(name)
+                if not deps:
+                    del waiting[dependent]
+                    ready[dependent] = 0
+            else:
+                del waiting[dependent]
+                logger.warning(f"Job '{dependent}' skipped: dependency '{name}' {status}.")
+                finish(dependent, 'skipped', f"dependency '{name}' {status}")
+
+    for name in [name for name, deps in waiting.items() if not deps]:
+        del waiting[name]
+        ready[name] = 0
+
+    while ready or running:
+        now = time.monotonic()
+        for name, not_before in sorted(ready.items(), key=lambda item: item[1]):
+            if len(running) >= max_workers or not_before > now:
+                continue
+            del ready[name]
+            if still_running(name):
+                logger.warning(f"Job '{name}' skipped: its timed-out previous run is still in progress.")
+                finish(name, 'skipped', "timed-out previous run still in progress")
+                continue
+            job = jobs_by_name[name]
+            attempts[name] = attempts.get(name, 0) + 1
+            started.setdefault(name, (datetime.now(), now))
+            running[_start(job, context)] = (name, now + job.timeout if job.timeout else None)
+
+        # Ждем завершения любой задачи, ближайшего дедлайна или конца паузы перед повтором
+        wake_times = [deadline for _, deadline in running.values() if deadline is not None]
+        if len(running) < max_workers:
+            wake_times.extend(ready.values())
+        timeout = max(min(wake_times) - time.monotonic(), 0) if wake_times else None
+        done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            name, _ = running.pop(future)
+            job = jobs_by_name[name]
+            error = future.exception()
+            if error is None and future.result() is not False:
+                finish(name, 'success')
+                continue
+            error = repr(error) if error is not None else "job reported failure"
+            if attempts[name] <= job.retries:
+                logger.warning(f"Job '{name}' attempt {attempts[name]} failed: {error}. "
+                               f"Retrying in {job.retry_delay}s.")
+                ready[name] = time.monotonic() + job.retry_delay
+            else:
+                finish(name, 'failed', error)
+
+        now = time.monotonic()
+        for future, (name, deadline) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                del running[future]
+                _orphan(name, future)
+                finish(name, 'timeout', f"attempt exceeded {jobs_by_name[name].timeout}s")
+
+    return {job.name: results[job.name] for job in jobs}
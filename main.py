@@ -1,12 +1,25 @@
 # main.py (ФИНАЛЬНАЯ ВЕРСИЯ С ПЛАНИРОВЩИКОМ)
+import argparse
 import logging
+import threading
 import time
-from datetime import date, timedelta
+from collections import namedtuple
+from datetime import date, datetime, timedelta
 import schedule  # Импортируем библиотеку для планирования
 
+import backfill
 import config
 import db_manager
+import dimensions
+import etl_metrics
+import http_cache
+import job_graph
 import metrika_api
+import metrika_logs_api
+import migrations
+import rollups
+import schema
+import tenants
 import topvisor_api
 
 
@@ -43,204 +56,405 @@ logger = logging.getLogger(__name__)
 # КОНЕЦ ОБНОВЛЕННОГО БЛОКА
 # =================================================================
 
-# Все функции fetch_and_store_* остаются без изменений
+# Итог сохранения набора за период: db_manager.WriteResult и даты ('YYYY-MM-DD'), по которым пришли строки
+StoreResult = namedtuple('StoreResult', 'written report_dates')
 
-def fetch_and_store_all_traffic_sources(date_from, date_to):
-    """Получает данные по всем источникам трафика из Яндекс.Метрики и сохраняет их в БД."""
-    logger.info(f"Starting to fetch all traffic sources data from {date_from} to {date_to}.")
-    sources_data_list_of_dicts = metrika_api.get_traffic_sources_summary(date_from, date_to)
 
-    if not sources_data_list_of_dicts:
-        logger.warning(f"No data for all traffic sources received from Metrika API for period {date_from} - {date_to}.")
-        return
+def _metrika_source():
+    """Модуль, из которого берутся данные Метрики: API отчетов или Logs API (config.METRIKA_SOURCE)."""
+    return metrika_logs_api if config.METRIKA_SOURCE == 'logs' else metrika_api
 
-    columns_for_db = ['report_date', 'source_group', 'source_engine', 'source_detail', 'visits', 'users']
-    data_to_insert_tuples = [tuple(d.get(col) for col in columns_for_db) for d in sources_data_list_of_dicts]
 
-    if not data_to_insert_tuples:
-        logger.info("No data (all_traffic) to insert into database after transformation.")
-        return
+def _store_records(table_schema, records, date_from, date_to):
+    """
+    Потоково сохраняет записи из генератора API (типы из schema.py) в таблицу table_schema:
+    записи сбрасываются в БД пачками, пока следующие страницы еще скачиваются. Строковые значения
+    по пути заменяются суррогатными ключами справочников (dimensions.py), строки помечаются текущим тенантом.
+    Возвращает StoreResult (db_manager.WriteResult и даты, за которые пришли строки) или None,
+    если загрузка прервалась ошибкой API или БД.
+    """
+    table_name = table_schema.table_name
+    report_dates = set()
+
+    def counted(records):
+        parsed_rows = 0
+        try:
+            for record in records:
+                parsed_rows += 1
+                report_dates.add(record.report_date)
+                yield record
+        finally:
+            etl_metrics.add('parsed_rows', parsed_rows)
+
+    rows = dimensions.encode_records(table_schema, counted(records), tenants.current_id())
+    source_keys = set()
+    if table_name in dimensions.SOURCE_FACT_TABLES:
+        rows = dimensions.track_source_keys(table_schema, rows, source_keys)
+    if not db_manager.ensure_partitions(table_name, date_from, date_to):
+        return None
+    try:
+        written = db_manager.bulk_insert_stream(table_name, table_schema.columns, rows)
+    except metrika_api.MetrikaAPIError as e:
+        logger.error(f"Metrika API error while loading {table_name} for {date_from} - {date_to}: {e}")
+        return None
+    except topvisor_api.TopvisorAPIError as e:
+        logger.error(f"Topvisor API error while loading {table_name} for {date_from} - {date_to}: {e}")
+        return None
+    except dimensions.DimensionLookupError as e:
+        logger.error(f"Dimension lookup failed while loading {table_name} for {date_from} - {date_to}: {e}")
+        return None
+
+    if written is None:
+        return None
+    if written.total == 0:
+        logger.warning(f"No data received for {table_name} for period {date_from} - {date_to}.")
+    # Перезагруженные дни заменяются целиком: источники, которых в новой загрузке нет, удаляются
+    if table_name in dimensions.SOURCE_FACT_TABLES and not dimensions.purge_stale_sources(
+            table_name, tenants.current_id(), source_keys):
+        return None
+    return StoreResult(written, report_dates)
+
 
-    logger.info(
-        f"Attempting to insert {len(data_to_insert_tuples)} records (all_traffic) into metrika_traffic_sources.")
-    db_manager.bulk_insert_data('metrika_traffic_sources', columns_for_db, data_to_insert_tuples)
+def fetch_and_store_all_traffic_sources(date_from, date_to):
+    """Получает данные по всем источникам трафика из Яндекс.Метрики и сохраняет их в БД."""
+    logger.info(f"Starting to fetch all traffic sources data from {date_from} to {date_to}.")
+    written = _store_records(schema.TRAFFIC_SOURCES, _metrika_source().iter_traffic_sources(date_from, date_to),
+                             date_from, date_to)
     logger.info(f"Finished fetching and storing all traffic sources data for {date_from} - {date_to}.")
+    return written
 
 
 def fetch_and_store_behavior_data(date_from, date_to):
     """Получает сводные поведенческие данные из Яндекс.Метрики и сохраняет их в БД."""
     logger.info(f"Starting to fetch behavior summary data from {date_from} to {date_to}.")
-    behavior_data_list_of_dicts = metrika_api.get_behavior_summary(date_from, date_to)
-
-    if not behavior_data_list_of_dicts:
-        logger.warning(f"No behavior summary data received from Metrika API for period {date_from} - {date_to}.")
-        return
-
-    columns_for_db = ['report_date', 'bounces', 'bounce_rate', 'page_depth', 'avg_visit_duration_seconds']
-    data_to_insert_tuples = [tuple(d.get(col) for col in columns_for_db) for d in behavior_data_list_of_dicts]
-
-    if not data_to_insert_tuples:
-        logger.info("No data (behavior) to insert into database after transformation.")
-        return
-
-    logger.info(f"Attempting to insert {len(data_to_insert_tuples)} records (behavior) into metrika_behavior.")
-    db_manager.bulk_insert_data('metrika_behavior', columns_for_db, data_to_insert_tuples)
+    written = _store_records(schema.BEHAVIOR, _metrika_source().iter_behavior_summary(date_from, date_to),
+                             date_from, date_to)
     logger.info(f"Finished fetching and storing behavior summary data for {date_from} - {date_to}.")
+    return written
 
 
 def fetch_and_store_conversions_data(date_from, date_to):
     """Получает данные по конверсиям из Яндекс.Метрики и сохраняет их в БД."""
     logger.info(f"Starting to fetch conversions data from {date_from} to {date_to}.")
-    conversions_data_list_of_dicts = metrika_api.get_conversions_data(date_from, date_to)
-
-    if not conversions_data_list_of_dicts:
-        logger.warning(f"No conversions data received from Metrika API for period {date_from} - {date_to}.")
-        return
-
-    columns_for_db = ['report_date', 'goal_id', 'goal_name', 'source_engine', 'source_detail', 'reaches',
-                      'conversion_rate']
-    data_to_insert_tuples = [tuple(d.get(col) for col in columns_for_db) for d in conversions_data_list_of_dicts]
-
-    if not data_to_insert_tuples:
-        logger.info("No data (conversions) to insert into database after transformation.")
-        return
-
-    logger.info(f"Attempting to insert {len(data_to_insert_tuples)} records (conversions) into metrika_conversions.")
-    db_manager.bulk_insert_data('metrika_conversions', columns_for_db, data_to_insert_tuples)
+    dimensions.sync_goals(tenants.current().metrika_goals)
+    written = _store_records(schema.CONVERSIONS, _metrika_source().iter_conversions_data(date_from, date_to),
+                             date_from, date_to)
     logger.info(f"Finished fetching and storing conversions data for {date_from} - {date_to}.")
+    return written
 
 
 def fetch_and_store_topvisor_positions(date_from, date_to):
     """Получает историю позиций из Топвизора и сохраняет их в БД."""
     logger.info(f"Starting to fetch Topvisor positions from {date_from} to {date_to}.")
-    positions_data_list_of_dicts = topvisor_api.get_positions_history(
+    tenant = tenants.current()
+    positions_records = topvisor_api.iter_positions_history(
         date_from_str=date_from,
         date_to_str=date_to,
-        project_id=config.TOPVISOR_PROJECT_ID,
-        region_indexes=config.TOPVISOR_REGION_INDEXES,
-        searcher_ids=config.TOPVISOR_SEARCHERS
+        project_id=tenant.topvisor_project_id,
+        region_indexes=tenant.topvisor_region_indexes,
+        searcher_ids=tenant.topvisor_searchers
     )
-
-    if not positions_data_list_of_dicts:
-        logger.warning(f"No positions data received from Topvisor API for period {date_from} - {date_to}.")
-        return
-
-    columns_for_db = ['report_date', 'keyword', 'search_engine_name', 'search_engine_id', 'region_id', 'position', 'url']
-    data_to_insert_tuples = [tuple(d.get(col) for col in columns_for_db) for d in positions_data_list_of_dicts]
-
-    if not data_to_insert_tuples:
-        logger.info("No data (positions) to insert into database after transformation.")
-        return
-
-    logger.info(f"Attempting to insert {len(data_to_insert_tuples)} records (positions) into topvisor_positions.")
-    db_manager.bulk_insert_data('topvisor_positions', columns_for_db, data_to_insert_tuples)
+    written = _store_records(schema.POSITIONS, positions_records, date_from, date_to)
     logger.info(f"Finished fetching and storing Topvisor positions data for {date_from} - {date_to}.")
+    return written
 
 
 def fetch_and_store_topvisor_visibility(date_from, date_to):
     """Получает историю видимости из Топвизора и сохраняет ее в БД."""
     logger.info(f"Starting to fetch Topvisor visibility from {date_from} to {date_to}.")
-    visibility_data_list_of_dicts = topvisor_api.get_visibility_summary(
+    tenant = tenants.current()
+    visibility_records = topvisor_api.iter_visibility_summary(
         date_from_str=date_from,
         date_to_str=date_to,
-        project_id=config.TOPVISOR_PROJECT_ID,
-        region_indexes=config.TOPVISOR_REGION_INDEXES,
-        searcher_ids=config.TOPVISOR_SEARCHERS
+        project_id=tenant.topvisor_project_id,
+        region_indexes=tenant.topvisor_region_indexes,
+        searcher_ids=tenant.topvisor_searchers
     )
+    written = _store_records(schema.VISIBILITY, visibility_records, date_from, date_to)
+    logger.info(f"Finished fetching and storing Topvisor visibility data for {date_from} - {date_to}.")
+    return written
 
-    if not visibility_data_list_of_dicts:
-        logger.warning(f"No visibility data received from Topvisor API for period {date_from} - {date_to}.")
-        return
 
-    # Важно! В get_visibility_summary нет region_name, поэтому исключаем его
-    columns_for_db = ['report_date', 'search_engine_name', 'search_engine_id', 'region_id', 'visibility_score']
-    data_to_insert_tuples = [tuple(d.get(col) for col in columns_for_db) for d in visibility_data_list_of_dicts]
+# Наборы данных по секциям: имя набора в etl_load_state -> функция загрузки за период
+METRIKA_DATASETS = (
+    ('metrika_traffic_sources', fetch_and_store_all_traffic_sources),
+    ('metrika_behavior', fetch_and_store_behavior_data),
+    ('metrika_conversions', fetch_and_store_conversions_data),
+)
+TOPVISOR_DATASETS = (
+    ('topvisor_positions', fetch_and_store_topvisor_positions),
+    ('topvisor_visibility', fetch_and_store_topvisor_visibility),
+)
 
-    if not data_to_insert_tuples:
-        logger.info("No data (visibility) to insert into database after transformation.")
-        return
 
-    logger.info(f"Attempting to insert {len(data_to_insert_tuples)} records (visibility) into topvisor_visibility.")
-    db_manager.bulk_insert_data('topvisor_visibility', columns_for_db, data_to_insert_tuples)
-    logger.info(f"Finished fetching and storing Topvisor visibility data for {date_from} - {date_to}.")
+def _coalesce_date_ranges(dates):
+    """Склеивает отсортированный список дат в непрерывные диапазоны [(date_from, date_to), ...]."""
+    ranges = []
+    for day in dates:
+        if ranges and day - ranges[-1][1] == timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [(range_from, range_to) for range_from, range_to in ranges]
+
+
+def load_date_range(dataset, fetch_and_store, range_from, range_to):
+    """
+    Загружает набор данных текущего тенанта за непрерывный диапазон дат. Если загрузка прошла без ошибок,
+    даты отмечаются в etl_load_state и пересчитываются агрегаты (rollups.py) за задетые дни, недели и месяцы.
+    Свежие даты (последние config.DAILY_GAP_LOOKBACK_DAYS дней), за которые не пришло ни одной строки,
+    не отмечаются: источник мог еще не посчитать их (Топвизор снимает позиции в течение дня),
+    и следующий запуск запросит их снова. Возвращает успех загрузки.
+    """
+    tenant_id = tenants.current_id()
+    with etl_metrics.stage(dataset):
+        stored = fetch_and_store(range_from.strftime('%Y-%m-%d'), range_to.strftime('%Y-%m-%d'))
+    if stored is None:
+        logger.warning(f"{tenant_id}/{dataset}: load for {range_from} - {range_to} failed; dates stay pending.")
+        with etl_metrics.stage(dataset):
+            etl_metrics.add('failed_loads')
+        return False
+    settled_before = date.today() - timedelta(days=config.DAILY_GAP_LOOKBACK_DAYS)
+    range_dates = [range_from + timedelta(days=offset) for offset in range((range_to - range_from).days + 1)]
+    empty_dates = [day for day in range_dates
+                   if day >= settled_before and day.strftime('%Y-%m-%d') not in stored.report_dates]
+    if empty_dates:
+        logger.warning(f"{tenant_id}/{dataset}: no rows for {len(empty_dates)} recent date(s) "
+                       f"({', '.join(map(str, empty_dates))}); they stay pending.")
+    db_manager.mark_dates_completed(tenant_id, dataset, [day for day in range_dates if day not in empty_dates])
+    # Агрегаты пересчитываются только за задетые периоды; если пересчет не удался, данные остаются
+    # загруженными, а агрегаты догонит следующая загрузка этих периодов или `python rollups.py`
+    rollups.refresh_rollups(dataset, range_from, range_to, tenant_id)
+    return True
+
+
+def load_missing_dates(dataset, fetch_and_store, date_from, date_to, refresh_from=None):
+    """
+    Загружает набор данных текущего тенанта только за те даты периода, которые еще не отмечены в etl_load_state.
+    Даты начиная с refresh_from загружаются заново в любом случае (поздние пересчеты источника).
+    Соседние пропуски склеиваются в диапазоны, и на каждый диапазон делается одна загрузка (load_date_range).
+    Возвращает False, если хотя бы один диапазон не загрузился.
+    """
+    tenant_id = tenants.current_id()
+    all_dates = [date_from + timedelta(days=offset) for offset in range((date_to - date_from).days + 1)]
+    completed_dates = db_manager.get_completed_dates(tenant_id, dataset, date_from, date_to)
+    missing_dates = [day for day in all_dates
+                     if day not in completed_dates or (refresh_from is not None and day >= refresh_from)]
+    if not missing_dates:
+        logger.info(f"{tenant_id}/{dataset}: all {len(all_dates)} dates between {date_from} and {date_to} are already loaded.")
+        return True
+
+    missing_ranges = _coalesce_date_ranges(missing_dates)
+    logger.info(f"{tenant_id}/{dataset}: {len(missing_dates)} of {len(all_dates)} dates missing in "
+                f"{len(missing_ranges)} range(s): "
+                + ", ".join(f"{range_from}..{range_to}" for range_from, range_to in missing_ranges))
+
+    all_loaded = True
+    for range_from, range_to in missing_ranges:
+        if not load_date_range(dataset, fetch_and_store, range_from, range_to):
+            all_loaded = False
+    return all_loaded
+
+
+def _configured_datasets(tenant):
+    """Наборы данных (секция, имя, функция загрузки), для которых у тенанта заданы доступы."""
+    datasets = []
+    # --- Секция Метрики ---
+    if tenant.metrika_token and tenant.metrika_counter_id:
+        datasets.extend(('metrika', dataset, fetch_and_store) for dataset, fetch_and_store in METRIKA_DATASETS)
+    else:
+        logger.warning(f"{tenant.tenant_id}: Metrika API token or counter ID not configured. Skipping Metrika data.")
+
+    # --- Секция Топвизора ---
+    if tenant.topvisor_api_key and tenant.topvisor_project_id:
+        datasets.extend(('topvisor', dataset, fetch_and_store) for dataset, fetch_and_store in TOPVISOR_DATASETS)
+    else:
+        logger.warning(f"{tenant.tenant_id}: Topvisor configuration is incomplete. Skipping Topvisor data.")
+    return datasets
+
+
+def _dataset_job(tenant, dataset, fetch_and_store, date_from, date_to, refresh_from=None):
+    """Задача графа: догрузка одного набора данных тенанта."""
+    def run():
+        with tenants.use(tenant):
+            return load_missing_dates(dataset, fetch_and_store, date_from, date_to, refresh_from=refresh_from)
+
+    return job_graph.Job(f"{tenant.tenant_id}:{dataset}", run, depends_on=('partitions',),
+                         timeout=config.JOB_TIMEOUT_SECONDS, retries=config.JOB_RETRIES,
+                         retry_delay=config.JOB_RETRY_DELAY_SECONDS)
+
+
+def _build_load_jobs(tenant_list, date_from, date_to, metrika_refresh_from=None):
+    """
+    Граф загрузки: сначала партиции, затем наборы данных всех тенантов. Наборы не зависят друг от друга
+    (Метрика и Топвизор - разные API), поэтому выполняются параллельно.
+    """
+    jobs = [job_graph.Job('partitions', db_manager.maintain_partitions, timeout=config.JOB_TIMEOUT_SECONDS)]
+    for tenant in tenant_list:
+        for section, dataset, fetch_and_store in _configured_datasets(tenant):
+            # Метрика уточняет последние дни задним числом, их перечитываем
+            refresh_from = metrika_refresh_from if section == 'metrika' else None
+            jobs.append(_dataset_job(tenant, dataset, fetch_and_store, date_from, date_to, refresh_from=refresh_from))
+    return jobs
+
+
+def _run_incremental_load(date_from, date_to, metrika_refresh_from=None):
+    """
+    Догружает пропущенные даты периода по всем наборам данных всех тенантов (tenants.py) через граф задач
+    (job_graph.py), не больше config.JOB_MAX_WORKERS задач одновременно. Лимиты API общие на процесс.
+    Даты Метрики начиная с metrika_refresh_from перезагружаются, чтобы подтянуть ее поздние пересчеты.
+    """
+    tenant_list = tenants.load_tenants()
+    jobs = _build_load_jobs(tenant_list, date_from, date_to, metrika_refresh_from=metrika_refresh_from)
+    results = job_graph.run_job_graph(jobs, max_workers=config.JOB_MAX_WORKERS)
+    for job_result in results.values():
+        # Неудачная задача не прерывает остальные, но запуск получает статус partial
+        etl_metrics.record_job(job_result)
+    succeeded = sum(1 for job_result in results.values() if job_result.status == 'success')
+    logger.info(f"{succeeded} of {len(results)} job(s) succeeded for {len(tenant_list)} tenant(s).")
+
+    cache = http_cache.get_response_cache()
+    if cache is not None:
+        logger.info(f"HTTP response cache stats: {cache.stats()}")
 
 
 # ================== НОВЫЙ БЛОК: ФУНКЦИЯ-ЗАДАЧА ДЛЯ ПЛАНИРОВЩИКА ==================
 def run_daily_job():
     """
     Основная задача, которая запускается планировщиком.
-    Собирает данные за "вчера".
+    Собирает данные за "вчера" и заодно закрывает пропуски за последние config.DAILY_GAP_LOOKBACK_DAYS дней.
     """
     logger.info("================== Starting scheduled daily job ==================")
+    etl_run = etl_metrics.EtlRun('daily_job')
     try:
-        # Устанавливаем даты для сбора данных за "вчера"
-        yesterday = (date.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-        date_from = yesterday
-        date_to = yesterday
-
-        logger.info(f"Data will be fetched for the date: {date_from}")
-
-        # --- Секция Метрики ---
-        if config.METRIKA_TOKEN and config.METRIKA_COUNTER_ID:
-            fetch_and_store_all_traffic_sources(date_from, date_to)
-            fetch_and_store_behavior_data(date_from, date_to)
-            fetch_and_store_conversions_data(date_from, date_to)
-            logger.info("Metrika data fetching section finished.")
-        else:
-            logger.warning("Metrika API token or counter ID not configured. Skipping Metrika data.")
+        # Фоновая историческая догрузка на это время встает на паузу
+        with etl_run, backfill.foreground():
+            # Данные всегда доступны до "вчера" включительно
+            date_to = date.today() - timedelta(days=1)
+            date_from = date_to - timedelta(days=max(config.DAILY_GAP_LOOKBACK_DAYS - 1, 0))
 
-        # --- Секция Топвизора ---
-        if config.TOPVISOR_API_KEY and config.TOPVISOR_PROJECT_ID:
-            fetch_and_store_topvisor_positions(date_from, date_to)
-            fetch_and_store_topvisor_visibility(date_from, date_to)
-            logger.info("Topvisor data fetching section finished.")
-        else:
-            logger.warning("Topvisor configuration is incomplete. Skipping Topvisor data.")
+            # Последние config.METRIKA_REVISION_DAYS дней Метрики перечитываем: она уточняет их задним числом
+            metrika_refresh_from = None
+            if config.METRIKA_REVISION_DAYS > 0:
+                metrika_refresh_from = date_to - timedelta(days=config.METRIKA_REVISION_DAYS - 1)
+
+            logger.info(f"Missing data will be fetched for the period: {date_from} to {date_to}")
+            _run_incremental_load(date_from, date_to, metrika_refresh_from=metrika_refresh_from)
 
     except Exception as e:
         logger.error(f"An error occurred during the daily job: {e}", exc_info=True)
+    db_manager.save_etl_run(etl_run)
 
     logger.info("================== Scheduled daily job finished ==================")
 
 
-
-def run_historical_load(days_to_load):
+def run_backfill(date_from, date_to, job_name='backfill', background=False):
     """
-    Выполняет разовую загрузку данных за указанное количество прошедших дней.
+    Догружает период любой длины окнами (backfill.py) по всем тенантам и наборам данных.
+    Загруженные окна отмечаются в etl_load_state, поэтому прерванная догрузка при повторном запуске
+    продолжается с места остановки. С background=True грузит не больше config.HISTORICAL_LOAD_MAX_WORKERS
+    окон одновременно и уступает ежедневной задаче.
     """
-    logger.info(f"================== Starting HISTORICAL data load for the last {days_to_load} days ==================")
+    logger.info(f"================== Starting {job_name} for {date_from} - {date_to} ==================")
+    etl_run = etl_metrics.EtlRun(job_name)
     try:
-        # Устанавливаем даты для сбора исторических данных
-        today = date.today()
-        # Данные всегда доступны до "вчера" включительно
-        date_to = (today - timedelta(days=1)).strftime('%Y-%m-%d')
-        date_from = (today - timedelta(days=days_to_load)).strftime('%Y-%m-%d')
-
-        logger.info(f"Historical data will be fetched for the period: {date_from} to {date_to}")
-
-        # --- Секция Метрики ---
-        if config.METRIKA_TOKEN and config.METRIKA_COUNTER_ID:
-            fetch_and_store_all_traffic_sources(date_from, date_to)
-            fetch_and_store_behavior_data(date_from, date_to)
-            fetch_and_store_conversions_data(date_from, date_to)
-        else:
-            logger.warning("Metrika configuration is incomplete. Skipping Metrika historical load.")
-
-        # --- Секция Топвизора ---
-        if config.TOPVISOR_API_KEY and config.TOPVISOR_PROJECT_ID:
-            fetch_and_store_topvisor_positions(date_from, date_to)
-            fetch_and_store_topvisor_visibility(date_from, date_to)
-        else:
-            logger.warning("Topvisor configuration is incomplete. Skipping Topvisor historical load.")
+        with etl_run:
+            tasks = [(tenant, dataset, fetch_and_store) for tenant in tenants.load_tenants()
+                     for _, dataset, fetch_and_store in _configured_datasets(tenant)]
+            max_workers = config.HISTORICAL_LOAD_MAX_WORKERS if background else None
+            backfill.run_backfill(tasks, date_from, date_to, load_date_range, max_workers=max_workers,
+                                  background=background)
 
     except Exception as e:
-        logger.error(f"An error occurred during the historical data load: {e}", exc_info=True)
+        logger.error(f"An error occurred during {job_name}: {e}", exc_info=True)
+    db_manager.save_etl_run(etl_run)
+
+    logger.info(f"================== {job_name} finished ==================")
+
+
+def run_historical_load(days_to_load, background=False):
+    """
+    Догружает данные за указанное количество прошедших дней: запрашиваются только даты,
+    которых еще нет в etl_load_state, поэтому повторный запуск почти ничего не стоит.
+    """
+    # Данные всегда доступны до "вчера" включительно
+    today = date.today()
+    run_backfill(today - timedelta(days=days_to_load), today - timedelta(days=1), job_name='historical_load',
+                 background=background)
+
+
+def start_background_historical_load(days_to_load, delay_seconds):
+    """
+    Запускает историческую догрузку в фоновом потоке через delay_seconds секунд, чтобы старт сервиса
+    не ждал ее: планировщик и ежедневная задача работают сразу, а догрузка уступает им (backfill.foreground).
+    """
+    def target():
+        time.sleep(delay_seconds)
+        try:
+            run_historical_load(days_to_load, background=True)
+        except Exception as e:
+            logger.error(f"Background historical load failed: {e}", exc_info=True)
+
+    thread = threading.Thread(target=target, name="historical-load", daemon=True)
+    thread.start()
+    logger.info(f"Historical load for the last {days_to_load} days will start in the background "
+                f"in {delay_seconds:g}s.")
+    return thread
+
+
+_daily_job_lock = threading.Lock()
+
+
+def start_daily_job(refresh_categories=False):
+    """
+    Запускает run_daily_job в фоновом потоке, чтобы цикл планировщика не ждал загрузку. Если предыдущий
+    запуск еще идет, новый пропускается. С refresh_categories=True перед загрузкой применяет правила
+    категоризации источников (refresh_source_categories) - так делается первый запуск при старте сервиса.
+    """
+    if not _daily_job_lock.acquire(blocking=False):
+        logger.warning("Daily job is still running, this run is skipped.")
+        return None
+
+    def target():
+        try:
+            if refresh_categories:
+                refresh_source_categories()
+            run_daily_job()
+        except Exception as e:
+            logger.error(f"Daily job failed: {e}", exc_info=True)
+        finally:
+            _daily_job_lock.release()
+
+    thread = threading.Thread(target=target, name="daily-job", daemon=True)
+    thread.start()
+    return thread
+
+
+def prepare_database():
+    """Приводит схему БД к актуальной версии (migrations.py); возвращает True, если это удалось."""
+    logger.info("Checking database schema version...")
+    return migrations.apply_migrations()
+
+
+def refresh_source_categories():
+    """
+    Применяет текущие правила категоризации источников к dim_sources и пересчитывает агрегаты
+    за периоды, где встречаются перекатегоризированные источники.
+    """
+    affected = dimensions.sync_source_categories()
+    for table_name, tenant_id, date_from, date_to in affected or ():
+        logger.info(f"Rebuilding rollups of {tenant_id}/{table_name} for {date_from} - {date_to} "
+                    f"after a source category change.")
+        rollups.refresh_rollups(table_name, date_from, date_to, tenant_id)
 
-    logger.info("================== HISTORICAL data load finished ==================")
 
 # ================== ОБНОВЛЕННЫЙ БЛОК: ОСНОВНАЯ ЛОГИКА ЗАПУСКА И ПЛАНИРОВАНИЯ ==================
 if __name__ == '__main__':
-    logger.info("Script started as a service.")
+    parser = argparse.ArgumentParser(description="Загрузка данных Метрики и Топвизора (по умолчанию - сервис с расписанием)")
+    parser.add_argument('--backfill', nargs=2, metavar=('DATE_FROM', 'DATE_TO'),
+                        help="однократно догрузить период YYYY-MM-DD YYYY-MM-DD и выйти")
+    args = parser.parse_args()
+    logger.info("Script started as a service." if not args.backfill else "Script started for a one-off backfill.")
 
     try:
         config.check_config()
@@ -248,22 +462,35 @@ if __name__ == '__main__':
         logger.error(f"Configuration check failed: {e}. Aborting.")
         exit(1)
 
-    logger.info("Checking and creating database tables if they don't exist...")
-    db_manager.create_tables_if_not_exist()
+    # Метрики загрузок в формате Prometheus: http://<host>:METRICS_PORT/metrics
+    etl_metrics.start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
 
-    # --- ШАГ 1: ИСТОРИЧЕСКАЯ ЗАГРУЗКА ---
-    # Выполняем загрузку данных за последние 30 дней.
-    run_historical_load(days_to_load=60)
+    if not prepare_database():
+        logger.error("Database schema migration failed. Aborting.")
+        exit(1)
+    db_manager.maintain_partitions()
 
-    # --- ШАГ 2: ЗАГРУЗКА ЗА ВЧЕРА И ЗАПУСК ПЛАНИРОВЩИКА ---
-    # Запускаем ежедневную задачу сразу, чтобы гарантировать наличие самых свежих (вчерашних) данных
-    logger.info("Running daily job for yesterday to ensure the latest data is present...")
-    run_daily_job()
+    if args.backfill:
+        refresh_source_categories()
+        backfill_from, backfill_to = (datetime.strptime(value, '%Y-%m-%d').date() for value in args.backfill)
+        run_backfill(backfill_from, backfill_to)
+        exit(0)
 
-    # Настраиваем расписание на будущее
-    schedule.every().day.at("03:00").do(run_daily_job)
+    # --- ШАГ 1: ПЛАНИРОВЩИК ---
+    # Расписание настраиваем сразу, чтобы перезапуск незадолго до 03:00 не пропустил ночную загрузку
+    schedule.every().day.at("03:00").do(start_daily_job)
     logger.info(f"Job scheduled to run every day at 03:00. Next run is at: {schedule.next_run}")
 
+    # --- ШАГ 2: ИСТОРИЧЕСКАЯ ЗАГРУЗКА В ФОНЕ ---
+    # Догружаем только недостающие даты за последние config.HISTORICAL_LOAD_DAYS дней, не задерживая старт.
+    start_background_historical_load(config.HISTORICAL_LOAD_DAYS, config.HISTORICAL_LOAD_DELAY_SECONDS)
+
+    # --- ШАГ 3: ЗАГРУЗКА ЗА ВЧЕРА ---
+    # Запускаем ежедневную задачу сразу, чтобы гарантировать наличие самых свежих (вчерашних) данных;
+    # она идет в своем потоке (вместе с пересчетом категорий источников), и планировщик работает с первых секунд
+    logger.info("Starting daily job for yesterday to ensure the latest data is present...")
+    start_daily_job(refresh_categories=True)
+
     # Основной цикл, который поддерживает работу скрипта
     while True:
         schedule.run_pending()
@@ -1,32 +1,55 @@
 # metrika_api.py (ФИНАЛЬНАЯ ИСПРАВЛЕННАЯ ВЕРСИЯ)
 import requests
 import logging
-from datetime import date, timedelta, datetime
-import time
+import threading
 import config  # Наш модуль конфигурации
+import etl_metrics
+import tenants
+from concurrency import ordered_map
+from http_cache import get_response_cache, ttl_for_dates
+from http_client import SharedSession, send_with_retries
+from rate_limiter import AdaptiveTokenBucket
+from schema import BehaviorRecord, ConversionRecord, TrafficSourceRecord
 
 logger = logging.getLogger(__name__)
 
-# Константы для API Метрики
+# Константы для API Метрики; токен и счетчик берутся у текущего тенанта (tenants.current())
 METRIKA_API_URL = config.METRIKA_API_URL
-TOKEN = config.METRIKA_TOKEN
-COUNTER_ID = config.METRIKA_COUNTER_ID
 
+# Единый для всех потоков и тенантов лимит частоты запросов к API Метрики (вместо фиксированных пауз);
+# он сам поднимается до METRIKA_RATE_LIMIT_MAX_RPS, пока API не начнет отвечать 429
+_rate_limiter = AdaptiveTokenBucket("Metrika API", config.METRIKA_RATE_LIMIT_RPS, config.METRIKA_RATE_LIMIT_BURST,
+                                    max_rate=config.METRIKA_RATE_LIMIT_MAX_RPS,
+                                    increase_step=config.HTTP_RATE_INCREASE_RPS)
+# и общий предел одновременных запросов: загрузка нескольких тенантов сразу не должна его превышать
+_concurrency = threading.BoundedSemaphore(config.METRIKA_MAX_WORKERS)
 
-def get_metrika_data(metrics, dimensions, date1, date2, filters=None, sort=None, limit=10000, offset=1):
-    """
-    Универсальная функция для запроса данных из API Яндекс.Метрики.
-    """
-    if not TOKEN or not COUNTER_ID:
-        logger.error("Metrika API Token or Counter ID is not configured.")
-        return None
+# Keep-alive сессия с пулом соединений на все параллельные потоки: TLS-рукопожатие не повторяется на каждой странице
+_session = SharedSession(
+    "Metrika API",
+    lambda: {'Content-Type': 'application/json'},
+    pool_size=config.METRIKA_MAX_WORKERS
+)
+
+
+class MetrikaAPIError(Exception):
+    """Ошибка запроса к API Метрики (подробности уже записаны в лог)."""
+
+
+# Отчет по целям: срезы и размер страницы (строк), страницы чанка целей загружаются параллельно
+CONVERSIONS_DIMENSIONS = 'ym:s:date,ym:s:goalID,ym:s:lastTrafficSource,ym:s:lastSourceEngine'
+CONVERSIONS_PAGE_SIZE = 10000
+
+
+def _page_params(metrics, dimensions, date1, date2, filters, sort, limit, offset):
+    """Параметры запроса страницы отчета для счетчика текущего тенанта; (параметры, токен)."""
+    tenant = tenants.current()
+    if not tenant.metrika_token or not tenant.metrika_counter_id:
+        logger.error(f"Metrika API Token or Counter ID is not configured for tenant '{tenant.tenant_id}'.")
+        raise MetrikaAPIError("Metrika API Token or Counter ID is not configured.")
 
-    headers = {
-        'Authorization': f'OAuth {TOKEN}',
-        'Content-Type': 'application/json'
-    }
     params = {
-        'ids': COUNTER_ID,
+        'ids': tenant.metrika_counter_id,
         'metrics': metrics,
         'dimensions': dimensions,
         'date1': date1,
@@ -39,219 +62,264 @@ def get_metrika_data(metrics, dimensions, date1, date2, filters=None, sort=None,
         params['filters'] = filters
     if sort:
         params['sort'] = sort
+    return params, tenant.metrika_token
+
+
+def _get_page(params, token):
+    """Ответ API на запрос страницы: из кэша, если он там есть, иначе запросом к API с сохранением в кэш."""
+    cache = get_response_cache()
+    cache_key = None
+    if cache is not None:
+        # Ответы за прошедшие даты не меняются, поэтому берем их из кэша, не тратя квоту API
+        cache_key = cache.make_key('GET', METRIKA_API_URL, params)
+        response_data = cache.get(cache_key)
+        if response_data is not None:
+            etl_metrics.add('cache_hits')
+            logger.debug(f"Metrika API response served from cache for params: {params}")
+            return response_data
+
+    response_data = _request_metrika_page(params, token)
+    if cache is not None:
+        cache.set(cache_key, response_data, ttl_for_dates("metrika", [params['date2']]))
+    return response_data
+
 
-    all_data = []
+def fetch_metrika_page(metrics, dimensions, date1, date2, filters=None, sort=None, limit=10000, offset=1):
+    """
+    Одна страница ответа API Яндекс.Метрики (offset - номер первой строки, с 1): весь ответ,
+    со строками в 'data' и общим числом строк в 'total_rows'. При ошибке выбрасывает MetrikaAPIError.
+    """
+    params, token = _page_params(metrics, dimensions, date1, date2, filters, sort, limit, offset)
+    return _get_page(params, token)
+
+
+def iter_metrika_pages(metrics, dimensions, date1, date2, filters=None, sort=None, limit=10000, offset=1):
+    """
+    Генератор по страницам ответа API Яндекс.Метрики: каждая страница (список строк 'data')
+    отдается сразу после получения, не дожидаясь остальных.
+    При ошибке запроса пишет подробности в лог и выбрасывает MetrikaAPIError.
+    """
+    params, token = _page_params(metrics, dimensions, date1, date2, filters, sort, limit, offset)
+    fetched_rows = 0
     current_offset = offset
 
     while True:
         params['offset'] = current_offset
-        logger.debug(f"Requesting Metrika API with params: {params}")
-        try:
-            response = requests.get(METRIKA_API_URL, headers=headers, params=params, timeout=30)
-            response.raise_for_status()
-
-            response_data = response.json()
-            if 'data' in response_data and response_data['data']:
-                all_data.extend(response_data['data'])
-                total_rows = response_data.get('total_rows', 0)
-                if len(all_data) >= total_rows or len(response_data['data']) < limit:
-                    break
-                current_offset += limit
-            else:
-                break
-            time.sleep(0.5)
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error requesting Metrika API: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                try:
-                    logger.error(f"Metrika API error details: {e.response.json()}")
-                except ValueError:
-                    logger.error(f"Metrika API error response content: {e.response.text}")
-            return None
-        except Exception as e:
-            logger.error(f"An unexpected error occurred during Metrika API request: {e}")
-            return None
+        response_data = _get_page(params, token)
+
+        page = response_data.get('data')
+        if not page:
+            break
+        fetched_rows += len(page)
+        yield page
+
+        total_rows = response_data.get('total_rows', 0)
+        if fetched_rows >= total_rows or len(page) < limit:
+            break
+        current_offset += limit
 
     logger.info(
-        f"Successfully fetched {len(all_data)} rows from Metrika API for metrics='{metrics}', dimensions='{dimensions}' between {date1} and {date2}.")
-    return all_data
+        f"Successfully fetched {fetched_rows} rows from Metrika API for metrics='{metrics}', dimensions='{dimensions}' between {date1} and {date2}.")
 
 
-def get_traffic_sources_summary(date_from, date_to):
+def request_metrika(method, url, token, description="Metrika API request", stream=False, timeout=30, **kwargs):
     """
-    Получает данные о трафике по всем источникам.
+    Запрос к любому API Метрики (отчеты, Logs API) под общими для них лимитами частоты и параллельности;
+    временные ошибки (429/5xx, таймауты) повторяются с паузами (http_client.send_with_retries).
+    Возвращает requests.Response, статус проверяет вызывающий.
     """
-    metrics = 'ym:s:visits,ym:s:users'
-    dimensions = 'ym:s:date,ym:s:lastTrafficSource,ym:s:lastSourceEngine'
-    raw_data = get_metrika_data(metrics=metrics, dimensions=dimensions, date1=date_from, date2=date_to,
-                                sort='ym:s:date')
+    def send():
+        with _concurrency:
+            return _session.get().request(method, url, headers={'Authorization': f'OAuth {token}'},
+                                          stream=stream, timeout=timeout, **kwargs)
 
-    if raw_data is None:
-        return []
+    return send_with_retries(send, _rate_limiter, description, stream=stream)
 
-    processed_data = []
-    for item in raw_data:
+
+def _request_metrika_page(params, token):
+    """
+    Один запрос страницы к API Метрики (request_metrika).
+    При окончательной ошибке пишет подробности в лог и выбрасывает MetrikaAPIError.
+    """
+    logger.debug(f"Requesting Metrika API with params: {params}")
+    try:
+        response = request_metrika('GET', METRIKA_API_URL, token, params=params)
+        response.raise_for_status()
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        etl_metrics.add('http_errors')
+        logger.error(f"Error requesting Metrika API: {e}")
+        if hasattr(e, 'response') and e.response is not None:
+            try:
+                logger.error(f"Metrika API error details: {e.response.json()}")
+            except ValueError:
+                logger.error(f"Metrika API error response content: {e.response.text}")
+        raise MetrikaAPIError(str(e)) from e
+    except Exception as e:
+        etl_metrics.add('http_errors')
+        logger.error(f"An unexpected error occurred during Metrika API request: {e}")
+        raise MetrikaAPIError(str(e)) from e
+
+
+def iter_traffic_sources(date_from, date_to):
+    """
+    Генератор записей о трафике по всем источникам: строки разбираются по мере поступления страниц API.
+    """
+    metrics = 'ym:s:visits,ym:s:users'
+    dimensions = 'ym:s:date,ym:s:lastTrafficSource,ym:s:lastSourceEngine'
+    processed_count = 0
+    for item in (row for page in iter_metrika_pages(metrics=metrics, dimensions=dimensions, date1=date_from,
+                                                     date2=date_to, sort='ym:s:date')
+                 for row in page):
         try:
             record_date_str = item['dimensions'][0]['name']
             traffic_source_type = item['dimensions'][1]['name'] or "Не определено"
             source_engine_detail = item['dimensions'][2]['name'] or "Не определено"
             visits = int(item['metrics'][0])
             users = int(item['metrics'][1])
-
-            source_group = "Прочие источники"
-            source_engine = traffic_source_type
-
-            # --- Логика категоризации ---
-            norm_type = traffic_source_type.lower()
-            if 'organic' in norm_type or 'search' in norm_type:
-                source_group = "Переходы из поисковых систем"
-                norm_engine = source_engine_detail.lower()
-                if 'yandex' in norm_engine or 'яндекс' in norm_engine:
-                    source_engine = "Яндекс"
-                elif 'google' in norm_engine:
-                    source_engine = "Google"
-                else:
-                    source_engine = "Другие поисковые системы"
-            elif 'direct' in norm_type:
-                source_group = "Прямые заходы"
-                source_engine = "Прямые заходы"
-            elif 'social' in norm_type:
-                source_group = "Переходы из социальных сетей"
-                source_engine = "Социальные сети"
-            # ... можно добавить другие elif для рекламного, ссылочного и т.д. ...
-
-            processed_data.append({
-                'report_date': record_date_str, 'source_group': source_group,
-                'source_engine': source_engine, 'source_detail': source_engine_detail,
-                'visits': visits, 'users': users
-            })
         except (IndexError, KeyError, TypeError) as e:
             logger.error(f"Error processing traffic source item: {item}. Error: {e}. Skipping.")
+            etl_metrics.add('rejected_rows')
             continue
-    logger.info(f"Processed {len(processed_data)} records for all traffic sources.")
-    return processed_data
+        processed_count += 1
+        yield TrafficSourceRecord(record_date_str, traffic_source_type, source_engine_detail, visits, users)
+    logger.info(f"Processed {processed_count} records for all traffic sources.")
 
 
-def get_behavior_summary(date_from, date_to):
+def iter_behavior_summary(date_from, date_to):
     """
-    Получает сводные данные по поведению пользователей на сайте.
+    Генератор сводных записей по поведению пользователей на сайте.
     """
     metrics = 'ym:s:bounces,ym:s:bounceRate,ym:s:pageDepth,ym:s:avgVisitDurationSeconds'
     dimensions = 'ym:s:date'
-    raw_data = get_metrika_data(metrics=metrics, dimensions=dimensions, date1=date_from, date2=date_to,
-                                sort='ym:s:date')
-
-    if raw_data is None:
-        return []
-
-    processed_data = []
-    for item in raw_data:
+    processed_count = 0
+    for item in (row for page in iter_metrika_pages(metrics=metrics, dimensions=dimensions, date1=date_from,
+                                                     date2=date_to, sort='ym:s:date')
+                 for row in page):
         try:
-            processed_data.append({
-                'report_date': item['dimensions'][0]['name'],
-                'bounces': int(item['metrics'][0] or 0),
-                'bounce_rate': float(item['metrics'][1] or 0.0),
-                'page_depth': float(item['metrics'][2] or 0.0),
-                'avg_visit_duration_seconds': int(item['metrics'][3] or 0)
-            })
+            record = BehaviorRecord(
+                report_date=item['dimensions'][0]['name'],
+                bounces=int(item['metrics'][0] or 0),
+                bounce_rate=float(item['metrics'][1] or 0.0),
+                page_depth=float(item['metrics'][2] or 0.0),
+                avg_visit_duration_seconds=int(item['metrics'][3] or 0)
+            )
         except (IndexError, KeyError, TypeError, ValueError) as e:
             logger.error(f"Error processing behavior item: {item}. Error: {e}. Skipping.")
+            etl_metrics.add('rejected_rows')
             continue
-    logger.info(f"Processed {len(processed_data)} records for behavior summary.")
-    return processed_data
+        processed_count += 1
+        yield record
+    logger.info(f"Processed {processed_count} records for behavior summary.")
 
 
 # ====================================================================================
 # ФИНАЛЬНАЯ ИСПРАВЛЕННАЯ ФУНКЦИЯ ДЛЯ КОНВЕРСИЙ
 # ====================================================================================
-def get_conversions_data(date_from, date_to):
+def _fetch_conversions_page(chunk_idx, goal_ids_chunk, date_from, date_to, offset):
+    """
+    Загружает и сразу разбирает одну страницу чанка целей (offset - номер первой строки, с 1).
+    Возвращает (номер чанка, успех, список записей страницы, total_rows чанка); при ошибке API - (.., False, [], 0).
     """
-    Получает данные по всем настроенным целям Яндекс.Метрики в разрезе источников.
-    ФИНАЛЬНАЯ ВЕРСИЯ: Корректно обрабатывает ответ API, пропуская цели не из текущего чанка.
+    metrics_list_chunk = [m for goal_id in goal_ids_chunk for m in
+                          (f"ym:s:goal{goal_id}reaches", f"ym:s:goal{goal_id}conversionRate")]
+    # goal_id -> смещение его пары метрик (reaches, conversionRate) в строке ответа
+    metric_offsets = {goal_id: index_in_chunk * 2 for index_in_chunk, goal_id in enumerate(goal_ids_chunk)}
+    try:
+        response_data = fetch_metrika_page(metrics=",".join(metrics_list_chunk), dimensions=CONVERSIONS_DIMENSIONS,
+                                           date1=date_from, date2=date_to, limit=CONVERSIONS_PAGE_SIZE, offset=offset)
+    except MetrikaAPIError as e:
+        logger.warning(f"Conversions chunk {chunk_idx + 1}, offset {offset} failed: {e}")
+        return chunk_idx, False, [], 0
+
+    records = []
+    for item in response_data.get('data') or []:
+        record = _parse_conversion_item(item, metric_offsets)
+        if record is not None:
+            records.append(record)
+    return chunk_idx, True, records, response_data.get('total_rows', 0)
+
+
+def iter_conversions_data(date_from, date_to):
     """
-    if not config.METRIKA_GOAL_IDS_FOR_REQUEST:
+    Генератор записей по целям текущего тенанта (tenants.current()) в разрезе источников.
+    Страницы загружаются параллельно (config.METRIKA_MAX_WORKERS потоков) под общим ограничителем частоты:
+    сначала первые страницы всех чанков целей (они сообщают total_rows), затем остальные страницы.
+    Записи каждой страницы отдаются сразу, поэтому память не зависит от длины периода.
+    Сбой страницы не останавливает остальные; если такие сбои были, после выдачи всех
+    полученных записей выбрасывается MetrikaAPIError.
+    """
+    goal_ids = list(tenants.current().metrika_goals)
+    if not goal_ids:
         logger.warning("No goal IDs configured. Skipping conversion data.")
-        return []
+        return
 
-    all_processed_data = []
-    goals_map = config.METRIKA_GOALS_MAP
+    processed_count = 0
+    failed_chunks = set()
 
     max_goals_per_request = 10
     goal_ids_chunks = [
-        config.METRIKA_GOAL_IDS_FOR_REQUEST[i:i + max_goals_per_request]
-        for i in range(0, len(config.METRIKA_GOAL_IDS_FOR_REQUEST), max_goals_per_request)
+        goal_ids[i:i + max_goals_per_request] for i in range(0, len(goal_ids), max_goals_per_request)
     ]
 
-    for chunk_idx, goal_ids_chunk in enumerate(goal_ids_chunks):
-        if not goal_ids_chunk: continue
-        logger.info(f"Processing conversions chunk {chunk_idx + 1}/{len(goal_ids_chunks)} with goals: {goal_ids_chunk}")
+    # (номер чанка, цели чанка, offset) для страниц после первой
+    page_tasks = []
+    first_pages = ordered_map(
+        lambda indexed_chunk: _fetch_conversions_page(indexed_chunk[0], indexed_chunk[1], date_from, date_to, 1),
+        enumerate(goal_ids_chunks),
+        max_workers=config.METRIKA_MAX_WORKERS, thread_name_prefix="metrika-conversions")
+    for chunk_idx, ok, records, total_rows in first_pages:
+        goal_ids_chunk = goal_ids_chunks[chunk_idx]
+        logger.info(f"Conversions chunk {chunk_idx + 1}/{len(goal_ids_chunks)} with goals {goal_ids_chunk}: "
+                    f"{total_rows} rows.")
+        if not ok:
+            failed_chunks.add(chunk_idx + 1)
+            continue
+        if not total_rows:
+            logger.warning(f"No data received for conversions chunk {chunk_idx + 1}.")
+        processed_count += len(records)
+        yield from records
+        page_tasks.extend((chunk_idx, goal_ids_chunk, offset)
+                          for offset in range(1 + CONVERSIONS_PAGE_SIZE, total_rows + 1, CONVERSIONS_PAGE_SIZE))
+
+    for chunk_idx, ok, records, _ in ordered_map(
+            lambda task: _fetch_conversions_page(task[0], task[1], date_from, date_to, task[2]), page_tasks,
+            max_workers=config.METRIKA_MAX_WORKERS, thread_name_prefix="metrika-conversions"):
+        if not ok:
+            failed_chunks.add(chunk_idx + 1)
+            continue
+        processed_count += len(records)
+        yield from records
 
-        metrics_list_chunk = [m for goal_id in goal_ids_chunk for m in
-                              (f"ym:s:goal{goal_id}reaches", f"ym:s:goal{goal_id}conversionRate")]
-        metrics_str_chunk = ",".join(metrics_list_chunk)
-        dimensions = 'ym:s:date,ym:s:goalID,ym:s:lastTrafficSource,ym:s:lastSourceEngine'
+    logger.info(f"Processed {processed_count} records for conversions data.")
+    if failed_chunks:
+        raise MetrikaAPIError(f"Conversions chunks {sorted(failed_chunks)} failed for {date_from} - {date_to}.")
 
-        raw_data_chunk = get_metrika_data(metrics=metrics_str_chunk, dimensions=dimensions, date1=date_from,
-                                          date2=date_to)
 
-        if not raw_data_chunk:
-            logger.warning(f"No data received for conversions chunk {chunk_idx + 1}.")
-            continue
+def _parse_conversion_item(item, metric_offsets):
+    """Разбирает строку ответа по целям; возвращает None для чужих целей и некорректных строк."""
+    try:
+        record_date_str = item['dimensions'][0].get('name')
+        goal_id_from_api = item['dimensions'][1].get('name')
 
-        for item_idx, item in enumerate(raw_data_chunk):
-            try:
-                record_date_str = item['dimensions'][0].get('name')
-                goal_id_from_api = item['dimensions'][1].get('name')
-
-                # Проверяем, есть ли goal_id из ответа API в ТЕКУЩЕМ запрошенном чанке.
-                try:
-                    index_in_chunk = goal_ids_chunk.index(str(goal_id_from_api))
-                    metric_offset = index_in_chunk * 2
-                except ValueError:
-                    # Нормальная ситуация: API вернул цель не из этого чанка. Молча пропускаем.
-                    continue
-
-                traffic_source_type = item['dimensions'][2].get('name', "Не определено")
-                source_engine_detail_name = item['dimensions'][3].get('name', "Не определено")
-
-                if not record_date_str: continue
-
-                goal_name = goals_map.get(goal_id_from_api, "Неизвестная цель")
-                reaches = int(item['metrics'][metric_offset]) if item['metrics'][metric_offset] is not None else 0
-                conversion_rate = float(item['metrics'][metric_offset + 1]) if item['metrics'][
-                                                                                   metric_offset + 1] is not None else 0.0
-
-                # (Блок категоризации источников)
-                current_source_engine_category = "Прочие источники"
-                normalized_api_traffic_type = traffic_source_type.lower()
-                if 'organic' in normalized_api_traffic_type or 'search' in normalized_api_traffic_type:
-                    current_source_engine_category = "Другие поисковые системы"
-                    normalized_engine_detail = source_engine_detail_name.lower()
-                    if 'яндекс' in normalized_engine_detail or 'yandex' in normalized_engine_detail:
-                        current_source_engine_category = "Яндекс"
-                    elif 'google' in normalized_engine_detail:
-                        current_source_engine_category = "Google"
-                elif 'direct' in normalized_api_traffic_type:
-                    current_source_engine_category = "Прямые заходы"
-                elif 'social' in normalized_api_traffic_type:
-                    current_source_engine_category = "Социальные сети"
-                elif 'link' in normalized_api_traffic_type:
-                    current_source_engine_category = "Переходы по ссылкам на сайтах"
-                elif 'ad' in normalized_api_traffic_type:
-                    current_source_engine_category = "Переходы по рекламе"
-                # ... и т.д.
-
-                all_processed_data.append({
-                    'report_date': record_date_str, 'goal_id': goal_id_from_api,
-                    'goal_name': goal_name, 'source_engine': current_source_engine_category,
-                    'source_detail': source_engine_detail_name, 'reaches': reaches,
-                    'conversion_rate': conversion_rate
-                })
-            except Exception as e:
-                logger.error(f"Error processing conversion item #{item_idx}: {item}. Error: {e}. Skipping.")
-                continue
-
-        time.sleep(0.5)
-
-    logger.info(f"Processed {len(all_processed_data)} records for conversions data.")
-    return all_processed_data
\ No newline at end of file
+        # Проверяем, есть ли goal_id из ответа API в ТЕКУЩЕМ запрошенном чанке.
+        metric_offset = metric_offsets.get(str(goal_id_from_api))
+        if metric_offset is None:
+            # Нормальная ситуация: API вернул цель не из этого чанка. Молча пропускаем.
+            return None
+
+        traffic_source_type = item['dimensions'][2].get('name') or "Не определено"
+        source_engine_detail_name = item['dimensions'][3].get('name') or "Не определено"
+
+        if not record_date_str: return None
+
+        reaches = int(item['metrics'][metric_offset]) if item['metrics'][metric_offset] is not None else 0
+        conversion_rate = float(item['metrics'][metric_offset + 1]) if item['metrics'][
+                                                                           metric_offset + 1] is not None else 0.0
+
+        return ConversionRecord(record_date_str, goal_id_from_api, traffic_source_type, source_engine_detail_name,
+                                reaches, conversion_rate)
+    except Exception as e:
+        logger.error(f"Error processing conversion item: {item}. Error: {e}. Skipping.")
+        etl_metrics.add('rejected_rows')
+        return None
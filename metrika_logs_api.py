@@ -0,0 +1,394 @@
+# metrika_logs_api.py
+import logging
+import threading
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+import config
+import db_manager
+import etl_metrics
+import tenants
+from metrika_api import MetrikaAPIError, request_metrika
+from schema import BehaviorRecord, ConversionRecord, TrafficSourceRecord
+from traffic_classifier import UNKNOWN_SOURCE
+
+logger = logging.getLogger(__name__)
+
+# Поля визита в Logs API -> колонка промежуточной таблицы (порядок совпадает с колонками TSV)
+VISIT_FIELDS = (
+    ('ym:s:visitID', 'visit_id'),
+    ('ym:s:date', 'report_date'),
+    ('ym:s:clientID', 'client_id'),
+    ('ym:s:bounce', 'bounce'),
+    ('ym:s:pageViews', 'page_views'),
+    ('ym:s:visitDuration', 'visit_duration'),
+    ('ym:s:lastTrafficSource', 'traffic_source'),
+    ('ym:s:lastSearchEngineRoot', 'search_engine'),
+    ('ym:s:lastAdvEngine', 'adv_engine'),
+    ('ym:s:lastReferalSource', 'referal_source'),
+    ('ym:s:lastSocialNetwork', 'social_network'),
+    ('ym:s:goalsID', 'goals_id'),
+)
+VISIT_COLUMNS = tuple(column for _, column in VISIT_FIELDS)
+
+# Logs API отдает коды источников, API отчетов - названия; правила traffic_classifier написаны под названия
+TRAFFIC_SOURCE_NAMES = {
+    'organic': "Search engine traffic",
+    'direct': "Direct traffic",
+    'referral': "Link traffic",
+    'ad': "Ad traffic",
+    'social': "Social network traffic",
+    'internal': "Internal traffic",
+    'email': "Mailing traffic",
+    'saved': "Cached page traffic",
+    'recommend': "Recommendation system traffic",
+    'messenger': "Messenger traffic",
+    'undefined': UNKNOWN_SOURCE,
+}
+
+# Статусы запроса выгрузки, после которых ждать уже нечего
+FAILED_STATUSES = ('canceled', 'processing_failed', 'cleaned_by_user', 'cleaned_automatically_as_too_old')
+
+# Визиты хранятся в нежурналируемой таблице: это промежуточные данные, их всегда можно выгрузить заново
+LOGS_TABLES_SQL = (
+    """
+    CREATE UNLOGGED TABLE IF NOT EXISTS metrika_logs_visits (
+        tenant_id VARCHAR(64) NOT NULL,
+        staged_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        visit_id TEXT NOT NULL, -- UInt64, в BIGINT не помещается
+        report_date DATE NOT NULL,
+        client_id TEXT,
+        bounce SMALLINT,
+        page_views INTEGER,
+        visit_duration INTEGER,
+        traffic_source TEXT, -- код: organic, direct, referral, ad, social, ...
+        search_engine TEXT,
+        adv_engine TEXT,
+        referal_source TEXT,
+        social_network TEXT,
+        goals_id TEXT -- массив в виде '[123,456]', по элементу на каждое достижение цели
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS metrika_logs_visits_tenant_date_idx ON metrika_logs_visits (tenant_id, report_date);",
+)
+# Визит тенанта хранится один раз, даже если его периода касались несколько выгрузок
+VISIT_KEY_SQL = (
+    """
+    DELETE FROM metrika_logs_visits a USING metrika_logs_visits b
+    WHERE a.tenant_id = b.tenant_id AND a.visit_id = b.visit_id AND a.ctid < b.ctid;
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS metrika_logs_visits_visit_key ON metrika_logs_visits (tenant_id, visit_id);",
+)
+
+# Визиты тенанта за период с "системой" источника, как ym:s:lastSourceEngine в API отчетов
+_VISITS_CTE = """
+    WITH visits AS (
+        SELECT visit_id, report_date, client_id, bounce, page_views, visit_duration, goals_id,
+               COALESCE(traffic_source, '') AS traffic_source,
+               COALESCE(CASE traffic_source
+                            WHEN 'organic' THEN search_engine
+                            WHEN 'ad' THEN adv_engine
+                            WHEN 'referral' THEN referal_source
+                            WHEN 'social' THEN social_network
+                        END, '') AS source_engine
+        FROM metrika_logs_visits
+        WHERE tenant_id = %(tenant_id)s AND report_date BETWEEN %(date_from)s AND %(date_to)s
+    )
+"""
+
+TRAFFIC_SOURCES_SQL = _VISITS_CTE + """
+    SELECT report_date, traffic_source, source_engine, COUNT(*), COUNT(DISTINCT client_id)
+    FROM visits
+    GROUP BY report_date, traffic_source, source_engine
+    ORDER BY report_date
+"""
+
+BEHAVIOR_SQL = _VISITS_CTE + """
+    SELECT report_date, SUM(bounce), AVG(bounce) * 100, AVG(page_views), ROUND(AVG(visit_duration))
+    FROM visits
+    GROUP BY report_date
+    ORDER BY report_date
+"""
+
+# Достижения целей (одно на элемент goals_id) и доля визитов среза с достижением цели
+CONVERSIONS_SQL = _VISITS_CTE + """
+    , slices AS (
+        SELECT report_date, traffic_source, source_engine, COUNT(*) AS visits
+        FROM visits
+        GROUP BY report_date, traffic_source, source_engine
+    ), reaches AS (
+        SELECT v.report_date, v.traffic_source, v.source_engine, v.visit_id, btrim(g.goal_id) AS goal_id
+        FROM visits v, unnest(string_to_array(NULLIF(btrim(v.goals_id, '[] '), ''), ',')) AS g (goal_id)
+    )
+    SELECT r.report_date, r.goal_id, r.traffic_source, r.source_engine, COUNT(*),
+           COUNT(DISTINCT r.visit_id) * 100.0 / s.visits
+    FROM reaches r JOIN slices s USING (report_date, traffic_source, source_engine)
+    WHERE r.goal_id = ANY(%(goal_ids)s)
+    GROUP BY r.report_date, r.goal_id, r.traffic_source, r.source_engine, s.visits
+    ORDER BY r.report_date
+"""
+
+
+class MetrikaLogsError(MetrikaAPIError):
+    """Выгрузку Logs API не удалось получить или сохранить (подробности уже записаны в лог)."""
+
+
+def create_logs_tables():
+    """Создает промежуточную таблицу визитов Logs API."""
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for command in LOGS_TABLES_SQL:
+                    cur.execute(command)
+            conn.commit()
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error creating Logs API tables: {repr(error)}")
+        return False
+
+
+def migrate_logs_visit_key():
+    """Удаляет повторы визитов в промежуточной таблице и добавляет уникальный ключ (tenant_id, visit_id)."""
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for command in VISIT_KEY_SQL:
+                    cur.execute(command)
+            conn.commit()
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error adding Logs API visit key: {repr(error)}")
+        return False
+
+
+def _call(method, path, tenant, description, **kwargs):
+    """Запрос к методу Logs API счетчика тенанта; возвращает разобранный JSON или выбрасывает MetrikaLogsError."""
+    url = f"{config.METRIKA_LOGS_API_URL.rstrip('/')}/{tenant.metrika_counter_id}/{path}"
+    try:
+        response = request_metrika(method, url, tenant.metrika_token, description=description, **kwargs)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        etl_metrics.add('http_errors')
+        logger.error(f"Logs API {description} failed for tenant '{tenant.tenant_id}': {e}")
+        raise MetrikaLogsError(f"{description}: {e}") from e
+
+
+def _wait_until_processed(tenant, request_id):
+    """Ждет подготовки выгрузки; возвращает описание запроса со списком частей (parts)."""
+    deadline = time.monotonic() + config.METRIKA_LOGS_MAX_WAIT_SECONDS
+    while True:
+        log_request = _call('GET', f"logrequest/{request_id}", tenant, "log request status")['log_request']
+        status = log_request.get('status')
+        if status == 'processed':
+            return log_request
+        if status in FAILED_STATUSES:
+            raise MetrikaLogsError(f"Log request {request_id} ended with status '{status}'.")
+        if time.monotonic() >= deadline:
+            raise MetrikaLogsError(f"Log request {request_id} not processed in "
+                                   f"{config.METRIKA_LOGS_MAX_WAIT_SECONDS}s (status '{status}').")
+        etl_metrics.add('export_wait_seconds', config.METRIKA_LOGS_POLL_SECONDS)
+        time.sleep(config.METRIKA_LOGS_POLL_SECONDS)
+
+
+class _TsvPartReader:
+    """
+    Файлоподобная обертка над потоковым ответом для cursor.copy_expert: отдает TSV по кускам,
+    не загружая часть целиком в память, и отрезает строку заголовков.
+    """
+
+    def __init__(self, response, chunk_size=1024 * 1024):
+        self._chunks = response.iter_content(chunk_size)
+        self._buffer = b''
+        self.bytes_read = 0
+
+    def _next_chunk(self):
+        chunk = next(self._chunks, b'')
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def read_header(self):
+        while b'\n' not in self._buffer:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            self._buffer += chunk
+        header, _, self._buffer = self._buffer.partition(b'\n')
+        return header.decode('utf-8').rstrip('\r').split('\t') if header else []
+
+    def read(self, size=-1):
+        if self._buffer:
+            data, self._buffer = self._buffer, b''
+            return data
+        return self._next_chunk()
+
+
+def _copy_part(cur, tenant, request_id, part_number):
+    """Потоково загружает одну часть выгрузки во временную таблицу metrika_logs_part через COPY."""
+    url = (f"{config.METRIKA_LOGS_API_URL.rstrip('/')}/{tenant.metrika_counter_id}/"
+           f"logrequest/{request_id}/part/{part_number}/download")
+    started = time.monotonic()
+    try:
+        response = request_metrika('GET', url, tenant.metrika_token, description="log request part download",
+                                   stream=True, timeout=300)
+        response.raise_for_status()
+    except Exception as e:
+        etl_metrics.add('http_errors')
+        logger.error(f"Logs API part {part_number} of request {request_id} download failed: {e}")
+        raise MetrikaLogsError(f"part {part_number} download: {e}") from e
+    reader = _TsvPartReader(response)
+    try:
+        header = reader.read_header()
+        expected = [field for field, _ in VISIT_FIELDS]
+        if header != expected:
+            raise MetrikaLogsError(f"Unexpected columns in part {part_number} of request {request_id}: {header}")
+        cur.copy_expert(sql.SQL("COPY metrika_logs_part ({}) FROM STDIN").format(
+            sql.SQL(', ').join(map(sql.Identifier, VISIT_COLUMNS))).as_string(cur), reader)
+    finally:
+        response.close()
+        etl_metrics.add('http_bytes', reader.bytes_read)
+        etl_metrics.add('http_seconds', time.monotonic() - started)
+
+
+def _export_visits(tenant, date_from, date_to):
+    """
+    Выгрузка визитов тенанта за [date_from, date_to] через Logs API: оценка, создание запроса, ожидание,
+    потоковая загрузка частей в metrika_logs_visits (старые визиты этого периода заменяются) и очистка запроса,
+    чтобы не занимать квоту счетчика на хранение выгрузок.
+    """
+    params = {'date1': date_from, 'date2': date_to, 'source': 'visits',
+              'fields': ','.join(field for field, _ in VISIT_FIELDS)}
+    evaluation = _call('GET', "logrequests/evaluate", tenant, "log request evaluation",
+                       params=params)['log_request_evaluation']
+    if not evaluation.get('possible'):
+        raise MetrikaLogsError(
+            f"Logs API export for {date_from} - {date_to} is not possible; at most "
+            f"{evaluation.get('max_possible_day_quantity')} days fit into one request (see BACKFILL_WINDOW_DAYS).")
+
+    request_id = _call('POST', "logrequests", tenant, "log request creation", params=params)['log_request']['request_id']
+    logger.info(f"Logs API request {request_id} created for tenant '{tenant.tenant_id}', {date_from} - {date_to}.")
+    processed = False
+    try:
+        log_request = _wait_until_processed(tenant, request_id)
+        processed = True
+        parts = sorted(part['part_number'] for part in log_request.get('parts') or [])
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                # Выгрузки тенанта из других процессов ждут, пока эта транзакция не завершится
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"metrika_logs:{tenant.tenant_id}",))
+                cur.execute(
+                    "DELETE FROM metrika_logs_visits WHERE tenant_id = %s AND (report_date BETWEEN %s AND %s "
+                    "OR staged_at < NOW() - make_interval(hours => %s))",
+                    (tenant.tenant_id, date_from, date_to, config.METRIKA_LOGS_STAGING_TTL_HOURS))
+                cur.execute(sql.SQL("CREATE TEMP TABLE metrika_logs_part ({}) ON COMMIT DROP").format(
+                    sql.SQL(', ').join(sql.SQL("{} TEXT").format(sql.Identifier(column)) for column in VISIT_COLUMNS)))
+                staged = 0
+                for part_number in parts:
+                    _copy_part(cur, tenant, request_id, part_number)
+                    # Типы приводятся здесь, а не в COPY: пустые значения Logs API превращаются в NULL
+                    cur.execute(sql.SQL(
+                        "INSERT INTO metrika_logs_visits (tenant_id, {columns}) "
+                        "SELECT %s, visit_id, report_date::date, NULLIF(client_id, ''), NULLIF(bounce, '')::smallint, "
+                        "NULLIF(page_views, '')::integer, NULLIF(visit_duration, '')::integer, traffic_source, "
+                        "search_engine, adv_engine, referal_source, social_network, goals_id FROM metrika_logs_part "
+                        "ON CONFLICT (tenant_id, visit_id) DO NOTHING"
+                    ).format(columns=sql.SQL(', ').join(map(sql.Identifier, VISIT_COLUMNS))), (tenant.tenant_id,))
+                    rows = cur.rowcount
+                    cur.execute("TRUNCATE metrika_logs_part")
+                    staged += rows
+                    logger.info(f"Logs API request {request_id}: part {part_number + 1}/{len(parts)} staged "
+                                f"({rows} visits).")
+            conn.commit()
+        logger.info(f"Logs API request {request_id}: {staged} visits staged for tenant '{tenant.tenant_id}'.")
+    except psycopg2.Error as error:
+        logger.error(f"Error staging Logs API request {request_id}: {repr(error)}")
+        raise MetrikaLogsError(f"staging request {request_id}: {error}") from error
+    finally:
+        # Обработанный запрос очищаем, необработанный отменяем: выгрузки занимают квоту счетчика
+        try:
+            _call('POST', f"logrequest/{request_id}/{'clean' if processed else 'cancel'}", tenant,
+                  "log request cleanup")
+        except MetrikaLogsError:
+            pass
+
+
+_exports_lock = threading.Lock()
+_export_locks = {}  # tenant_id -> threading.Lock
+_exported = {}  # tenant_id -> [(date_from, date_to, time.monotonic() выгрузки)]
+
+
+def stage_visits(date_from, date_to):
+    """
+    Гарантирует, что визиты текущего тенанта за период выгружены в metrika_logs_visits. Наборы данных
+    и окна backfill загружаются параллельно, но выгрузки одного тенанта идут по очереди: пересекающиеся
+    периоды не заменяют визиты друг друга одновременно. Период, целиком входящий в выгрузку не старше
+    config.METRIKA_LOGS_REUSE_SECONDS, повторно не выгружается.
+    """
+    tenant = tenants.current()
+    if not tenant.metrika_token or not tenant.metrika_counter_id:
+        raise MetrikaLogsError("Metrika API Token or Counter ID is not configured.")
+    period_from, period_to = db_manager._to_date(date_from), db_manager._to_date(date_to)
+    with _exports_lock:
+        lock = _export_locks.setdefault(tenant.tenant_id, threading.Lock())
+    with lock:
+        now = time.monotonic()
+        fresh = [export for export in _exported.get(tenant.tenant_id, ())
+                 if now - export[2] < config.METRIKA_LOGS_REUSE_SECONDS]
+        _exported[tenant.tenant_id] = fresh
+        if any(start <= period_from and period_to <= end for start, end, _ in fresh):
+            return
+        _export_visits(tenant, date_from, date_to)
+        fresh.append((period_from, period_to, time.monotonic()))
+
+
+def _aggregate(query, date_from, date_to, **params):
+    """Выгружает визиты (stage_visits) и считает по ним агрегат запросом query; возвращает строки результата."""
+    stage_visits(date_from, date_to)
+    params.update(tenant_id=tenants.current_id(), date_from=date_from, date_to=date_to)
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+            conn.commit()
+        return rows
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error aggregating Logs API visits for {date_from} - {date_to}: {repr(error)}")
+        raise MetrikaLogsError(f"aggregation: {error}") from error
+
+
+def _source(traffic_source, source_engine):
+    """(тип, детализация) источника по кодам Logs API - в том же виде, что отдает API отчетов."""
+    return TRAFFIC_SOURCE_NAMES.get(traffic_source, traffic_source or UNKNOWN_SOURCE), source_engine or UNKNOWN_SOURCE
+
+
+def iter_traffic_sources(date_from, date_to):
+    """Записи о трафике по всем источникам, посчитанные в БД по визитам из Logs API."""
+    rows = _aggregate(TRAFFIC_SOURCES_SQL, date_from, date_to)
+    for report_date, traffic_source, source_engine, visits, users in rows:
+        yield TrafficSourceRecord(report_date.isoformat(), *_source(traffic_source, source_engine), visits, users)
+    logger.info(f"Processed {len(rows)} records for all traffic sources (Logs API).")
+
+
+def iter_behavior_summary(date_from, date_to):
+    """Сводные записи по поведению, посчитанные в БД по визитам из Logs API."""
+    rows = _aggregate(BEHAVIOR_SQL, date_from, date_to)
+    for report_date, bounces, bounce_rate, page_depth, avg_duration in rows:
+        yield BehaviorRecord(report_date.isoformat(), int(bounces or 0), float(bounce_rate or 0.0),
+                             float(page_depth or 0.0), int(avg_duration or 0))
+    logger.info(f"Processed {len(rows)} records for behavior summary (Logs API).")
+
+
+def iter_conversions_data(date_from, date_to):
+    """Записи по целям текущего тенанта в разрезе источников, посчитанные в БД по визитам из Logs API."""
+    goal_ids = list(tenants.current().metrika_goals)
+    if not goal_ids:
+        logger.warning("No goal IDs configured. Skipping conversion data.")
+        return
+    rows = _aggregate(CONVERSIONS_SQL, date_from, date_to, goal_ids=goal_ids)
+    for report_date, goal_id, traffic_source, source_engine, reaches, conversion_rate in rows:
+        yield ConversionRecord(report_date.isoformat(), goal_id, *_source(traffic_source, source_engine),
+                               reaches, float(conversion_rate))
+    logger.info(f"Processed {len(rows)} records for conversions data (Logs API).")
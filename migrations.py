@@ -0,0 +1,96 @@
+# migrations.py
+import logging
+from collections import namedtuple
+
+import psycopg2
+
+import db_manager
+import dimensions
+import metrika_logs_api
+import rollups
+
+logger = logging.getLogger(__name__)
+
+# Шаг схемы БД: apply() возвращает True при успехе. Примененные версии записываются в schema_version
+# и больше не выполняются; изменения схемы добавляются новой версией в конец MIGRATIONS, старые не меняются.
+Migration = namedtuple('Migration', 'version description apply')
+
+# Порядок важен: ключи тенантов ссылаются на колонки справочников, а представления - на tenant_id.
+# Шаги идемпотентны (IF NOT EXISTS и проверки схемы), поэтому БД, созданная до появления schema_version,
+# один раз проходит их все и дальше проверяется одним запросом.
+MIGRATIONS = (
+    Migration(1, "fact and ETL service tables", db_manager.create_tables_if_not_exist),
+    Migration(2, "dimension tables and surrogate keys", dimensions.create_dimension_tables),
+    Migration(3, "tenant_id columns", db_manager.migrate_tenant_columns),
+    Migration(4, "dimension views", dimensions.create_views),
+    Migration(5, "rollup tables", rollups.create_rollup_tables),
+    Migration(6, "Metrika Logs API staging table", metrika_logs_api.create_logs_tables),
+    Migration(7, "dim_sources keyed by raw source type and detail", dimensions.migrate_source_keys),
+    Migration(8, "unique Metrika Logs API visits per tenant", metrika_logs_api.migrate_logs_visit_key),
+)
+LATEST_VERSION = MIGRATIONS[-1].version
+
+SCHEMA_VERSION_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+"""
+# Ключ advisory-блокировки: несколько экземпляров сервиса не применяют миграции одновременно
+_MIGRATION_LOCK_KEY = 726570001
+
+
+def _current_version(cur):
+    """Последняя примененная версия схемы; 0, если таблицы schema_version еще нет."""
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def apply_migrations():
+    """
+    Приводит схему БД к LATEST_VERSION: если версия уже актуальна, стоит одного запроса,
+    иначе под advisory-блокировкой по порядку применяет недостающие шаги MIGRATIONS.
+    Версия записывается после каждого успешного шага; на неудачном шаге применение останавливается.
+    Возвращает True, если схема актуальна.
+    """
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                version = _current_version(cur)
+                conn.commit()
+                if version >= LATEST_VERSION:
+                    logger.info(f"Database schema is up to date (version {version}).")
+                    return True
+
+                # Шаги берут свои соединения из пула, блокировка держится на этом (уровня сессии)
+                cur.execute("SELECT pg_advisory_lock(%s)", (_MIGRATION_LOCK_KEY,))
+                try:
+                    cur.execute(SCHEMA_VERSION_SQL)
+                    # Пока ждали блокировку, миграции мог применить другой экземпляр
+                    version = _current_version(cur)
+                    conn.commit()
+                    for migration in MIGRATIONS:
+                        if migration.version <= version:
+                            continue
+                        logger.info(f"Applying schema migration {migration.version}: {migration.description}...")
+                        if not migration.apply():
+                            logger.error(f"Schema migration {migration.version} failed, "
+                                         f"schema stays at version {version}.")
+                            return False
+                        cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                                    (migration.version, migration.description))
+                        conn.commit()
+                        version = migration.version
+                finally:
+                    conn.rollback()
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (_MIGRATION_LOCK_KEY,))
+                    conn.commit()
+        logger.info(f"Database schema migrated to version {LATEST_VERSION}.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error applying schema migrations: {repr(error)}")
+        return False
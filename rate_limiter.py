@@ -0,0 +1,91 @@
+# rate_limiter.py
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Потокобезопасный ограничитель частоты запросов (token bucket).
+    Токены пополняются со скоростью rate в секунду, в "ведре" помещается не больше capacity токенов,
+    поэтому после простоя допускается короткий всплеск из capacity запросов подряд.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive, got {rate}")
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, tokens=1):
+        """Блокирует поток, пока не наберется нужное число токенов. Возвращает время ожидания в секундах."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    TokenBucket, который сам подбирает частоту (AIMD): после каждого успешного ответа она растет
+    на increase_step до max_rate, при троттлинге падает в decrease_factor раз, но не ниже min_rate.
+    Если сервер указал Retry-After, все потоки ждут до этого момента.
+    """
+
+    def __init__(self, name, rate, capacity=None, min_rate=None, max_rate=None,
+                 increase_step=0.05, decrease_factor=0.5):
+        super().__init__(rate, capacity)
+        self.name = name
+        self.min_rate = float(min_rate if min_rate is not None else rate / 10)
+        self.max_rate = float(max(max_rate if max_rate is not None else rate, rate))
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self._paused_until = 0.0
+
+    def acquire(self, tokens=1):
+        waited = 0.0
+        while True:
+            with self._lock:
+                pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+            waited += pause
+        return waited + super().acquire(tokens)
+
+    def on_success(self):
+        """Ответ без троттлинга: понемногу повышаем частоту."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        """Троттлинг (429/503, таймаут): снижаем частоту и при retry_after приостанавливаем все запросы."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            previous_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            # Накопленный запас тоже сбрасываем, иначе после паузы уйдет всплеск запросов
+            self._tokens = min(self._tokens, 1.0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+        logger.warning(f"{self.name}: throttled, rate limit {previous_rate:.2f} -> {self.rate:.2f} req/s"
+                       + (f", pausing for {retry_after:.1f}s." if retry_after else "."))
@@ -0,0 +1,182 @@
+# rollups.py
+import logging
+from datetime import date, timedelta
+
+import psycopg2
+from psycopg2 import sql
+
+import config
+import db_manager
+import tenants
+
+logger = logging.getLogger(__name__)
+
+# Гранулярности агрегатов: (значение period_type, единица date_trunc)
+PERIODS = (('day', 'day'), ('week', 'week'), ('month', 'month'))
+
+ROLLUP_TABLES_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS rollup_traffic_sources (
+        period_type VARCHAR(5) NOT NULL, -- 'day', 'week', 'month'
+        period_start DATE NOT NULL,
+        source_group VARCHAR(255) NOT NULL,
+        source_engine VARCHAR(255) NOT NULL,
+        visits BIGINT,
+        users BIGINT, -- сумма дневных значений, а не уникальные пользователи за период
+        tenant_id VARCHAR(64) NOT NULL,
+        PRIMARY KEY (tenant_id, period_type, period_start, source_group, source_engine)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_conversions (
+        period_type VARCHAR(5) NOT NULL,
+        period_start DATE NOT NULL,
+        goal_id VARCHAR(255) NOT NULL,
+        source_engine VARCHAR(255) NOT NULL,
+        reaches BIGINT,
+        tenant_id VARCHAR(64) NOT NULL,
+        PRIMARY KEY (tenant_id, period_type, period_start, goal_id, source_engine)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_positions (
+        period_type VARCHAR(5) NOT NULL,
+        period_start DATE NOT NULL,
+        search_engine_id INTEGER NOT NULL,
+        region_id INTEGER NOT NULL,
+        avg_position REAL,
+        rows_count INTEGER, -- число пар (ключевое слово, день) с известной позицией
+        top3_count INTEGER,
+        top10_count INTEGER,
+        top30_count INTEGER,
+        tenant_id VARCHAR(64) NOT NULL,
+        PRIMARY KEY (tenant_id, period_type, period_start, search_engine_id, region_id)
+    );
+    """,
+)
+
+# Первичные ключи агрегатов (для перевода таблиц, созданных до появления тенантов)
+ROLLUP_KEYS = {
+    "rollup_traffic_sources": ("tenant_id", "period_type", "period_start", "source_group", "source_engine"),
+    "rollup_conversions": ("tenant_id", "period_type", "period_start", "goal_id", "source_engine"),
+    "rollup_positions": ("tenant_id", "period_type", "period_start", "search_engine_id", "region_id"),
+}
+
+# Фактовая таблица -> список (таблица агрегата, SELECT с агрегацией тенанта %(tenant_id)s за
+# [%(date_from)s, %(date_to)s)). Первые две колонки SELECT - period_type и period_start, последняя -
+# tenant_id, порядок остальных совпадает с таблицей агрегата.
+ROLLUPS = {
+    "metrika_traffic_sources": (
+        ("rollup_traffic_sources", """
+            SELECT %(period_type)s, date_trunc(%(unit)s, report_date)::date,
+                   s.source_group, s.source_engine, SUM(f.visits), SUM(f.users), %(tenant_id)s
+            FROM metrika_traffic_sources f JOIN dim_sources s USING (source_id)
+            WHERE f.tenant_id = %(tenant_id)s AND report_date >= %(date_from)s AND report_date < %(date_to)s
+            GROUP BY 1, 2, 3, 4
+        """),
+    ),
+    "metrika_conversions": (
+        ("rollup_conversions", """
+            SELECT %(period_type)s, date_trunc(%(unit)s, report_date)::date,
+                   f.goal_id, s.source_engine, SUM(f.reaches), %(tenant_id)s
+            FROM metrika_conversions f JOIN dim_sources s USING (source_id)
+            WHERE f.tenant_id = %(tenant_id)s AND report_date >= %(date_from)s AND report_date < %(date_to)s
+            GROUP BY 1, 2, 3, 4
+        """),
+    ),
+    "topvisor_positions": (
+        ("rollup_positions", """
+            SELECT %(period_type)s, date_trunc(%(unit)s, report_date)::date,
+                   search_engine_id, region_id, AVG(position),
+                   COUNT(*), COUNT(*) FILTER (WHERE position <= 3),
+                   COUNT(*) FILTER (WHERE position <= 10), COUNT(*) FILTER (WHERE position <= 30), %(tenant_id)s
+            FROM topvisor_positions
+            WHERE tenant_id = %(tenant_id)s AND report_date >= %(date_from)s AND report_date < %(date_to)s
+              AND position IS NOT NULL AND search_engine_id IS NOT NULL AND region_id IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+        """),
+    ),
+}
+
+
+def _bucket_bounds(unit, date_from, date_to):
+    """Границы [начало первого, начало следующего за последним) периодов, задетых датами date_from..date_to."""
+    if unit == 'day':
+        return date_from, date_to + timedelta(days=1)
+    if unit == 'week':
+        start = date_from - timedelta(days=date_from.weekday())
+        return start, date_to - timedelta(days=date_to.weekday()) + timedelta(days=7)
+    start = date_from.replace(day=1)
+    last_month_start = date_to.replace(day=1)
+    return start, (last_month_start + timedelta(days=32)).replace(day=1)
+
+
+def create_rollup_tables():
+    """Создает таблицы агрегатов, если их еще нет."""
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for command in ROLLUP_TABLES_SQL:
+                    cur.execute(command)
+                for rollup_table, key_columns in ROLLUP_KEYS.items():
+                    db_manager.ensure_tenant_column(cur, rollup_table, 'p', key_columns)
+            conn.commit()
+        logger.info("Rollup tables checked/created successfully.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error creating rollup tables: {repr(error)}")
+        return False
+
+
+def refresh_rollups(table_name, date_from, date_to, tenant_id):
+    """
+    Пересчитывает агрегаты фактовой таблицы тенанта tenant_id только для периодов (день/неделя/месяц), в которые
+    попадают даты date_from..date_to: старые строки этих периодов удаляются и вставляются заново
+    в одной транзакции, так что дашборды не видят "полупустых" периодов. Параллельные пересчеты одной таблицы
+    агрегатов тенанта (окна backfill, фоновое окно и ежедневная загрузка) выполняются по очереди
+    под advisory-блокировкой транзакции, иначе их DELETE + INSERT одного периода нарушают уникальный ключ.
+    """
+    rollups = ROLLUPS.get(table_name)
+    if not rollups:
+        return True
+    date_from = db_manager._to_date(date_from)
+    date_to = db_manager._to_date(date_to)
+    try:
+        with db_manager.pooled_connection() as conn:
+            with conn.cursor() as cur:
+                for rollup_table, select_sql in rollups:
+                    # Блокировки берутся в порядке ROLLUPS, поэтому взаимных блокировок между пересчетами нет;
+                    # снимаются при commit/rollback
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{tenant_id}:{rollup_table}",))
+                    for period_type, unit in PERIODS:
+                        bucket_from, bucket_to = _bucket_bounds(unit, date_from, date_to)
+                        params = {'period_type': period_type, 'unit': unit, 'tenant_id': tenant_id,
+                                  'date_from': bucket_from, 'date_to': bucket_to}
+                        cur.execute(sql.SQL(
+                            "DELETE FROM {} WHERE tenant_id = %(tenant_id)s AND period_type = %(period_type)s "
+                            "AND period_start >= %(date_from)s AND period_start < %(date_to)s"
+                        ).format(sql.Identifier(rollup_table)), params)
+                        cur.execute(sql.SQL("INSERT INTO {} ").format(sql.Identifier(rollup_table))
+                                    + sql.SQL(select_sql), params)
+            conn.commit()
+        logger.info(f"Rollups of {tenant_id}/{table_name} refreshed for {date_from} - {date_to}.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        logger.error(f"Error refreshing rollups of {tenant_id}/{table_name} for {date_from} - {date_to}: {repr(error)}")
+        return False
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=config.LOG_LEVEL.upper(),
+        format='%(asctime)s - %(levelname)s - %(name)s - %(module)s - %(funcName)s - %(lineno)d - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
+    # Полный пересчет агрегатов за период исторической загрузки (например, после первого развертывания)
+    create_rollup_tables()
+    rebuild_to = date.today() - timedelta(days=1)
+    rebuild_from = date.today() - timedelta(days=config.HISTORICAL_LOAD_DAYS)
+    for tenant in tenants.load_tenants():
+        for fact_table in ROLLUPS:
+            refresh_rollups(fact_table, rebuild_from, rebuild_to, tenant.tenant_id)
+    logger.info("rollups.py rebuild finished.")
@@ -0,0 +1,63 @@
+# schema.py
+from collections import namedtuple
+
+# Типы записей, которые отдают парсеры API. Это кортежи: без словаря на каждую строку,
+# и если у таблицы нет справочников, запись уходит в БД как есть, без пересборки.
+# Источник Метрики хранится как есть (тип и детализация), группа и система выводятся в dim_sources.
+TrafficSourceRecord = namedtuple(
+    'TrafficSourceRecord', 'report_date source_type source_detail visits users')
+BehaviorRecord = namedtuple(
+    'BehaviorRecord', 'report_date bounces bounce_rate page_depth avg_visit_duration_seconds')
+ConversionRecord = namedtuple(
+    'ConversionRecord', 'report_date goal_id source_type source_detail reaches conversion_rate')
+PositionRecord = namedtuple(
+    'PositionRecord', 'report_date keyword search_engine_name search_engine_id region_id position url')
+VisibilityRecord = namedtuple(
+    'VisibilityRecord', 'report_date search_engine_name search_engine_id region_id visibility_score')
+
+
+class TableSchema:
+    """
+    Связывает таблицу фактов с типом записей парсера и справочниками.
+    dimensions - кортеж (имя справочника из dimensions.py, поля записи, колонка с ключом в таблице):
+    группа полей записи заменяется в БД одной колонкой с суррогатным ключом (на месте первого поля группы).
+    """
+
+    def __init__(self, table_name, record_type, dimensions=()):
+        self.table_name = table_name
+        self.record_type = record_type
+        self.dimensions = tuple(dimensions)
+
+        fields = record_type._fields
+        replaced = {field: (dim_index, id_column)
+                    for dim_index, (_, source_fields, id_column) in enumerate(self.dimensions)
+                    for field in source_fields}
+        columns = []
+        # Для каждой колонки БД: ('field', индекс поля записи) или ('dim', индекс справочника)
+        column_plan = []
+        for field_index, field in enumerate(fields):
+            if field not in replaced:
+                columns.append(field)
+                column_plan.append(('field', field_index))
+            elif ('dim', replaced[field][0]) not in column_plan:
+                columns.append(replaced[field][1])
+                column_plan.append(('dim', replaced[field][0]))
+        # Первая колонка каждой строки в БД - tenant_id, ее подставляет dimensions.encode_records
+        self.columns = ('tenant_id',) + tuple(columns)
+        self.column_plan = tuple(column_plan)
+        self.dimension_field_indexes = tuple(tuple(fields.index(field) for field in source_fields)
+                                             for _, source_fields, _ in self.dimensions)
+
+
+_SOURCE_FIELDS = ('source_type', 'source_detail')
+
+TRAFFIC_SOURCES = TableSchema('metrika_traffic_sources', TrafficSourceRecord,
+                              dimensions=(('sources', _SOURCE_FIELDS, 'source_id'),))
+BEHAVIOR = TableSchema('metrika_behavior', BehaviorRecord)
+CONVERSIONS = TableSchema('metrika_conversions', ConversionRecord,
+                          dimensions=(('sources', _SOURCE_FIELDS, 'source_id'),))
+POSITIONS = TableSchema('topvisor_positions', PositionRecord,
+                        dimensions=(('keywords', ('keyword',), 'keyword_id'), ('urls', ('url',), 'url_id')))
+VISIBILITY = TableSchema('topvisor_visibility', VisibilityRecord)
+
+TABLES = {table.table_name: table for table in (TRAFFIC_SOURCES, BEHAVIOR, CONVERSIONS, POSITIONS, VISIBILITY)}
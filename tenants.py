@@ -0,0 +1,93 @@
+# tenants.py
+import contextvars
+import json
+import logging
+from collections import namedtuple
+from contextlib import contextmanager
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Тенант - один сайт: счетчик Метрики и проект Топвизора, строки в БД помечаются его tenant_id
+Tenant = namedtuple('Tenant', [
+    'tenant_id',
+    'metrika_token', 'metrika_counter_id', 'metrika_goals',
+    'topvisor_api_key', 'topvisor_user_id', 'topvisor_project_id', 'topvisor_region_indexes', 'topvisor_searchers',
+])
+
+
+def _tenant_from_dict(data):
+    """Тенант из записи файла; незаданные поля берутся из общих настроек config (например, общий токен)."""
+    goals = data.get('metrika_goals', config.METRIKA_GOALS_MAP)
+    return Tenant(
+        tenant_id=str(data['tenant_id']),
+        metrika_token=data.get('metrika_token', config.METRIKA_TOKEN),
+        metrika_counter_id=data.get('metrika_counter_id'),
+        metrika_goals={str(goal_id): goal_name for goal_id, goal_name in goals.items()},
+        topvisor_api_key=data.get('topvisor_api_key', config.TOPVISOR_API_KEY),
+        topvisor_user_id=data.get('topvisor_user_id', config.TOPVISOR_USER_ID),
+        topvisor_project_id=data.get('topvisor_project_id'),
+        topvisor_region_indexes=[int(r) for r in data.get('topvisor_region_indexes', config.TOPVISOR_REGION_INDEXES)],
+        topvisor_searchers=[int(s) for s in data.get('topvisor_searchers', config.TOPVISOR_SEARCHERS)],
+    )
+
+
+DEFAULT_TENANT = Tenant(
+    tenant_id=config.DEFAULT_TENANT_ID,
+    metrika_token=config.METRIKA_TOKEN,
+    metrika_counter_id=config.METRIKA_COUNTER_ID,
+    metrika_goals=config.METRIKA_GOALS_MAP,
+    topvisor_api_key=config.TOPVISOR_API_KEY,
+    topvisor_user_id=config.TOPVISOR_USER_ID,
+    topvisor_project_id=config.TOPVISOR_PROJECT_ID,
+    topvisor_region_indexes=config.TOPVISOR_REGION_INDEXES,
+    topvisor_searchers=config.TOPVISOR_SEARCHERS,
+)
+
+
+def load_tenants():
+    """
+    Список тенантов из config.TENANTS_FILE (JSON-массив объектов с tenant_id, metrika_counter_id,
+    topvisor_project_id и т.д.) или единственный тенант из переменных окружения.
+    Файл читается при каждом запуске задачи, поэтому новый сайт подключается без перезапуска.
+    """
+    if not config.TENANTS_FILE:
+        return [DEFAULT_TENANT]
+    with open(config.TENANTS_FILE, encoding='utf-8') as tenants_file:
+        entries = json.load(tenants_file)
+    tenant_list = []
+    for entry in entries:
+        try:
+            tenant = _tenant_from_dict(entry)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.error(f"Invalid tenant entry {entry}: {e}. Skipping.")
+            continue
+        if any(known.tenant_id == tenant.tenant_id for known in tenant_list):
+            logger.error(f"Duplicate tenant_id '{tenant.tenant_id}' in {config.TENANTS_FILE}. Skipping.")
+            continue
+        tenant_list.append(tenant)
+    return tenant_list
+
+
+_current_tenant = contextvars.ContextVar('tenant', default=None)
+
+
+def current():
+    """Тенант, для которого сейчас идет загрузка (по умолчанию - тенант из переменных окружения)."""
+    return _current_tenant.get() or DEFAULT_TENANT
+
+
+def current_id():
+    return current().tenant_id
+
+
+@contextmanager
+def use(tenant):
+    """Делает tenant текущим в блоке; потоки concurrency.ordered_map и job_graph наследуют его."""
+    token = _current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current_tenant.reset(token)
+
@@ -0,0 +1,140 @@
+# tests/test_job_graph.py
+import contextvars
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_graph  # noqa: E402
+from job_graph import Job, run_job_graph  # noqa: E402
+
+
+def _flaky(failures):
+    """Задача, которая первые failures раз падает, а потом выполняется успешно."""
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise RuntimeError(f"failure {len(calls)}")
+        return True
+
+    return func, calls
+
+
+class RunJobGraphTest(unittest.TestCase):
+
+    def test_failed_dependency_skips_dependents_only(self):
+        results = run_job_graph([
+            Job('a', lambda: False),
+            Job('b', lambda: True, depends_on=('a',)),
+            Job('c', lambda: True, depends_on=('b',)),
+            Job('d', lambda: True),
+        ], max_workers=2)
+
+        self.assertEqual(results['a'].status, 'failed')
+        self.assertEqual(results['b'].status, 'skipped')
+        self.assertEqual(results['c'].status, 'skipped')
+        self.assertEqual(results['b'].attempts, 0)
+        self.assertEqual(results['d'].status, 'success')
+        self.assertEqual(list(results), ['a', 'b', 'c', 'd'])
+
+    def test_dependents_start_after_dependency_succeeds(self):
+        order = []
+        run_job_graph([
+            Job('load', lambda: order.append('load')),
+            Job('rollup', lambda: order.append('rollup'), depends_on=('load',)),
+        ], max_workers=4)
+        self.assertEqual(order, ['load', 'rollup'])
+
+    def test_retry_after_failure(self):
+        func, calls = _flaky(failures=1)
+        results = run_job_graph([Job('flaky', func, retries=2, retry_delay=0.01)], max_workers=1)
+
+        self.assertEqual(results['flaky'].status, 'success')
+        self.assertEqual(results['flaky'].attempts, 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_retries_exhausted(self):
+        func, calls = _flaky(failures=10)
+        results = run_job_graph([Job('broken', func, retries=1, retry_delay=0.01)], max_workers=1)
+
+        self.assertEqual(results['broken'].status, 'failed')
+        self.assertEqual(results['broken'].attempts, 2)
+        self.assertIn('failure 2', results['broken'].error)
+        self.assertEqual(len(calls), 2)
+
+    def test_timeout_is_not_retried_and_blocks_reruns_until_finished(self):
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait(5)
+            return True
+
+        started = time.monotonic()
+        results = run_job_graph([
+            Job('slow', slow, timeout=0.1, retries=3),
+            Job('after', lambda: True, depends_on=('slow',)),
+        ], max_workers=2)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(results['slow'].status, 'timeout')
+        self.assertEqual(results['slow'].attempts, 1)
+        self.assertEqual(results['after'].status, 'skipped')
+
+        # Поток первой попытки еще работает: следующий граф не должен запустить ту же задачу
+        self.assertTrue(job_graph.still_running('slow'))
+        results = run_job_graph([Job('slow', slow), Job('after', lambda: True, depends_on=('slow',))],
+                                max_workers=2)
+        self.assertEqual(results['slow'].status, 'skipped')
+        self.assertEqual(results['after'].status, 'skipped')
+        self.assertEqual(len(calls), 1)
+
+        release.set()
+        deadline = time.monotonic() + 5
+        while job_graph.still_running('slow') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        results = run_job_graph([Job('slow', slow)], max_workers=1)
+        self.assertEqual(results['slow'].status, 'success')
+        self.assertEqual(len(calls), 2)
+
+    def test_max_workers_bound(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def work():
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+
+        results = run_job_graph([Job(f"job{index}", work) for index in range(6)], max_workers=2)
+
+        self.assertTrue(all(result.status == 'success' for result in results.values()))
+        self.assertEqual(state['peak'], 2)
+
+    def test_jobs_see_caller_context(self):
+        tenant = contextvars.ContextVar('tenant', default=None)
+        seen = []
+        tenant.set('site-a')
+        run_job_graph([Job('read', lambda: seen.append(tenant.get()))], max_workers=1)
+        self.assertEqual(seen, ['site-a'])
+
+    def test_invalid_graphs(self):
+        with self.assertRaises(ValueError):
+            run_job_graph([Job('a', lambda: True, depends_on=('b',)),
+                           Job('b', lambda: True, depends_on=('a',))], max_workers=1)
+        with self.assertRaises(ValueError):
+            run_job_graph([Job('a', lambda: True, depends_on=('missing',))], max_workers=1)
+        with self.assertRaises(ValueError):
+            run_job_graph([Job('a', lambda: True), Job('a', lambda: True)], max_workers=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
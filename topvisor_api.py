@@ -1,39 +1,90 @@
 # topvisor_api.py (ФИНАЛЬНАЯ ВЕРСИЯ)
 import requests
 import logging
+import threading
 import time
 import json
 from datetime import datetime, timedelta
 import config
+import etl_metrics
+import tenants
+from concurrency import ordered_map
+from http_cache import get_response_cache, ttl_for_dates
+from http_client import SharedSession, backoff_delay, send_with_retries
+from rate_limiter import AdaptiveTokenBucket
+from schema import PositionRecord, VisibilityRecord
 
 logger = logging.getLogger(__name__)
 
+# Ключ API и пользователь берутся у текущего тенанта (tenants.current())
 BASE_TOPVISOR_API_URL = config.TOPVISOR_API_URL
-API_KEY = config.TOPVISOR_API_KEY
-USER_ID = config.TOPVISOR_USER_ID
 
 SEARCHER_MAP = {
     1: "Yandex XML", 2: "Yandex", 3: "Google", 4: "Go.Mail.ru", 5: "Rambler",
     6: "Bing", 7: "Yahoo", 8: "ASK", 9: "Sputnik", 10: "Youtube",
 }
 
+# Единый для всех потоков и тенантов лимит частоты запросов к API Топвизора (вместо time.sleep перед каждым запросом);
+# он сам поднимается до TOPVISOR_RATE_LIMIT_MAX_RPS и снижается при троттлинге
+_rate_limiter = AdaptiveTokenBucket("Topvisor API", config.TOPVISOR_RATE_LIMIT_RPS, config.TOPVISOR_RATE_LIMIT_BURST,
+                                    max_rate=config.TOPVISOR_RATE_LIMIT_MAX_RPS,
+                                    increase_step=config.HTTP_RATE_INCREASE_RPS)
+# и общий предел одновременных запросов при загрузке нескольких тенантов сразу
+_concurrency = threading.BoundedSemaphore(config.TOPVISOR_MAX_WORKERS)
 
-def call_public_api(method_path, params_data):
-    if not API_KEY or not USER_ID:
-        logger.error("Topvisor API Key or User ID is not configured.")
+# Keep-alive сессия с пулом соединений на все параллельные потоки: тысячи мелких запросов summary
+# не платят за TLS-рукопожатие каждый раз
+_session = SharedSession(
+    "Topvisor API",
+    lambda: {'Content-Type': 'application/json', 'Accept': 'application/json'},
+    pool_size=config.TOPVISOR_MAX_WORKERS
+)
+
+
+class TopvisorAPIError(Exception):
+    """Часть данных Топвизора не удалось получить даже после повторов (подробности в логе)."""
+
+
+class TopvisorUnavailableError(TopvisorAPIError):
+    """Запрос не прошел на уровне HTTP и после повторов send_with_retries - повторять его снова бессмысленно."""
+
+
+def _request(method_path, params_data, full_response=False):
+    """
+    Один вызов метода API (временные ошибки HTTP повторяет send_with_retries). Возвращает поле 'result' ответа
+    (или весь ответ, если full_response=True - нужен для 'total'/'nextOffset') либо None, если API ответил
+    ошибками в теле; если не помогли и повторы HTTP, выбрасывает TopvisorUnavailableError.
+    """
+    tenant = tenants.current()
+    if not tenant.topvisor_api_key or not tenant.topvisor_user_id:
+        logger.error(f"Topvisor API Key or User ID is not configured for tenant '{tenant.tenant_id}'.")
         return None
 
     full_url = f"{BASE_TOPVISOR_API_URL.strip('/')}/v2/json/get/{method_path.strip('/')}"
-    headers = {'User-Id': str(USER_ID), 'Authorization': f'Bearer {API_KEY}', 'Content-Type': 'application/json',
-               'Accept': 'application/json'}
     payload = params_data
 
     # Убираем лишний лог, чтобы не засорять вывод
     # logger.info(f"Attempting Topvisor Public API Call. URL: {full_url}")
     logger.debug(f"Payload (body): {json.dumps(payload, ensure_ascii=False)}")
 
+    # Ответы за прошедшие даты не меняются, поэтому берем их из кэша, не тратя квоту API
+    cache = get_response_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key('POST', full_url, {'user_id': str(tenant.topvisor_user_id), 'payload': payload})
+        cached_content = cache.get(cache_key)
+        if cached_content is not None:
+            etl_metrics.add('cache_hits')
+            return cached_content if full_response else cached_content.get("result")
+
+    def send():
+        with _concurrency:
+            return _session.get().post(full_url, json=payload, timeout=60, headers={
+                'User-Id': str(tenant.topvisor_user_id), 'Authorization': f'Bearer {tenant.topvisor_api_key}'})
+
     try:
-        response = requests.post(full_url, headers=headers, json=payload, timeout=60)
+        # Временные ошибки (429/5xx, таймауты) повторяются здесь же с паузами по Retry-After или с джиттером
+        response = send_with_retries(send, _rate_limiter, f"Topvisor {method_path} request")
         response_content = response.json()
 
         if response.status_code != 200:
@@ -43,125 +94,297 @@ def call_public_api(method_path, params_data):
         response.raise_for_status()
 
         if "errors" in response_content and response_content["errors"]:
+            etl_metrics.add('http_errors')
             logger.error(f"Topvisor API returned an error: {response_content['errors']}")
             return None
 
-        return response_content.get("result")
+        if cache is not None:
+            cache.set(cache_key, response_content, ttl_for_dates("topvisor", payload.get("dates") or []))
+        return response_content if full_response else response_content.get("result")
 
     except requests.exceptions.RequestException as e:
+        etl_metrics.add('http_errors')
         logger.error(f"Request error: {e}", exc_info=True)
-        return None
+        raise TopvisorUnavailableError(f"Topvisor {method_path} request failed: {e}") from e
+    except ValueError as e:
+        # Не-JSON ответ (например, HTML-страница ошибки прокси)
+        etl_metrics.add('http_errors')
+        logger.error(f"Invalid Topvisor API response: {e}")
+        raise TopvisorUnavailableError(f"Topvisor {method_path} returned an invalid response: {e}") from e
 
 
-def get_positions_history(date_from_str, date_to_str, project_id, region_indexes, searcher_ids):
+def _call_with_retries(method_path, params_data, description, full_response=False):
+    """
+    Вызывает метод API с повторами при ошибках в теле ответа ('errors') и экспоненциальной паузой с джиттером;
+    возвращает result или None после всех попыток. Сетевые ошибки и 429/5xx уже повторил send_with_retries:
+    их здесь не повторяем, а пробрасываем TopvisorUnavailableError.
+    """
+    for attempt in range(1, config.TOPVISOR_CELL_RETRIES + 1):
+        result = _request(method_path, params_data, full_response=full_response)
+        if result is not None:
+            return result
+        if attempt < config.TOPVISOR_CELL_RETRIES:
+            delay = backoff_delay(attempt, base=config.TOPVISOR_RETRY_BACKOFF_SECONDS)
+            logger.warning(f"Topvisor request for {description} failed (attempt {attempt}), retrying in {delay:.1f}s.")
+            etl_metrics.add('http_retries')
+            etl_metrics.add('http_sleep_seconds', delay)
+            time.sleep(delay)
+    logger.error(f"Topvisor request for {description} failed after {config.TOPVISOR_CELL_RETRIES} attempts.")
+    return None
+
+
+def _parse_positions_page(keywords, searcher_id):
+    """Разбирает одну страницу ключевых слов positions_2/history в список записей позиций."""
+    searcher_name = SEARCHER_MAP.get(searcher_id, f"SearcherID {searcher_id}")
+    records = []
+    for keyword_data in keywords:
+        keyword_name = keyword_data.get("name")
+        positions_data = keyword_data.get("positionsData", {})
+
+        if not isinstance(positions_data, dict):
+            continue
+
+        for composite_key, pos_data in positions_data.items():
+            try:
+                parts = composite_key.split(':')
+                if len(parts) < 3: continue
+
+                report_date = parts[0]
+                region_id = int(parts[2])
+                position_val = pos_data.get("position")
+
+                if not isinstance(position_val, (int, str)) or not str(position_val).isdigit():
+                    continue
+
+                position = int(position_val)
+            except (ValueError, TypeError, IndexError) as e:
+                logger.warning(f"Error parsing position data for '{keyword_name}': {e}. Skipping.")
+                etl_metrics.add('rejected_rows')
+                continue
+            records.append(PositionRecord(report_date, keyword_name, searcher_name, searcher_id, region_id,
+                                          position, pos_data.get("relevant_url")))
+    return records
+
+
+def _fetch_positions_page(base_params, searcher_id, offset):
+    """
+    Загружает и сразу разбирает одну страницу истории позиций.
+    Возвращает (ответ API без ключевых слов или None при ошибке, список записей, число ключевых слов на странице).
+    """
+    params = dict(base_params, offset=offset)
+    try:
+        response = _call_with_retries("positions_2/history", params,
+                                      f"positions page offset={offset}, searcher {searcher_id}", full_response=True)
+    except TopvisorUnavailableError as e:
+        logger.error(f"Positions page offset={offset}, searcher {searcher_id} failed: {e}")
+        response = None
+    if response is None:
+        return None, [], 0
+    result = response.get("result") or {}
+    keywords = result.get("keywords") if isinstance(result, dict) else None
+    if not isinstance(keywords, list):
+        keywords = []
+    page_meta = {key: value for key, value in response.items() if key != "result"}
+    return page_meta, _parse_positions_page(keywords, searcher_id), len(keywords)
+
+
+def iter_positions_history(date_from_str, date_to_str, project_id, region_indexes, searcher_ids):
     """
     НАДЕЖНАЯ ВЕРСИЯ.
     Итерирует по поисковым системам, чтобы делать более простые и надежные запросы.
+    Ключевые слова запрашиваются страницами по config.TOPVISOR_POSITIONS_PAGE_SIZE: первая страница
+    сообщает общее число ('total'), после чего остальные страницы загружаются параллельно под общим
+    ограничителем частоты. Каждая страница разбирается отдельно, поэтому в памяти держатся только
+    страницы "в работе". Если API не вернул total, страницы запрашиваются последовательно по 'nextOffset'.
+    Если часть страниц так и не загрузилась, в конце выбрасывается TopvisorAPIError.
     """
-    all_positions_data = []
+    page_size = config.TOPVISOR_POSITIONS_PAGE_SIZE
+    processed_count = 0
+    failed_pages = 0
 
     for searcher_id in searcher_ids:
         logger.info(f"Fetching positions for searcher ID: {searcher_id}")
-        params = {
+        base_params = {
             "project_id": project_id,
             "regions_indexes": region_indexes,
             "searchers": [searcher_id],
             "dates": [date_from_str, date_to_str],
             "positions_fields": ["position", "relevant_url"],
             "fields": ["name", "id"],
-            "limit": 2000,
+            "limit": page_size,
             "offset": 0,
+            "fetch_total": True,
             "show_all_positions_data_from_date": 1
         }
 
-        result = call_public_api(method_path="positions_2/history", params_data=params)
-        time.sleep(1)
-
-        if result and "keywords" in result and isinstance(result["keywords"], list):
-            searcher_name = SEARCHER_MAP.get(searcher_id, f"SearcherID {searcher_id}")
-
-            for keyword_data in result["keywords"]:
-                keyword_name = keyword_data.get("name")
-                positions_data = keyword_data.get("positionsData", {})
-
-                if not isinstance(positions_data, dict):
+        page_meta, records, keywords_count = _fetch_positions_page(base_params, searcher_id, 0)
+        if page_meta is None:
+            failed_pages += 1
+            continue
+        processed_count += len(records)
+        yield from records
+
+        total = page_meta.get("total")
+        if isinstance(total, int):
+            # Общее число известно: остальные страницы грузим параллельно, сохраняя порядок
+            offsets = range(page_size, total, page_size)
+            logger.info(f"Searcher {searcher_id}: {total} keywords, {len(offsets) + 1} page(s).")
+            for page_meta, records, _ in ordered_map(
+                    lambda offset: _fetch_positions_page(base_params, searcher_id, offset), offsets,
+                    max_workers=config.TOPVISOR_MAX_WORKERS, thread_name_prefix="topvisor-positions"):
+                if page_meta is None:
+                    failed_pages += 1
                     continue
-
-                for composite_key, pos_data in positions_data.items():
-                    try:
-                        parts = composite_key.split(':')
-                        if len(parts) < 3: continue
-
-                        report_date = parts[0]
-                        region_id = int(parts[2])
-                        position_val = pos_data.get("position")
-
-                        if not isinstance(position_val, (int, str)) or not str(position_val).isdigit():
-                            continue
-
-                        position = int(position_val)
-
-                        all_positions_data.append({
-                            "report_date": report_date, "keyword": keyword_name,
-                            "search_engine_name": searcher_name, "search_engine_id": searcher_id,
-                            "region_id": region_id, "position": position,
-                            "url": pos_data.get("relevant_url")
-                        })
-                    except (ValueError, TypeError, IndexError) as e:
-                        logger.warning(f"Error parsing position data for '{keyword_name}': {e}. Skipping.")
-                        continue
-
-    logger.info(f"Processed {len(all_positions_data)} position records for project {project_id}.")
-    return all_positions_data
+                processed_count += len(records)
+                yield from records
+        else:
+            offset = 0
+            while keywords_count >= page_size:
+                next_offset = page_meta.get("nextOffset")
+                offset = next_offset if isinstance(next_offset, int) else offset + page_size
+                page_meta, records, keywords_count = _fetch_positions_page(base_params, searcher_id, offset)
+                if page_meta is None:
+                    failed_pages += 1
+                    break
+                processed_count += len(records)
+                yield from records
+
+    logger.info(f"Processed {processed_count} position records for project {project_id}.")
+    if failed_pages:
+        raise TopvisorAPIError(f"{failed_pages} positions page(s) failed for {date_from_str} - {date_to_str}.")
+
+
+def _visibility_record(day_str, region_id, searcher_id, raw_value):
+    """Собирает запись видимости; возвращает None, если значения за день нет или оно некорректно."""
+    if raw_value is None:
+        return None
+    try:
+        visibility_score = float(raw_value)
+    except (ValueError, TypeError) as e:
+        logger.warning(f"Could not parse visibility '{raw_value}' for {day_str}. Error: {e}")
+        etl_metrics.add('rejected_rows')
+        return None
+    return VisibilityRecord(day_str, SEARCHER_MAP.get(searcher_id, f"SearcherID {searcher_id}"),
+                            searcher_id, region_id, visibility_score)
 
 
-def get_visibility_summary(date_from_str, date_to_str, project_id, region_indexes, searcher_ids):
+def _fetch_visibility_cell(project_id, cell):
     """
-    НАДЕЖНАЯ ВЕРСИЯ.
-    Получает историю видимости, итерируя по дням.
+    Загружает видимость для одной ячейки (день, регион, ПС).
+    Возвращает (успех, запись или None, если видимости за этот день нет); недоступность API
+    (TopvisorUnavailableError) пробрасывается.
+    """
+    day_str, region_id, searcher_id = cell
+    params = {
+        "project_id": project_id, "region_index": region_id,
+        "searcher": searcher_id, "dates": [day_str, day_str],
+        "show_visibility": True,
+    }
+    result = _call_with_retries("positions_2/summary", params,
+                                f"visibility {day_str}, region {region_id}, searcher {searcher_id}")
+    if result is None:
+        return False, None
+
+    visibility_list = result.get("visibilities", []) if isinstance(result, dict) else []
+    if not visibility_list:
+        return True, None
+    return True, _visibility_record(day_str, region_id, searcher_id, visibility_list[0])
+
+
+def _fetch_visibility_window(project_id, window):
+    """
+    Загружает ряд видимости за окно дат одним запросом positions_2/summary для пары регион/ПС.
+    Значения сопоставляются с днями по списку 'dates' из ответа (или по порядку, если ответ
+    содержит ровно по значению на день). Дни, которых нет в ответе (API обрезал диапазон),
+    догружаются запросами по одному дню.
+    Возвращает (число неудачных ячеек, список записей в порядке дней). Если API недоступен
+    (TopvisorUnavailableError), оставшиеся дни по одному не запрашиваются: неудачными считаются все дни окна.
+    """
+    days, region_id, searcher_id = window
+    try:
+        return _load_visibility_window(project_id, days, region_id, searcher_id)
+    except TopvisorUnavailableError as e:
+        logger.error(f"Visibility {days[0]} - {days[-1]}, region {region_id}, searcher {searcher_id} failed: {e}")
+        return len(days), []
+
+
+def _load_visibility_window(project_id, days, region_id, searcher_id):
+    if len(days) == 1:
+        ok, record = _fetch_visibility_cell(project_id, (days[0], region_id, searcher_id))
+        return (0 if ok else 1), ([record] if record is not None else [])
+
+    params = {
+        "project_id": project_id, "region_index": region_id,
+        "searcher": searcher_id, "dates": [days[0], days[-1]],
+        "show_visibility": True,
+    }
+    result = _call_with_retries("positions_2/summary", params,
+                                f"visibility {days[0]} - {days[-1]}, region {region_id}, searcher {searcher_id}")
+
+    values_by_day = {}
+    if isinstance(result, dict):
+        visibility_list = result.get("visibilities") or []
+        response_dates = result.get("dates")
+        if isinstance(response_dates, list) and len(response_dates) == len(visibility_list):
+            values_by_day = dict(zip(response_dates, visibility_list))
+        elif len(visibility_list) == len(days):
+            values_by_day = dict(zip(days, visibility_list))
+
+    missing_days = [day_str for day_str in days if day_str not in values_by_day]
+    if missing_days:
+        logger.warning(f"Visibility range {days[0]} - {days[-1]} (region {region_id}, searcher {searcher_id}) "
+                       f"returned {len(days) - len(missing_days)}/{len(days)} days; "
+                       f"falling back to per-day requests for the rest.")
+
+    failed_cells = 0
+    records = []
+    for day_str in days:
+        if day_str in values_by_day:
+            record = _visibility_record(day_str, region_id, searcher_id, values_by_day[day_str])
+        else:
+            ok, record = _fetch_visibility_cell(project_id, (day_str, region_id, searcher_id))
+            if not ok:
+                failed_cells += 1
+        if record is not None:
+            records.append(record)
+    return failed_cells, records
+
+
+def iter_visibility_summary(date_from_str, date_to_str, project_id, region_indexes, searcher_ids, window_days=None):
+    """
+    Получает историю видимости по сетке окно дат x регион x ПС: на каждое окно из window_days дней
+    (по умолчанию config.TOPVISOR_VISIBILITY_WINDOW_DAYS; 1 - запрос на каждый день) уходит один запрос.
+    Ячейки запрашиваются параллельно (config.TOPVISOR_MAX_WORKERS потоков) под общим ограничителем частоты,
+    а записи отдаются в исходном порядке сетки. Неудачная ячейка повторяется отдельно, не перезапуская сетку;
+    если после всех повторов ячейки остались незагруженными, в конце выбрасывается TopvisorAPIError.
     """
-    from datetime import datetime, timedelta
-    all_visibility_data = []
-
     try:
         start_date = datetime.strptime(date_from_str, '%Y-%m-%d').date()
         end_date = datetime.strptime(date_to_str, '%Y-%m-%d').date()
     except ValueError:
         logger.error(f"Invalid date format for visibility. Expected YYYY-MM-DD.")
-        return []
-
-    current_date = start_date
-    while current_date <= end_date:
-        day_str = current_date.strftime('%Y-%m-%d')
-
-        for region_id in region_indexes:
-            for searcher_id in searcher_ids:
-                # Убираем лишний лог, чтобы не засорять вывод
-                # logger.info(f"Requesting visibility for project {project_id}, region {region_id}, searcher {searcher_id}, date {day_str}")
-
-                params = {
-                    "project_id": project_id, "region_index": region_id,
-                    "searcher": searcher_id, "dates": [day_str, day_str],
-                    "show_visibility": True,
-                }
-                time.sleep(1)
-                result = call_public_api(method_path="positions_2/summary", params_data=params)
-
-                if result and "visibilities" in result:
-                    visibility_list = result.get("visibilities", [])
-                    if visibility_list and visibility_list[0] is not None:
-                        try:
-                            visibility_score = float(visibility_list[0])
-                            searcher_name = SEARCHER_MAP.get(searcher_id, f"SearcherID {searcher_id}")
-                            all_visibility_data.append({
-                                "report_date": day_str, "search_engine_name": searcher_name,
-                                "search_engine_id": searcher_id, "region_id": region_id,
-                                "visibility_score": visibility_score
-                            })
-                        except (ValueError, TypeError, IndexError) as e:
-                            logger.warning(f"Could not parse visibility '{visibility_list}' for {day_str}. Error: {e}")
-
-        current_date += timedelta(days=1)
-
-    logger.info(f"Processed {len(all_visibility_data)} visibility records for the entire period.")
-    return all_visibility_data
\ No newline at end of file
+        return
+
+    window_days = max(1, window_days or config.TOPVISOR_VISIBILITY_WINDOW_DAYS)
+    all_days = [(start_date + timedelta(days=offset)).strftime('%Y-%m-%d')
+                for offset in range((end_date - start_date).days + 1)]
+    windows = (
+        (all_days[i:i + window_days], region_id, searcher_id)
+        for i in range(0, len(all_days), window_days)
+        for region_id in region_indexes
+        for searcher_id in searcher_ids
+    )
+
+    processed_count = 0
+    failed_cells = 0
+    for window_failed, records in ordered_map(lambda window: _fetch_visibility_window(project_id, window), windows,
+                                              max_workers=config.TOPVISOR_MAX_WORKERS,
+                                              thread_name_prefix="topvisor-visibility"):
+        failed_cells += window_failed
+        for record in records:
+            processed_count += 1
+            yield record
+
+    logger.info(f"Processed {processed_count} visibility records for the entire period.")
+    if failed_cells:
+        raise TopvisorAPIError(f"{failed_cells} visibility cell(s) failed for {date_from_str} - {date_to_str}.")
@@ -0,0 +1,49 @@
+# traffic_classifier.py
+import logging
+import re
+from functools import lru_cache
+
+import config
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_SOURCE = "Не определено"
+
+
+def _compile_substrings(substrings):
+    """Список подстрок -> одно регулярное выражение без учета регистра; пустой список совпадает со всем."""
+    if not substrings:
+        return None
+    return re.compile('|'.join(re.escape(str(part)) for part in substrings), re.IGNORECASE)
+
+
+def compile_rules(rules):
+    """Превращает таблицу правил из конфига в кортеж (regex типа, regex системы, группа, источник)."""
+    compiled = []
+    for rule in rules:
+        try:
+            compiled.append((_compile_substrings(rule.get("source_type")),
+                             _compile_substrings(rule.get("source_engine")),
+                             rule["group"], rule["engine"]))
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.error(f"Invalid traffic source rule {rule}: {e}. Skipping.")
+    return tuple(compiled)
+
+
+_RULES = compile_rules(config.TRAFFIC_SOURCE_RULES)
+
+
+@lru_cache(maxsize=config.TRAFFIC_CLASSIFIER_CACHE_SIZE)
+def classify(source_type, source_engine):
+    """
+    Возвращает (source_group, source_engine) для пары ym:s:lastTrafficSource / ym:s:lastSourceEngine.
+    Различных пар немного, поэтому результат запоминается и правила на каждой строке не перебираются.
+    Правила по умолчанию заканчиваются правилом для всех остальных источников; если в своих правилах
+    его нет, неподошедший источник попадает в группу UNKNOWN_SOURCE с исходным типом вместо системы.
+    """
+    source_type = source_type or UNKNOWN_SOURCE
+    source_engine = source_engine or UNKNOWN_SOURCE
+    for type_re, engine_re, rule_group, rule_engine in _RULES:
+        if (type_re is None or type_re.search(source_type)) and (engine_re is None or engine_re.search(source_engine)):
+            return rule_group, rule_engine.replace("{source_type}", source_type)
+    return UNKNOWN_SOURCE, source_type